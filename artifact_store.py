@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import fcntl
+import hashlib
+import zipfile
+import contextlib
+import gzip
+import pickle
+import torch
+import numpy as np
+from torchtext.vocab import GloVe
+
+# Artifact store of preprocessed data
+# Each artifact group (e.g. a word embedding or the user history graphs of one split) is a directory of raw .npy files (and .json files for dictionaries),
+# and the manifest records the file, dtype and shape of every array so that loading is a memory-mapping without unpickling
+#   artifacts/manifest.json
+#   artifacts/digests.json
+#   artifacts/<group>/<key>.npy
+#   artifacts/<group>/<key>.json
+# The manifest also records the inputs, parameters, build time and size of every preprocessing stage group
+#   {'version': MANIFEST_VERSION, 'groups': {group: {key: entry}}, 'stages': {group: stage}}
+# and the digest file caches the content digests of the raw input files by path, size and modification time
+#   {path: {'size', 'mtime_ns', 'digest'}}
+# Both files are read-modified-written under an exclusive lock of artifacts/manifest.lock, and replaced atomically, so that concurrent runs sharing the store never lose an update
+MANIFEST_VERSION = 2
+
+class ArtifactStore:
+    def __init__(self, root='artifacts'):
+        self.root = root
+        self.manifest_file = os.path.join(self.root, 'manifest.json')
+        self.digest_file = os.path.join(self.root, 'digests.json')
+        self.lock_file = os.path.join(self.root, 'manifest.lock')
+        self.lock_f = None
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    # A manifest without version is either a version 1 manifest (flat {group: {key: entry}} without stages), which is migrated in place,
+    # or an unversioned manifest of the current layout {'groups', 'stages'}
+    # (the migration re-reads the manifest under the lock, as another run may have migrated it meanwhile)
+    def read_manifest(self):
+        manifest = read_json(self.manifest_file, None)
+        if manifest is None:
+            return {'version': MANIFEST_VERSION, 'groups': {}, 'stages': {}}
+        if 'version' not in manifest:
+            with self.locked():
+                manifest = read_json(self.manifest_file, None)
+                if 'version' not in manifest:
+                    if not (isinstance(manifest.get('groups'), dict) and isinstance(manifest.get('stages'), dict)):
+                        manifest = {'groups': manifest, 'stages': {}}
+                    manifest['version'] = MANIFEST_VERSION
+                    self.write_manifest(manifest)
+        assert manifest['version'] == MANIFEST_VERSION, 'unsupported artifact manifest version : %d' % manifest['version']
+        return manifest
+
+    # Must be called under the lock, with the manifest read under the same lock
+    def write_manifest(self, manifest):
+        assert self.lock_f is not None, 'the artifact manifest must be written under the lock'
+        write_json(self.manifest_file, manifest)
+
+    # Exclusive lock of the manifest and the digest file among the processes sharing the store
+    # It is re-entrant within a store object (flock locks of two opens of the lock file exclude each other, even in one process)
+    @contextlib.contextmanager
+    def locked(self):
+        if self.lock_f is not None:
+            yield
+            return
+        with open(self.lock_file, 'a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            self.lock_f = lock_f
+            try:
+                yield
+            finally:
+                self.lock_f = None
+
+    def update_manifest(self, group, key, entry):
+        with self.locked():
+            manifest = self.read_manifest()
+            manifest['groups'].setdefault(group, {})[key] = entry
+            self.write_manifest(manifest)
+
+    def path(self, group, key, extension='.npy'):
+        return os.path.join(self.root, group, key + extension)
+
+    def exists(self, group, keys=None):
+        manifest = self.read_manifest()
+        if group not in manifest['groups']:
+            return False
+        entries = manifest['groups'][group]
+        keys = entries.keys() if keys is None else keys
+        return all(key in entries and os.path.exists(os.path.join(self.root, entries[key]['file'])) for key in keys)
+
+    def keys(self, group):
+        return list(self.read_manifest()['groups'].get(group, {}).keys())
+
+    def save(self, group, key, array):
+        if isinstance(array, torch.Tensor):
+            array = array.detach().cpu().numpy()
+        if not os.path.exists(os.path.join(self.root, group)):
+            os.makedirs(os.path.join(self.root, group))
+        np.save(self.path(group, key), np.ascontiguousarray(array), allow_pickle=False)
+        self.update_manifest(group, key, {'file': group + '/' + key + '.npy', 'dtype': array.dtype.str, 'shape': list(array.shape), 'nbytes': int(array.nbytes)})
+
+    # Create a writable memory-mapped array to be filled in place (e.g. chunk by chunk) instead of building it in memory
+    # The array is registered in the manifest only by finalize, so that a partially written artifact is never loaded
+    def create(self, group, key, shape, dtype):
+        if not os.path.exists(os.path.join(self.root, group)):
+            os.makedirs(os.path.join(self.root, group))
+        return np.lib.format.open_memmap(self.path(group, key), mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def finalize(self, group, key, array):
+        array.flush()
+        self.update_manifest(group, key, {'file': group + '/' + key + '.npy', 'dtype': array.dtype.str, 'shape': list(array.shape), 'nbytes': int(array.nbytes)})
+
+    # Copy-on-write memory mapping : pages are shared through the page cache (and among DataLoader workers) until written
+    def load(self, group, key, mmap_mode='c'):
+        return self.load_entry(group, key, self.read_manifest()['groups'][group][key], mmap_mode)
+
+    def load_entry(self, group, key, entry, mmap_mode='c'):
+        array = np.load(os.path.join(self.root, entry['file']), mmap_mode=mmap_mode, allow_pickle=False)
+        assert array.dtype.str == entry['dtype'] and list(array.shape) == entry['shape'], 'artifact mismatch with manifest : %s/%s' % (group, key)
+        return array
+
+    def load_group(self, group, mmap_mode='c'):
+        return {key: self.load_entry(group, key, entry, mmap_mode) for key, entry in self.read_manifest()['groups'].get(group, {}).items() if 'dtype' in entry}
+
+    def load_tensor(self, group, key):
+        return torch.from_numpy(self.load(group, key))
+
+    def save_json(self, group, key, data):
+        if not os.path.exists(os.path.join(self.root, group)):
+            os.makedirs(os.path.join(self.root, group))
+        with open(self.path(group, key, '.json'), 'w', encoding='utf-8') as json_f:
+            json.dump(data, json_f)
+        self.update_manifest(group, key, {'file': group + '/' + key + '.json', 'nbytes': os.path.getsize(self.path(group, key, '.json'))})
+
+    def load_json(self, group, key):
+        with open(os.path.join(self.root, self.read_manifest()['groups'][group][key]['file']), 'r', encoding='utf-8') as json_f:
+            return json.load(json_f)
+
+    def record_stage(self, stage, seconds):
+        with self.locked():
+            manifest = self.read_manifest()
+            manifest['stages'][stage['group']] = {'stage': stage['name'],
+                                                  'inputs': stage['inputs'],
+                                                  'params': stage['params'],
+                                                  'seconds': seconds,
+                                                  'nbytes': sum(entry['nbytes'] for entry in manifest['groups'].get(stage['group'], {}).values()),
+                                                  'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self.write_manifest(manifest)
+
+    # Content digest of a raw input file (or of a member of a zip file), hashed only when the file is not in the digest file with the same size and modification time
+    # A moved, copied, touched or extracted input is hashed again to the same digest, so the stages keyed by it are not rebuilt
+    def content_digest(self, file, member=None):
+        stat = os.stat(file)
+        path = os.path.abspath(file) + ('' if member is None else '!' + member)
+        entry = read_json(self.digest_file, {}).get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['digest']
+        digest = md5_digest(file, member)
+        with self.locked():
+            digests = read_json(self.digest_file, {})
+            digests[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+            write_json(self.digest_file, digests)
+        return digest
+
+    # Build the keys of a preprocessing stage with build(group) unless all of them are already stored
+    def build_stage(self, stage, keys, build):
+        if not self.exists(stage['group'], keys):
+            start_time = time.time()
+            build(stage['group'])
+            self.record_stage(stage, round(time.time() - start_time, 3))
+            print('%s-completed : %s (%.1fs)' % (stage['name'], stage['group'], time.time() - start_time))
+
+
+def read_json(file, default):
+    if not os.path.exists(file):
+        return default
+    with open(file, 'r', encoding='utf-8') as json_f:
+        return json.load(json_f)
+
+# Written to a temporary file and renamed, so that a reader never sees a partially written file
+def write_json(file, data):
+    with open(file + '.tmp', 'w', encoding='utf-8') as json_f:
+        json.dump(data, json_f, indent=1)
+    os.replace(file + '.tmp', file)
+
+def md5_digest(file, member=None, chunk_size=1 << 24):
+    md5 = hashlib.md5()
+    with contextlib.ExitStack() as stack:
+        if member is None:
+            f = stack.enter_context(open(file, 'rb'))
+        else:
+            f = stack.enter_context(stack.enter_context(zipfile.ZipFile(file, 'r')).open(member, 'r'))
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Preprocessing stages
+# Every stage is stored as the artifact group '<stage>-<dataset>-<key>', where the key is a hash of the stage version, its inputs and its own parameters.
+# The inputs are either raw files (e.g. the dataset files and the GloVe file, fingerprinted by a logical name and a content digest) or the groups of upstream stages,
+# so that changing a parameter (e.g. max_history_num) rebuilds only the stages downstream of it and a stale artifact is never reused.
+# The GloVe text file is digested either as extracted or as the member of the downloaded zip file, so that both key the same stages.
+# The version of a stage must be increased whenever its building code changes.
+PREPROCESS_STAGE_VERSIONS = {
+    'ids': 1,                   # user ID, news ID, category, subCategory and entity dictionaries
+    'vocabulary': 1,            # word dictionary
+    'word_embedding': 3,        # GloVe word embedding of the vocabulary
+    'entity_embedding': 1,      # knowledge-graph entity & context embedding
+    'user_history_category': 1, # user history category masks & indices of each split
+    'user_history_graph': 1,    # precomputed user history graphs of each split
+    'behaviors': 2,             # columnar behaviors (and dev/test candidate labels) of each split
+    'news_text': 1              # tokenized news titles & abstracts
+}
+
+# GloVe vectors of the word embedding : 840B for 300 dimensions, else 6B
+def glove_version(config):
+    return ('840B', 300) if config.word_embedding_dim == 300 else ('6B', config.word_embedding_dim)
+
+# Source file of the GloVe vectors : the extracted text file if it is in the cache, else the (downloaded) zip file
+def glove_source_file(name, dim, cache='../glove'):
+    glove_file = os.path.join(cache, 'glove.%s.%dd.txt' % (name, dim))
+    return glove_file if os.path.exists(glove_file) else os.path.join(cache, os.path.basename(GloVe.url[name]))
+
+def preprocess_stages(config, store: ArtifactStore):
+    stages = {}
+    def add_stage(name, stage, inputs, params):
+        key = hashlib.md5(json.dumps([stage, PREPROCESS_STAGE_VERSIONS[stage], inputs, params], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        stages[name] = {'name': name, 'group': stage + '-' + config.dataset + '-' + key, 'inputs': inputs, 'params': params}
+        return stages[name]['group']
+    roots = {'train': config.train_root, 'dev': config.dev_root, 'test': config.test_root}
+    def dataset_file(mode, file):
+        return [mode + '/' + file, store.content_digest(os.path.join(roots[mode], file))]
+    def glove_file(name, dim):
+        glove_source, member = glove_source_file(name, dim), 'glove.%s.%dd.txt' % (name, dim)
+        return [member, store.content_digest(glove_source, member if glove_source.endswith('.zip') else None)]
+    news_files = [dataset_file(mode, 'news.tsv') for mode in roots]
+    ids = add_stage('ids', 'ids', news_files + [dataset_file('train', 'behaviors.tsv')], {'dataset': config.dataset})
+    vocabulary = add_stage('vocabulary', 'vocabulary', news_files, {'dataset': config.dataset, 'tokenizer': config.tokenizer, 'word_threshold': config.word_threshold})
+    add_stage('word_embedding', 'word_embedding', [vocabulary, glove_file(*glove_version(config))], {'word_embedding_dim': config.word_embedding_dim})
+    if config.dataset in ['mind']:
+        embedding_files = [dataset_file(mode, file) for mode in roots for file in ['entity_embedding.vec', 'context_embedding.vec']]
+        add_stage('entity_embedding', 'entity_embedding', [ids] + embedding_files, {'entity_embedding_dim': config.entity_embedding_dim, 'context_embedding_dim': config.context_embedding_dim})
+    for mode in roots:
+        user_history_category = add_stage('user_history_category_' + mode, 'user_history_category', [ids] + news_files + [dataset_file(mode, 'behaviors.tsv')], {'max_history_num': config.max_history_num})
+        add_stage('user_history_graph_' + mode, 'user_history_graph', [user_history_category], {'self_connection': not config.no_self_connection,
+                                                                                                 'normalization_type': None if config.no_adjacent_normalization else config.gcn_normalization_type})
+        add_stage('behaviors_' + mode, 'behaviors', [ids, dataset_file(mode, 'behaviors.tsv')], {'max_history_num': config.max_history_num, 'labeled_candidates': mode != 'test' or config.dataset != 'large'})
+    add_stage('news_text', 'news_text', [ids, vocabulary], {'max_title_length': config.max_title_length, 'max_abstract_length': config.max_abstract_length})
+    return stages
+
+
+# One-time conversion of the pickle/gzip/json outputs of the former preprocessing into the artifact store
+# The former outputs are assumed to be built from the current dataset files
+def convert_legacy_artifacts(config, store: ArtifactStore):
+    stages = preprocess_stages(config, store)
+    legacy_suffix = '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.dataset
+    legacy_json_files = {'ids': [('user_ID', 'user_ID-%s.json' % config.dataset), ('news_ID', 'news_ID-%s.json' % config.dataset), ('category', 'category-%s.json' % config.dataset), ('subCategory', 'subCategory-%s.json' % config.dataset)],
+                         'vocabulary': [('vocabulary', 'vocabulary-' + str(config.word_threshold) + legacy_suffix + '.json')]}
+    legacy_tensor_files = {'word_embedding': [('word_embedding', 'word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + legacy_suffix + '.pkl')]}
+    if config.dataset in ['mind']:
+        legacy_json_files['ids'].append(('entity', 'entity-%s.json' % config.dataset))
+        legacy_tensor_files['entity_embedding'] = [('entity_embedding', 'entity_embedding-%s.pkl' % config.dataset), ('context_embedding', 'context_embedding-%s.pkl' % config.dataset)]
+    for name in legacy_json_files:
+        if all(os.path.exists(file) for _, file in legacy_json_files[name]) and not store.exists(stages[name]['group']):
+            for key, file in legacy_json_files[name]:
+                with open(file, 'r', encoding='utf-8') as legacy_f:
+                    store.save_json(stages[name]['group'], key, json.load(legacy_f))
+            store.record_stage(stages[name], None)
+            print('Converted : ' + ', '.join(file for _, file in legacy_json_files[name]))
+    for name in legacy_tensor_files:
+        if all(os.path.exists(file) for _, file in legacy_tensor_files[name]) and not store.exists(stages[name]['group']):
+            for key, file in legacy_tensor_files[name]:
+                with open(file, 'rb') as legacy_f:
+                    store.save(stages[name]['group'], key, pickle.load(legacy_f))
+            store.record_stage(stages[name], None)
+            print('Converted : ' + ', '.join(file for _, file in legacy_tensor_files[name]))
+    for mode in ['train', 'dev', 'test']:
+        legacy_file = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '_' + mode + '.pkl.gz'
+        category_stage, graph_stage = stages['user_history_category_' + mode], stages['user_history_graph_' + mode]
+        if os.path.exists(legacy_file) and not (store.exists(category_stage['group']) and store.exists(graph_stage['group'])):
+            with gzip.open(legacy_file, 'rb') as legacy_f:
+                user_history_graph_data = pickle.load(legacy_f)
+            store.save(category_stage['group'], 'user_history_category_mask', user_history_graph_data[mode + '_user_history_category_mask'])
+            store.save(category_stage['group'], 'user_history_category_indices', user_history_graph_data[mode + '_user_history_category_indices'])
+            store.record_stage(category_stage, None)
+            store.save(graph_stage['group'], 'user_history_graph', user_history_graph_data[mode + '_user_history_graph'])
+            store.record_stage(graph_stage, None)
+            print('Converted : ' + legacy_file)
+
+
+if __name__ == '__main__':
+    from config import Config
+    config = Config()
+    convert_legacy_artifacts(config, ArtifactStore())
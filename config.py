@@ -40,6 +40,7 @@ class Config:
         parser.add_argument('--word_threshold', type=int, default=3, help='Word threshold')
         parser.add_argument('--max_title_length', type=int, default=32, help='Sentence truncate length for title')
         parser.add_argument('--max_abstract_length', type=int, default=128, help='Sentence truncate length for abstract') #128
+        parser.add_argument('--preprocess_workers', type=int, default=1, help='Number of processes for tokenization and vocabulary counting in preprocessing')
         # Training config
         parser.add_argument('--negative_sample_num', type=int, default=4, help='Negative sample number of each positive sample')
         parser.add_argument('--max_history_num', type=int, default=40, help='Maximum number of history news for each user')
@@ -48,13 +49,24 @@ class Config:
         parser.add_argument('--lr', type=float, default=1e-4, help='Learning rate')
         parser.add_argument('--weight_decay', type=float, default=0, help='Optimizer weight decay')
         parser.add_argument('--gradient_clip_norm', type=float, default=4, help='Gradient clip norm (non-positive value for no clipping)')
+        parser.add_argument('--unique_news_batching', default=False, action='store_true', help='Whether encode each news of a training batch once (gathered into the history and candidate slots)')
+        parser.add_argument('--in_batch_negatives', default=False, action='store_true', help='Whether use the click news of the other samples of a training batch as extra negatives (requires the dot-product click predictor)')
+        parser.add_argument('--shared_negative_num', type=int, default=0, help='Number of sampled negative news shared by all samples of a training batch (with --in_batch_negatives)')
+        parser.add_argument('--length_bucketing', default=False, action='store_true', help='Whether batch the training samples of similar history numbers together (in descending history number within each batch)')
+        parser.add_argument('--dynamic_padding', default=False, action='store_true', help='Whether trim the histories and news texts of each batch to the longest ones of the batch instead of max_history_num, max_title_length and max_abstract_length')
+        parser.add_argument('--history_cache', default=False, action='store_true', help='Whether read the training history news representations from a cache of all news representations (without gradient), while the candidate news are encoded live')
+        parser.add_argument('--history_cache_refresh_steps', type=int, default=1000, help='Training steps between two full re-encodings of the history news cache (non-positive value for encoding it only once)')
+        parser.add_argument('--history_cache_max_age', type=int, default=50, help='Maximum age in training steps of the cached representations of the history news of a batch, older ones are re-encoded before use (non-positive value for no age bound)')
+        parser.add_argument('--body_freeze_epoch', type=int, default=0, help='Epoch after which the body branch of the news encoder (CIDER, CNE and NAML) is frozen, and its outputs are precomputed into a memory-mapped feature file for the later epochs (non-positive value for no freezing)')
         parser.add_argument('--world_size', type=int, default=1, help='World size of multi-process GPU training')
         # Dev config
         parser.add_argument('--dev_criterion', type=str, default='auc', choices=['auc', 'mrr', 'ndcg5', 'ndcg10', 'avg'], help='Validation criterion to select model')
+        parser.add_argument('--no_prediction_file', default=False, action='store_true', help='Whether skip writing the dev/test rank files (metrics are computed in memory; the large test rank file is always written)')
         parser.add_argument('--early_stopping_epoch', type=int, default=5, help='Epoch number of stop training after dev result does not improve')
         # Model config
         parser.add_argument('--num_layers', type=int, default=1, choices=[1, 2], help="The number of sub-encoder-layers in transformer encoder")
         parser.add_argument('--feedforward_dim', type=int, default=512, choices=[128, 256, 512, 1024], help="The dimension of the feedforward network model")
+        parser.add_argument('--padding_aware_transformer', default=False, action='store_true', help='Whether the CIDER news encoder masks the padding words in its transformers (with the nested-tensor fast path in evaluation) and mean-pools only the real words')
         parser.add_argument('--head_num', type=int, default=10, choices=[3, 5, 10, 15, 20], help='Head number of multi-head self-attention')
         parser.add_argument('--head_dim', type=int, default=15, help='Head dimension of multi-head self-attention') 
         parser.add_argument('--intent_embedding_dim', type=int, default=400, choices=[100, 200, 300, 400], help='Intent embedding dimension')
@@ -75,6 +87,7 @@ class Config:
         parser.add_argument('--subCategory_embedding_dim', type=int, default=50, help='SubCategory embedding dimension')
         parser.add_argument('--no_self_connection', default=False, action='store_true', help='Whether the graph contains self-connection')
         parser.add_argument('--no_adjacent_normalization', default=False, action='store_true', help='Whether normalize the adjacent matrix')
+        parser.add_argument('--graph_materialization', type=str, default='precomputed', choices=['precomputed', 'batch'], help='Store dense user history graphs in the corpus (\"precomputed\") or build them per batch from the history category indices (\"batch\")')
         parser.add_argument('--gcn_normalization_type', type=str, default='symmetric', choices=['symmetric', 'asymmetric'], help='GCN normalization for adjacent matrix A (\"symmetric\" for D^{-\\frac{1}{2}}AD^{-\\frac{1}{2}}; \"asymmetric\" for D^{-\\frac{1}{2}}A)')
         parser.add_argument('--gcn_layer_num', type=int, default=4, help='Number of GCN layer')
         parser.add_argument('--no_gcn_residual', default=False, action='store_true', help='Whether apply residual connection to GCN')
@@ -158,7 +171,9 @@ class Config:
         for attribute in self.attribute_dict:
             print(attribute + ' : ' + str(getattr(self, attribute)))
         print('*' * 32 + ' Experiment setting ' + '*' * 32)
+        assert self.preprocess_workers >= 1, 'Number of preprocessing processes must be positive'
         assert self.batch_size % self.world_size == 0, 'For multi-gpu training, batch size must be divisible by world size'
+        assert not (self.history_cache and (self.unique_news_batching or self.in_batch_negatives)), 'The history news cache can not be used with unique news batching or in-batch negatives'
         os.environ['MASTER_ADDR'] = 'localhost'
         os.environ['MASTER_PORT'] = '1024'
 
@@ -1,335 +1,633 @@
 import os
+import io
 import json
-import pickle
-import gzip
 import collections
 import re
+import zipfile
+import contextlib
+import warnings
+import multiprocessing
 from nltk.tokenize import word_tokenize
 # import torchtext
 # print(torchtext.__version__)
 from torchtext.vocab import GloVe
+from torchtext.utils import download_from_url
 from config import Config
+from artifact_store import ArtifactStore, preprocess_stages, glove_version, glove_source_file
 import torch
 import numpy as np
 
-def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
 pat = re.compile(r"[\w]+|[.,!?;|]")
+# strings accepted by float() : decimal/exponent numbers with digit-separating underscores, nan, inf and infinity (with surrounding whitespaces)
+number_pat = re.compile(r"\s*[+-]?(?:(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)(?:[eE][+-]?\d(?:_?\d)*)?|[nN][aA][nN]|[iI][nN][fF](?:[iI][nN][iI][tT][yY])?)\s*")
+space_pat = re.compile(r"[ \t]*")
+
+def is_number(s):
+    return number_pat.fullmatch(s) is not None
+
+
+# Batch tokenizer of news texts
+# Each word is aligned to a character position of the text for the entity alignment : a word starts after the end of the former word and the following spaces/tabs.
+# For the MIND tokenizer, this is the character span of re.finditer when the words are only separated by spaces/tabs (otherwise the alignment is shifted by the dropped characters).
+class NewsTokenizer:
+    def __init__(self, tokenizer: str, word_dict: dict = None, entity_dict: dict = None):
+        self.tokenizer = tokenizer
+        self.word_dict = word_dict
+        self.entity_dict = entity_dict
+
+    # Output
+    # words : lower-cased words of text
+    # spans : character spans of words (None for the NLTK tokenizer)
+    def tokenize(self, text: str):
+        text = text.lower()
+        if self.tokenizer == 'MIND':
+            matches = list(pat.finditer(text))
+            return [match.group() for match in matches], np.array([match.span() for match in matches], dtype=np.int64).reshape([-1, 2])
+        return word_tokenize(text), None
+
+    # Input
+    # text         : original (not lower-cased) text
+    # words        : [word_num]
+    # spans        : [word_num, 2]
+    # Output
+    # word_starts  : [word_num] aligned character positions of words
+    def align(self, text: str, words: list, spans):
+        word_lengths = np.array([len(word) for word in words], dtype=np.int64)
+        if spans is not None and len(words) > 0 and len(text.lower()) == len(text):
+            end = int(spans[-1, 1])
+            if text.count(' ', 0, end) + text.count('\t', 0, end) == end - word_lengths.sum():
+                return spans[:, 0]
+        word_starts = np.zeros([len(words)], dtype=np.int64)
+        offset_index = 0
+        for i in range(len(words)):
+            word_starts[i] = space_pat.match(text, offset_index).end()
+            offset_index = word_starts[i] + word_lengths[i]
+        return word_starts
+
+    def word_index(self, word: str):
+        if is_number(word):
+            return self.word_dict['<NUM>']
+        return self.word_dict[word] if word in self.word_dict else 1
+
+    # Input
+    # texts       : [batch_size]
+    # entities    : [batch_size] json lists of MIND entities of texts (None for no entity alignment)
+    # Output
+    # text_ids    : [batch_size, max_length]
+    # text_mask   : [batch_size, max_length]
+    # text_entity : [batch_size, max_length]
+    # word_num    : total word number of texts (before truncation)
+    def encode(self, texts: list, max_length: int, entities: list = None):
+        text_ids = np.zeros([len(texts), max_length], dtype=np.int32)
+        text_mask = np.zeros([len(texts), max_length], dtype=bool)
+        text_entity = np.zeros([len(texts), max_length], dtype=np.int32)
+        word_num = 0
+        for i, text in enumerate(texts):
+            words, spans = self.tokenize(text)
+            word_num += len(words)
+            words = words[:max_length]
+            text_ids[i, :len(words)] = [self.word_index(word) for word in words]
+            text_mask[i, :len(words)] = True
+            if entities is not None and len(words) > 0:
+                occurrences = [[offset, self.entity_dict[entity['WikidataId']]] for entity in json.loads(entities[i]) if entity['WikidataId'] in self.entity_dict for offset in entity['OccurrenceOffsets']]
+                if len(occurrences) > 0:
+                    occurrences = np.array(occurrences, dtype=np.int64)[::-1]                                          # reversed, so that a later occurrence takes precedence
+                    word_starts = self.align(text, words, None if spans is None else spans[:max_length])
+                    word_ends = word_starts + np.array([len(word) for word in words], dtype=np.int64)
+                    positions = np.searchsorted(word_starts, occurrences[:, 0], side='right') - 1
+                    aligned = (positions >= 0) & (occurrences[:, 0] < word_ends[positions]) & (occurrences[:, 0] < len(text))
+                    positions, first_indices = np.unique(positions[aligned], return_index=True)
+                    text_entity[i, positions] = occurrences[aligned][first_indices, 1]
+        return text_ids, text_mask, text_entity, word_num
+
+# The GloVe file is downloaded before the preprocessing stages are keyed, as it is fingerprinted as an input of the word embedding stage
+def download_glove(name, dim, cache='../glove'):
+    glove_source = glove_source_file(name, dim, cache)
+    if not os.path.exists(glove_source):
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+        download_from_url(GloVe.url[name], path=glove_source)
+
+# Stream the raw GloVe text file (or the downloaded zip file) once and keep only the vectors of the words in word_dict, instead of loading all GloVe vectors
+# Lines are parsed as torchtext.vocab.Vectors does (a later duplicate of a word overrides the former one)
+# Output
+# glove_vectors     : [len(word_dict), dim] (zero for words not in GloVe)
+# glove_exist       : [len(word_dict)]
+# glove_mean_vector : [dim] (mean of all GloVe vectors, accumulated in float64)
+def load_glove_subset(name, dim, word_dict, cache='../glove'):
+    glove_file = 'glove.%s.%dd.txt' % (name, dim)
+    glove_source = glove_source_file(name, dim, cache)
+    glove_vectors = np.zeros([len(word_dict), dim], dtype=np.float32)
+    glove_exist = np.zeros([len(word_dict)], dtype=bool)
+    glove_vector_sum = np.zeros([dim], dtype=np.float64)
+    glove_vector_num = 0
+    with contextlib.ExitStack() as stack:
+        if glove_source.endswith('.zip'):
+            glove_zip = stack.enter_context(zipfile.ZipFile(glove_source, 'r'))
+            glove_f = stack.enter_context(glove_zip.open(glove_file, 'r'))
+        else:
+            glove_f = stack.enter_context(open(glove_source, 'rb'))
+        for line in glove_f:
+            entries = line.rstrip().split(b' ')
+            if len(entries) == 2: # header
+                continue
+            if len(entries) != dim + 1:
+                raise Exception('GloVe vector of %s has %d dimensions, but %d dimensions are expected' % (entries[0], len(entries) - 1, dim))
+            try:
+                word = entries[0].decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            vector = np.array(entries[1:], dtype=np.float64)
+            glove_vector_sum += vector
+            glove_vector_num += 1
+            if word in word_dict:
+                glove_vectors[word_dict[word]] = vector
+                glove_exist[word_dict[word]] = True
+    return glove_vectors, glove_exist, (glove_vector_sum / glove_vector_num).astype(np.float32)
+
+# Parse the entity (or context) embedding files of all splits in bulk : each file is read once into a string array, whose first column holds the IDs and the others the vector values
+# An entity appearing in several splits takes the vector of the last split, and the vectors are scattered into the entity_dict order with one indexed assignment
+# Output
+# embedding_vectors : [len(entity_dict), embedding_dim] (zero for entities without vector)
+def load_entity_vectors(embedding_files, entity_dict, embedding_dim, embedding_name='entity'):
+    WikidataIds = []
+    vectors = []
+    for embedding_file in embedding_files:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # empty file or blank lines
+            lines = np.loadtxt(embedding_file, dtype=str, delimiter='\t', comments=None, encoding='utf-8', ndmin=2) # a line of a different column number raises ValueError
+        if lines.size == 0:
+            continue
+        if lines.shape[1] > 1 and np.all(lines[:, -1] == ''): # trailing tab
+            lines = lines[:, :-1]
+        assert lines.shape[1] == embedding_dim + 1, '%s embedding dim does not match' % embedding_name
+        WikidataIds.append(lines[:, 0])
+        vectors.append(lines[:, 1:].astype(np.float64))
+    embedding_vectors = np.zeros([len(entity_dict), embedding_dim], dtype=np.float32)
+    if len(WikidataIds) > 0:
+        WikidataIds = np.concatenate(WikidataIds)
+        vectors = np.concatenate(vectors, axis=0)
+        unique_WikidataIds, reversed_line_indices = np.unique(WikidataIds[::-1], return_index=True) # de-duplicate WikidataIds across splits, keeping the last line
+        line_indices = len(WikidataIds) - 1 - reversed_line_indices
+        in_dict = np.array([WikidataId in entity_dict for WikidataId in unique_WikidataIds], dtype=bool)
+        entity_indices = np.array([entity_dict[WikidataId] for WikidataId in unique_WikidataIds[in_dict]], dtype=np.int64)
+        embedding_vectors[entity_indices] = vectors[line_indices[in_dict]]
+    return torch.from_numpy(embedding_vectors)
+
+# Byte ranges [start, end) of the shards of a file, aligned to line starts
+def shard_byte_ranges(file, shard_num):
+    file_size = os.path.getsize(file)
+    boundaries = [0]
+    with open(file, 'rb') as f:
+        for shard_index in range(1, shard_num):
+            target = file_size * shard_index // shard_num
+            if target <= boundaries[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline() # move to the start of the next line
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+# Lines of a shard, split with the same universal newlines as reading the whole file in text mode
+def read_shard_lines(file, start, end):
+    with open(file, 'rb') as f:
+        f.seek(start)
+        return io.StringIO(f.read(end - start).decode('utf-8'), newline=None)
+
+# News ID of each line of a shard (None for the lines skipped in Adressa)
+def read_shard_news_IDs(shard):
+    file, start, end, dataset = shard
+    news_IDs = []
+    for line in read_shard_lines(file, start, end):
+        if dataset not in ['mind'] and len(line.split('\t')) != 8:
+            news_IDs.append(None)
+        else:
+            news_IDs.append(line.split('\t', 1)[0])
+    return news_IDs
+
+# Word counter of the title and abstract (body for Adressa) of the lines of a shard selected by news_mask
+def count_shard_words(shard):
+    file, start, end, news_mask, tokenizer = shard
+    news_tokenizer = NewsTokenizer(tokenizer)
+    word_counter = collections.Counter()
+    for line, counted in zip(read_shard_lines(file, start, end), news_mask):
+        if counted:
+            news_ID, category, subCategory, title, abstract, _, _, _ = line.split('\t')
+            for text in [title, abstract]:
+                words, _ = news_tokenizer.tokenize(text)
+                for word in words:
+                    if is_number(word):
+                        word_counter['<NUM>'] += 1
+                    else:
+                        word_counter[word] += 1
+    return word_counter
+
+# Input
+# user_history_category_indices : [batch_size, max_history_num] (padded with category_num)
+# user_history_num              : [batch_size]
+# Output
+# user_history_graph            : [batch_size, max_history_num + category_num, max_history_num + category_num]
+def build_user_history_graph(user_history_category_indices, user_history_num, category_num, self_connection=True, normalization_type='symmetric'):
+    batch_size, max_history_num = user_history_category_indices.shape
+    graph_size = max_history_num + category_num
+    history_mask = np.arange(max_history_num)[np.newaxis, :] < user_history_num[:, np.newaxis]                                                          # [batch_size, max_history_num]
+    category_one_hot = (user_history_category_indices[:, :, np.newaxis] == np.arange(category_num)[np.newaxis, np.newaxis, :]) & history_mask[:, :, np.newaxis] # [batch_size, max_history_num, category_num]
+    category_exist = category_one_hot.any(axis=1)                                                                                                      # [batch_size, category_num]
+    user_history_graph = np.zeros([batch_size, graph_size, graph_size], dtype=np.float32)
+    # edge of E_{n} in intra-cluster graph G1
+    intra_cluster_edge = (user_history_category_indices[:, :, np.newaxis] == user_history_category_indices[:, np.newaxis, :]) & history_mask[:, :, np.newaxis] & history_mask[:, np.newaxis, :]
+    intra_cluster_edge[:, np.arange(max_history_num), np.arange(max_history_num)] = False
+    user_history_graph[:, :max_history_num, :max_history_num] = intra_cluster_edge
+    # edge of E_{p}^{1} in inter-cluster graph G2
+    user_history_graph[:, :max_history_num, max_history_num:] = category_one_hot
+    user_history_graph[:, max_history_num:, :max_history_num] = category_one_hot.transpose(0, 2, 1)
+    # edge of E_{p}^{2} in inter-cluster graph G2
+    inter_cluster_edge = category_exist[:, :, np.newaxis] & category_exist[:, np.newaxis, :]
+    inter_cluster_edge[:, np.arange(category_num), np.arange(category_num)] = False
+    user_history_graph[:, max_history_num:, max_history_num:] = inter_cluster_edge
+    if self_connection:
+        user_history_graph[:, np.arange(graph_size), np.arange(graph_size)] = 1
+    if normalization_type is not None:
+        # only non-empty histories are normalized (an empty history graph is the identity or the zero matrix)
+        non_empty = user_history_num > 0
+        degree = user_history_graph[non_empty].sum(axis=2, keepdims=False)                                                                           # [non_empty_num, graph_size]
+        if normalization_type == 'asymmetric':
+            # Asymmetric adjacent matrix normalization: D^{-\frac{1}{2}}A
+            D_inv = 1 / degree
+            user_history_graph[non_empty] = D_inv[:, :, np.newaxis] * user_history_graph[non_empty]
+        else:
+            # Symmetric adjacent matrix normalization: D^{-\frac{1}{2}}AD^{-\frac{1}{2}}
+            D_inv_sqrt = np.sqrt(1 / degree)
+            user_history_graph[non_empty] = D_inv_sqrt[:, :, np.newaxis] * user_history_graph[non_empty] * D_inv_sqrt[:, np.newaxis, :]
+    return user_history_graph
+
+# Columnar behaviors of a split, backed by memory-mapped int arrays instead of Python lists
+# Indexed by sample : user_ID, positive_news (click impression, train) or candidate_news (dev & test), behavior_index
+# Indexed by behavior in CSR format : history news (history_offsets, history_news) and non-clicked news of train (negative_offsets, negative_news)
+class Behaviors:
+    def __init__(self, arrays: dict, max_history_num: int):
+        for key in arrays:
+            setattr(self, key, arrays[key])
+        self.max_history_num = max_history_num
+        self.history_length = np.diff(self.history_offsets).astype(np.int32) # [behavior_num]
+        self.num = len(self.user_ID)
+        if hasattr(self, 'candidate_news'):
+            # candidates of an impression are contiguous rows, so the rows of impression i are [candidate_offsets[i], candidate_offsets[i + 1])
+            self.candidate_offsets = np.searchsorted(self.behavior_index, np.arange(len(self.history_length) + 1)).astype(np.int64) # [behavior_num + 1]
+            self.candidate_num = np.diff(self.candidate_offsets).astype(np.int32)                                                      # [behavior_num]
+
+    @staticmethod
+    def keys(mode, labeled_candidates=True):
+        if mode == 'train':
+            return ['user_ID', 'positive_news', 'behavior_index', 'history_offsets', 'history_news', 'negative_offsets', 'negative_news']
+        return ['user_ID', 'candidate_news', 'behavior_index', 'history_offsets', 'history_news'] + (['candidate_label'] if labeled_candidates else [])
+
+    # Output
+    # user_history      : [max_history_num] (padded with 0)
+    # user_history_mask : [max_history_num]
+    def history(self, behavior_index):
+        history_length = self.history_length[behavior_index]
+        history_offset = self.history_offsets[behavior_index]
+        user_history = np.zeros([self.max_history_num], dtype=np.int32)
+        user_history[:history_length] = self.history_news[history_offset:history_offset + history_length]
+        return user_history, np.arange(self.max_history_num) < history_length
+
+    # Input
+    # behavior_index    : [batch_size]
+    # trim              : whether pad the histories to the longest history of the batch (at least 1) instead of max_history_num
+    # Output
+    # user_history      : [batch_size, max_history_num] (padded with 0)
+    # user_history_mask : [batch_size, max_history_num]
+    def histories(self, behavior_index, trim=False):
+        history_num = max(int(self.history_length[behavior_index].max()), 1) if trim else self.max_history_num
+        user_history_mask = np.arange(history_num)[np.newaxis, :] < self.history_length[behavior_index][:, np.newaxis]
+        history_index = np.where(user_history_mask, self.history_offsets[behavior_index][:, np.newaxis] + np.arange(history_num)[np.newaxis, :], 0)
+        user_history = np.where(user_history_mask, self.history_news[history_index], 0).astype(np.int32)
+        return user_history, user_history_mask
+
+    def non_click_news(self, behavior_index):
+        return self.negative_news[self.negative_offsets[behavior_index]:self.negative_offsets[behavior_index + 1]]
+
+    def __len__(self):
+        return self.num
+
 
 class Corpus:
     @staticmethod
     def preprocess(config: Config):
-        user_ID_file = 'user_ID-%s.json' % config.dataset
-        news_ID_file = 'news_ID-%s.json' % config.dataset
-        category_file = 'category-%s.json' % config.dataset
-        subCategory_file = 'subCategory-%s.json' % config.dataset
-        vocabulary_file = 'vocabulary-' + str(config.word_threshold) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.dataset + '.json'
-        word_embedding_file = 'word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.dataset + '.pkl'
-        user_history_graph_file_raw = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '.pkl'+'.gz'
-        user_history_graph_file_train = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '_train.pkl'+'.gz'
-        
+        store = ArtifactStore()
+        download_glove(*glove_version(config))
+        stages = preprocess_stages(config, store)
+        ids_keys = ['user_ID', 'news_ID', 'category', 'subCategory'] + (['entity'] if config.dataset in ['mind'] else [])
+
+        store.build_stage(stages['ids'], ids_keys, lambda group: Corpus.preprocess_ids(config, store, group))
+        store.build_stage(stages['vocabulary'], ['vocabulary'], lambda group: Corpus.preprocess_vocabulary(config, store, group))
+        store.build_stage(stages['word_embedding'], ['word_embedding'], lambda group: Corpus.preprocess_word_embedding(config, store, group, stages['vocabulary']['group']))
         if config.dataset in ['mind']:
-            # for MIND
-            entity_file = 'entity-%s.json' % config.dataset
-            entity_embedding_file = 'entity_embedding-%s.pkl' % config.dataset
-            context_embedding_file = 'context_embedding-%s.pkl' % config.dataset
-            preprocessed_data_files = [user_ID_file, news_ID_file, category_file, subCategory_file, vocabulary_file, word_embedding_file, entity_file, entity_embedding_file, context_embedding_file, user_history_graph_file_train]
-        else:
-            # for Adressa (not include entity_file, entity_embedding_file, context_embedding_file)
-            preprocessed_data_files = [user_ID_file, news_ID_file, category_file, subCategory_file, vocabulary_file, word_embedding_file, user_history_graph_file_train]
-
-        if not all(list(map(os.path.exists, preprocessed_data_files))):
-            user_ID_dict = {'<UNK>': 0}
-            news_ID_dict = {'<PAD>': 0}
-            category_dict = {}
-            subCategory_dict = {}
-            word_dict = {'<PAD>': 0, '<UNK>': 1}
-            word_counter = collections.Counter()
-            entity_dict = {'<PAD>': 0, '<UNK>': 1}
-            news_category_dict = {}
-
-            # 1. user ID dictionay
-            with open(os.path.join(config.train_root, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
-                for line in train_behaviors_f:
-                    impression_ID, user_ID, time, history, impressions = line.split('\t')
-                    if user_ID not in user_ID_dict:
-                        user_ID_dict[user_ID] = len(user_ID_dict)
-                with open(user_ID_file, 'w', encoding='utf-8') as user_ID_f:
-                    json.dump(user_ID_dict, user_ID_f)
-
-            # 2. news ID dictionay & news category dictionay & news subCategory dictionay
-            if config.dataset in ['mind']:
-                for i, prefix in enumerate([config.train_root, config.dev_root, config.test_root]):
-                    with open(os.path.join(prefix, 'news.tsv'), 'r', encoding='utf-8') as news_f:
-                        for line in news_f:
-                            news_ID, category, subCategory, title, abstract, _, title_entities, abstract_entities = line.split('\t')
-                            if news_ID not in news_ID_dict:
-                                news_ID_dict[news_ID] = len(news_ID_dict)
-                                if category not in category_dict:
-                                    category_dict[category] = len(category_dict)
-                                if subCategory not in subCategory_dict:
-                                    subCategory_dict[subCategory] = len(subCategory_dict)
-                                words = pat.findall(title.lower()) if config.tokenizer == 'MIND' else word_tokenize(title.lower())
-                                for word in words:
-                                    if is_number(word):
-                                        word_counter['<NUM>'] += 1
-                                    else:
-                                        if i == 0: # training set
-                                            word_counter[word] += 1
-                                        else:
-                                            if word in word_counter: # already appeared in training set
-                                                word_counter[word] += 1
-                                words = pat.findall(abstract.lower()) if config.tokenizer == 'MIND' else word_tokenize(abstract.lower())
-                                for word in words:
-                                    if is_number(word):
-                                        word_counter['<NUM>'] += 1
-                                    else:
-                                        if i == 0: # training set
-                                            word_counter[word] += 1
-                                        else:
-                                            if word in word_counter: # already appeared in training set
-                                                word_counter[word] += 1
-                                for entity in json.loads(title_entities):
-                                    WikidataId = entity['WikidataId']
-                                    if WikidataId not in entity_dict:
-                                        entity_dict[WikidataId] = len(entity_dict)
-                                for entity in json.loads(abstract_entities):
-                                    WikidataId = entity['WikidataId']
-                                    if WikidataId not in entity_dict:
-                                        entity_dict[WikidataId] = len(entity_dict)
-                            news_category_dict[news_ID] = category_dict[category]
-                with open(news_ID_file, 'w', encoding='utf-8') as news_ID_f:
-                    json.dump(news_ID_dict, news_ID_f)
-                with open(category_file, 'w', encoding='utf-8') as category_f:
-                    json.dump(category_dict, category_f)
-                with open(subCategory_file, 'w', encoding='utf-8') as subCategory_f:
-                    json.dump(subCategory_dict, subCategory_f)
-            # for Adressa
-            else:
-                for i, prefix in enumerate([config.train_root, config.dev_root, config.test_root]):
-                    with open(os.path.join(prefix, 'news.tsv'), 'r', encoding='utf-8') as news_f:
-                        for line in news_f:
-                            # print(len(line.split('\t')))
-                            if len(line.split('\t')) != 8:
-                                continue
-                            news_ID, category, subCategory, title, body, _, _, _ = line.split('\t')
-                            if news_ID not in news_ID_dict:
-                                news_ID_dict[news_ID] = len(news_ID_dict)
-                                if category not in category_dict:
-                                    category_dict[category] = len(category_dict)
-                                if subCategory not in subCategory_dict:
-                                    subCategory_dict[subCategory] = len(subCategory_dict)
-                                words = pat.findall(title.lower()) if config.tokenizer == 'MIND' else word_tokenize(title.lower())
-                                for word in words:
-                                    if is_number(word):
-                                        word_counter['<NUM>'] += 1
-                                    else:
-                                        if i == 0: # training set
-                                            word_counter[word] += 1
-                                        else:
-                                            if word in word_counter: # already appeared in training set
-                                                word_counter[word] += 1
-                                words = pat.findall(body.lower()) if config.tokenizer == 'MIND' else word_tokenize(body.lower())
-                                for word in words:
-                                    if is_number(word):
-                                        word_counter['<NUM>'] += 1
-                                    else:
-                                        if i == 0: # training set
-                                            word_counter[word] += 1
-                                        else:
-                                            if word in word_counter: # already appeared in training set
-                                                word_counter[word] += 1
-                                # for entity in json.loads(title_entities):
-                                #     WikidataId = entity['WikidataId']
-                                #     if WikidataId not in entity_dict:
-                                #         entity_dict[WikidataId] = len(entity_dict)
-                                # for entity in json.loads(abstract_entities):
-                                #     WikidataId = entity['WikidataId']
-                                #     if WikidataId not in entity_dict:
-                                #         entity_dict[WikidataId] = len(entity_dict)
-                            news_category_dict[news_ID] = category_dict[category]
-                with open(news_ID_file, 'w', encoding='utf-8') as news_ID_f:
-                    json.dump(news_ID_dict, news_ID_f)
-                with open(category_file, 'w', encoding='utf-8') as category_f:
-                    json.dump(category_dict, category_f)
-                with open(subCategory_file, 'w', encoding='utf-8') as subCategory_f:
-                    json.dump(subCategory_dict, subCategory_f)
-
-            # 3. word dictionay
-            word_counter_list = [[word, word_counter[word]] for word in word_counter]
-            word_counter_list.sort(key=lambda x: x[1], reverse=True) # sort by word frequency
-            filtered_word_counter_list = list(filter(lambda x: x[1] >= config.word_threshold, word_counter_list))
-            for i, word in enumerate(filtered_word_counter_list):
-                word_dict[word[0]] = i + 2
-            with open(vocabulary_file, 'w', encoding='utf-8') as vocabulary_f:
-                json.dump(word_dict, vocabulary_f)
-
-            # 4. Glove word embedding
-            if config.word_embedding_dim == 300:
-                glove = GloVe(name='840B', dim=300, cache='../glove', max_vectors=10000000000)
-            else:
-                glove = GloVe(name='6B', dim=config.word_embedding_dim, cache='../glove', max_vectors=10000000000)
-            glove_stoi = glove.stoi
-            glove_vectors = glove.vectors
-            glove_mean_vector = torch.mean(glove_vectors, dim=0, keepdim=False)
-            word_embedding_vectors = torch.zeros([len(word_dict), config.word_embedding_dim])
-            for word in word_dict:
-                index = word_dict[word]
-                if index != 0:
-                    if word in glove_stoi:
-                        word_embedding_vectors[index, :] = glove_vectors[glove_stoi[word]]
+            store.build_stage(stages['entity_embedding'], ['entity_embedding', 'context_embedding'], lambda group: Corpus.preprocess_entity_embedding(config, store, group, stages['ids']['group']))
+        for mode in ['train', 'dev', 'test']:
+            user_history_category_group = stages['user_history_category_' + mode]['group']
+            store.build_stage(stages['user_history_category_' + mode], ['user_history_category_mask', 'user_history_category_indices'], lambda group: Corpus.preprocess_user_history_category(config, store, group, stages['ids']['group'], mode))
+            if config.graph_materialization == 'precomputed':
+                store.build_stage(stages['user_history_graph_' + mode], ['user_history_graph'], lambda group: Corpus.preprocess_user_history_graph(config, store, group, user_history_category_group))
+            store.build_stage(stages['behaviors_' + mode], Behaviors.keys(mode, stages['behaviors_' + mode]['params']['labeled_candidates']), lambda group: Corpus.preprocess_behaviors(config, store, group, stages['ids']['group'], mode))
+        return stages
+
+    # 1. user ID dictionay & news ID dictionay & news category dictionay & news subCategory dictionay & knowledge-graph entity dictionary
+    @staticmethod
+    def preprocess_ids(config: Config, store: ArtifactStore, group: str):
+        user_ID_dict = {'<UNK>': 0}
+        news_ID_dict = {'<PAD>': 0}
+        category_dict = {}
+        subCategory_dict = {}
+        entity_dict = {'<PAD>': 0, '<UNK>': 1}
+        with open(os.path.join(config.train_root, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
+            for line in train_behaviors_f:
+                impression_ID, user_ID, time, history, impressions = line.split('\t')
+                if user_ID not in user_ID_dict:
+                    user_ID_dict[user_ID] = len(user_ID_dict)
+        for prefix in [config.train_root, config.dev_root, config.test_root]:
+            with open(os.path.join(prefix, 'news.tsv'), 'r', encoding='utf-8') as news_f:
+                for line in news_f:
+                    if config.dataset in ['mind']:
+                        news_ID, category, subCategory, title, abstract, _, title_entities, abstract_entities = line.split('\t')
                     else:
-                        random_vector = torch.zeros(config.word_embedding_dim)
-                        random_vector.normal_(mean=0, std=0.1)
-                        word_embedding_vectors[index, :] = random_vector + glove_mean_vector
-            with open(word_embedding_file, 'wb') as word_embedding_f:
-                pickle.dump(word_embedding_vectors, word_embedding_f)
-
-            # 5. knowledge-graph entity dictionary & eneity embedding & context embedding
-            if config.dataset in ['mind']:
-                entity_embedding_vectors = torch.zeros([len(entity_dict), config.entity_embedding_dim])
-                context_embedding_vectors = torch.zeros([len(entity_dict), config.context_embedding_dim])
-                for prefix in [config.train_root, config.dev_root, config.test_root]:
-                    with open(os.path.join(prefix, 'entity_embedding.vec'), 'r', encoding='utf-8') as entity_f:
-                        for line in entity_f:
-                            if len(line.strip()) > 0:
-                                terms = line.strip().split('\t')
-                                assert len(terms) == config.entity_embedding_dim + 1, 'entity embedding dim does not match'
-                                WikidataId = terms[0]
-                                if WikidataId in entity_dict:
-                                    entity_embedding_vectors[entity_dict[WikidataId]] = torch.FloatTensor(list(map(float, terms[1:])))
-                for prefix in [config.train_root, config.dev_root, config.test_root]:
-                    with open(os.path.join(prefix, 'context_embedding.vec'), 'r', encoding='utf-8') as context_f:
-                        for line in context_f:
-                            if len(line.strip()) > 0:
-                                terms = line.strip().split('\t')
-                                assert len(terms) == config.context_embedding_dim + 1, 'context embedding dim does not match'
-                                WikidataId = terms[0]
-                                if WikidataId in entity_dict:
-                                    context_embedding_vectors[entity_dict[WikidataId]] = torch.FloatTensor(list(map(float, terms[1:])))
-                with open(entity_file, 'w', encoding='utf-8') as entity_f:
-                    json.dump(entity_dict, entity_f)
-                with open(entity_embedding_file, 'wb') as entity_embedding_f:
-                    pickle.dump(entity_embedding_vectors, entity_embedding_f)
-                with open(context_embedding_file, 'wb') as context_embedding_f:
-                    pickle.dump(context_embedding_vectors, context_embedding_f)
-            
-            # 6. user history graph
-            category_num = len(category_dict)
-            graph_size = config.max_history_num + category_num # graph size of |V_{n}|+|V_{p}|
-            prefix_mode = ['train', 'dev', 'test']
-            
-            # user_history_graph_data_mode = {}
-            for prefix_index, prefix in enumerate([config.train_root, config.dev_root, config.test_root]):
-                mode = prefix_mode[prefix_index]
-                user_history_num = 0
-                with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
-                    for line in behaviors_f:
-                        user_history_num += 1
-                user_history_graph = np.zeros([user_history_num, graph_size, graph_size], dtype=np.float32)
-                user_history_category_mask = np.zeros([user_history_num, category_num + 1], dtype=bool)
-                user_history_category_indices = np.zeros([user_history_num, config.max_history_num], dtype=np.int64)
-                with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
-                    user_history_graph_data = {}
-                    for line_index, line in enumerate(behaviors_f):
-                        impression_ID, user_ID, time, history, impressions = line.split('\t')
-                        if config.no_self_connection:
-                            history_graph = np.zeros([graph_size, graph_size], dtype=np.float32)
+                        # for Adressa (not include entity_file, entity_embedding_file, context_embedding_file)
+                        if len(line.split('\t')) != 8:
+                            continue
+                        news_ID, category, subCategory, title, body, _, _, _ = line.split('\t')
+                    if news_ID not in news_ID_dict:
+                        news_ID_dict[news_ID] = len(news_ID_dict)
+                        if category not in category_dict:
+                            category_dict[category] = len(category_dict)
+                        if subCategory not in subCategory_dict:
+                            subCategory_dict[subCategory] = len(subCategory_dict)
+                        if config.dataset in ['mind']:
+                            for entity in json.loads(title_entities):
+                                WikidataId = entity['WikidataId']
+                                if WikidataId not in entity_dict:
+                                    entity_dict[WikidataId] = len(entity_dict)
+                            for entity in json.loads(abstract_entities):
+                                WikidataId = entity['WikidataId']
+                                if WikidataId not in entity_dict:
+                                    entity_dict[WikidataId] = len(entity_dict)
+        store.save_json(group, 'user_ID', user_ID_dict)
+        store.save_json(group, 'news_ID', news_ID_dict)
+        store.save_json(group, 'category', category_dict)
+        store.save_json(group, 'subCategory', subCategory_dict)
+        if config.dataset in ['mind']:
+            store.save_json(group, 'entity', entity_dict)
+
+    # 2. word dictionay
+    # The news files are split into shards by byte ranges, which are tokenized and counted in parallel with preprocess_workers processes
+    @staticmethod
+    def preprocess_vocabulary(config: Config, store: ArtifactStore, group: str):
+        news_files = [os.path.join(prefix, 'news.tsv') for prefix in [config.train_root, config.dev_root, config.test_root]]
+        shard_num = 1 if config.preprocess_workers == 1 else config.preprocess_workers * 4 # more shards than processes for load balancing
+        shards = [(file_index, start, end) for file_index, news_file in enumerate(news_files) for start, end in shard_byte_ranges(news_file, shard_num)]
+        pool = multiprocessing.Pool(config.preprocess_workers) if config.preprocess_workers > 1 else None
+        map_function = pool.map if pool is not None else lambda function, iterable: list(map(function, iterable))
+        # only the first occurrence of each news is counted
+        news_ID_set = set()
+        news_masks = []
+        for news_IDs in map_function(read_shard_news_IDs, [(news_files[file_index], start, end, config.dataset) for file_index, start, end in shards]):
+            news_mask = np.zeros([len(news_IDs)], dtype=bool)
+            for i, news_ID in enumerate(news_IDs):
+                if news_ID is not None and news_ID not in news_ID_set:
+                    news_ID_set.add(news_ID)
+                    news_mask[i] = True
+            news_masks.append(news_mask)
+        shard_word_counters = map_function(count_shard_words, [(news_files[file_index], start, end, news_mask, config.tokenizer) for (file_index, start, end), news_mask in zip(shards, news_masks)])
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # merged in the shard order, so that the word order of equal frequency is the same as counting sequentially
+        word_dict = {'<PAD>': 0, '<UNK>': 1}
+        word_counter = collections.Counter()
+        for (file_index, _, _), shard_word_counter in zip(shards, shard_word_counters):
+            if file_index == 0: # training set
+                word_counter.update(shard_word_counter)
+            else:
+                for word in shard_word_counter:
+                    if word == '<NUM>' or word in word_counter: # already appeared in training set
+                        word_counter[word] += shard_word_counter[word]
+        word_counter_list = [[word, word_counter[word]] for word in word_counter]
+        word_counter_list.sort(key=lambda x: x[1], reverse=True) # sort by word frequency
+        filtered_word_counter_list = list(filter(lambda x: x[1] >= config.word_threshold, word_counter_list))
+        for i, word in enumerate(filtered_word_counter_list):
+            word_dict[word[0]] = i + 2
+        store.save_json(group, 'vocabulary', word_dict)
+
+    # 3. Glove word embedding
+    @staticmethod
+    def preprocess_word_embedding(config: Config, store: ArtifactStore, group: str, vocabulary_group: str):
+        word_dict = store.load_json(vocabulary_group, 'vocabulary')
+        glove_name, glove_dim = glove_version(config)
+        glove_vectors, glove_exist, glove_mean_vector = load_glove_subset(glove_name, glove_dim, word_dict, cache='../glove')
+        # the random vectors of the words not in GloVe are seeded by the stage key, so that a rebuild of the same inputs gives the same embedding
+        generator = torch.Generator().manual_seed(int(group.rsplit('-', 1)[1], 16))
+        word_embedding_vectors = torch.from_numpy(glove_vectors)
+        glove_mean_vector = torch.from_numpy(glove_mean_vector)
+        for word in word_dict:
+            index = word_dict[word]
+            if index != 0 and not glove_exist[index]:
+                random_vector = torch.zeros(config.word_embedding_dim)
+                random_vector.normal_(mean=0, std=0.1, generator=generator)
+                word_embedding_vectors[index, :] = random_vector + glove_mean_vector
+        word_embedding_vectors[0] = 0
+        store.save(group, 'word_embedding', word_embedding_vectors)
+
+    # 4. knowledge-graph eneity embedding & context embedding
+    @staticmethod
+    def preprocess_entity_embedding(config: Config, store: ArtifactStore, group: str, ids_group: str):
+        entity_dict = store.load_json(ids_group, 'entity')
+        entity_embedding_vectors = load_entity_vectors([os.path.join(prefix, 'entity_embedding.vec') for prefix in [config.train_root, config.dev_root, config.test_root]], entity_dict, config.entity_embedding_dim, 'entity')
+        context_embedding_vectors = load_entity_vectors([os.path.join(prefix, 'context_embedding.vec') for prefix in [config.train_root, config.dev_root, config.test_root]], entity_dict, config.context_embedding_dim, 'context')
+        store.save(group, 'entity_embedding', entity_embedding_vectors)
+        store.save(group, 'context_embedding', context_embedding_vectors)
+
+    # 5. user history category mask & indices
+    @staticmethod
+    def preprocess_user_history_category(config: Config, store: ArtifactStore, group: str, ids_group: str, mode: str):
+        category_dict = store.load_json(ids_group, 'category')
+        category_num = len(category_dict)
+        news_category_dict = {}
+        for prefix in [config.train_root, config.dev_root, config.test_root]:
+            with open(os.path.join(prefix, 'news.tsv'), 'r', encoding='utf-8') as news_f:
+                for line in news_f:
+                    if config.dataset not in ['mind'] and len(line.split('\t')) != 8:
+                        continue
+                    news_ID, category, _ = line.split('\t', 2)
+                    news_category_dict[news_ID] = category_dict[category]
+        prefix = {'train': config.train_root, 'dev': config.dev_root, 'test': config.test_root}[mode]
+        user_history_num = 0
+        with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
+            for line in behaviors_f:
+                user_history_num += 1
+        user_history_category_mask = np.zeros([user_history_num, category_num + 1], dtype=bool) # extra one category index for padding news
+        user_history_category_indices = np.full([user_history_num, config.max_history_num], category_num, dtype=np.int64)
+        with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
+            for line_index, line in enumerate(behaviors_f):
+                impression_ID, user_ID, time, history, impressions = line.split('\t')
+                if len(history.strip()) > 0:
+                    history_news_ID = history.split(' ')
+                    offset = max(0, len(history_news_ID) - config.max_history_num)
+                    history_news_num = min(len(history_news_ID), config.max_history_num)
+                    user_history_category_indices[line_index, :history_news_num] = [news_category_dict[news_ID] for news_ID in history_news_ID[offset:offset + history_news_num]]
+        user_history_category_mask[np.arange(user_history_num)[:, np.newaxis], user_history_category_indices] = 1
+        user_history_category_mask[:, category_num] = 0
+        store.save(group, 'user_history_category_mask', user_history_category_mask)
+        store.save(group, 'user_history_category_indices', user_history_category_indices)
+
+    # 6. user history graph
+    @staticmethod
+    def preprocess_user_history_graph(config: Config, store: ArtifactStore, group: str, user_history_category_group: str):
+        user_history_category_indices = store.load(user_history_category_group, 'user_history_category_indices')
+        user_history_num, max_history_num = user_history_category_indices.shape
+        category_num = store.load(user_history_category_group, 'user_history_category_mask').shape[1] - 1
+        user_history_news_num = (user_history_category_indices != category_num).sum(axis=1)
+        graph_size = max_history_num + category_num # graph size of |V_{n}|+|V_{p}|
+        graph_chunk_size = 4096                     # behaviors per vectorized graph building chunk
+        # build the graphs of E_{n}, E_{p}^{1} and E_{p}^{2} chunk by chunk, written in place into the memory-mapped artifact
+        user_history_graph = store.create(group, 'user_history_graph', [user_history_num, graph_size, graph_size], np.float32)
+        for chunk_index in range(0, user_history_num, graph_chunk_size):
+            user_history_graph[chunk_index:chunk_index + graph_chunk_size] = build_user_history_graph(user_history_category_indices[chunk_index:chunk_index + graph_chunk_size],
+                                                                                                       user_history_news_num[chunk_index:chunk_index + graph_chunk_size],
+                                                                                                       category_num,
+                                                                                                       self_connection=not config.no_self_connection,
+                                                                                                       normalization_type=None if config.no_adjacent_normalization else config.gcn_normalization_type)
+        store.finalize(group, 'user_history_graph', user_history_graph)
+
+    # 7. columnar behaviors
+    @staticmethod
+    def preprocess_behaviors(config: Config, store: ArtifactStore, group: str, ids_group: str, mode: str):
+        user_ID_dict = store.load_json(ids_group, 'user_ID')
+        news_ID_dict = store.load_json(ids_group, 'news_ID')
+        user_IDs = []
+        sample_news = []       # click impression (train) or candidate news (dev & test) of each sample
+        candidate_labels = []  # click label of each candidate news (labeled dev & test)
+        behavior_indices = []
+        history_lengths = []
+        history_news = []
+        negative_lengths = []
+        negative_news = []
+        prefix = {'train': config.train_root, 'dev': config.dev_root, 'test': config.test_root}[mode]
+        labeled_candidates = mode != 'test' or config.dataset != 'large'
+        with open(os.path.join(prefix, 'behaviors.tsv'), 'r', encoding='utf-8') as behaviors_f:
+            for behavior_index, line in enumerate(behaviors_f):
+                impression_ID, user_ID, time, history, impressions = line.split('\t')
+                if len(history) != 0:
+                    history = list(map(lambda x: news_ID_dict[x], history.strip().split(' ')))[-config.max_history_num:]
+                    history_news.extend(history)
+                    history_lengths.append(len(history))
+                else:
+                    history_lengths.append(0)
+                if mode == 'train':
+                    click_impressions = []
+                    non_click_impressions = []
+                    for impression in impressions.strip().split(' '):
+                        if impression[-2:] == '-1':
+                            click_impressions.append(news_ID_dict[impression[:-2]])
                         else:
-                            history_graph = np.identity(graph_size, dtype=np.float32)
-                        history_category_mask = np.zeros(category_num + 1, dtype=bool) # extra one category index for padding news
-                        history_category_indices = np.full([config.max_history_num], category_num, dtype=np.int64)
-                        if len(history.strip()) > 0:
-                            history_news_ID = history.split(' ')
-                            offset = max(0, len(history_news_ID) - config.max_history_num)
-                            history_news_num = min(len(history_news_ID), config.max_history_num)
-                            for i in range(history_news_num):
-                                category_index = news_category_dict[history_news_ID[i + offset]]
-                                history_category_mask[category_index] = 1
-                                history_category_indices[i] = category_index
-                                history_graph[i, config.max_history_num + category_index] = 1 # edge of E_{p}^{1} in inter-cluster graph G2
-                                history_graph[config.max_history_num + category_index, i] = 1 # edge of E_{p}^{1} in inter-cluster graph G2
-                                for j in range(i + 1, history_news_num):
-                                    _category_index = news_category_dict[history_news_ID[j + offset]]
-                                    if category_index == _category_index:
-                                        history_graph[i, j] = 1 # edge of E_{n} in intra-cluster graph G1
-                                        history_graph[j, i] = 1 # edge of E_{n} in intra-cluster graph G1
-                                    else:
-                                        history_graph[config.max_history_num + category_index, config.max_history_num + _category_index] = 1 # edge of E_{p}^{2} in inter-cluster graph G2
-                                        history_graph[config.max_history_num + _category_index, config.max_history_num + category_index] = 1 # edge of E_{p}^{2} in inter-cluster graph G2
-                            if not config.no_adjacent_normalization:
-                                if config.gcn_normalization_type == 'asymmetric':
-                                    # Asymmetric adjacent matrix normalization: D^{-\frac{1}{2}}A
-                                    D_inv = np.zeros([graph_size, graph_size], dtype=np.float32)
-                                    np.fill_diagonal(D_inv, 1 / history_graph.sum(axis=1, keepdims=False))
-                                    history_graph = np.matmul(D_inv, history_graph)
-                                else:
-                                    # Symmetric adjacent matrix normalization: D^{-\frac{1}{2}}AD^{-\frac{1}{2}}
-                                    D_inv_sqrt = np.zeros([graph_size, graph_size], dtype=np.float32)
-                                    np.fill_diagonal(D_inv_sqrt, np.sqrt(1 / history_graph.sum(axis=1, keepdims=False)))
-                                    history_graph = np.matmul(np.matmul(D_inv_sqrt, history_graph), D_inv_sqrt)
-                        user_history_graph[line_index] = history_graph
-                        user_history_category_mask[line_index] = history_category_mask
-                        user_history_category_indices[line_index] = history_category_indices
-                    user_history_graph_data[mode + '_user_history_graph'] = user_history_graph
-                    user_history_graph_data[mode + '_user_history_category_mask'] = user_history_category_mask
-                    user_history_graph_data[mode + '_user_history_category_indices'] = user_history_category_indices
-                with gzip.open(user_history_graph_file_raw.replace('.pkl.gz', f'_{mode}.pkl.gz'), 'wb', compresslevel=9) as user_history_graph_f:
-                    pickle.dump(user_history_graph_data, user_history_graph_f)
-                print(f'{mode}-completed: ', len(user_history_graph_data))
+                            non_click_impressions.append(news_ID_dict[impression[:-2]])
+                    for click_impression in click_impressions:
+                        user_IDs.append(user_ID_dict[user_ID])
+                        sample_news.append(click_impression)
+                        behavior_indices.append(behavior_index)
+                    negative_news.extend(non_click_impressions)
+                    negative_lengths.append(len(non_click_impressions))
+                else:
+                    for impression in impressions.strip().split(' '):
+                        user_IDs.append(user_ID_dict[user_ID] if user_ID in user_ID_dict else 0)
+                        sample_news.append(news_ID_dict[impression[:-2]] if labeled_candidates else news_ID_dict[impression])
+                        behavior_indices.append(behavior_index)
+                        if labeled_candidates:
+                            candidate_labels.append(int(impression[-1]))
+        store.save(group, 'user_ID', np.array(user_IDs, dtype=np.int32))
+        store.save(group, 'positive_news' if mode == 'train' else 'candidate_news', np.array(sample_news, dtype=np.int32))
+        store.save(group, 'behavior_index', np.array(behavior_indices, dtype=np.int32))
+        store.save(group, 'history_offsets', np.concatenate([[0], np.cumsum(history_lengths)]).astype(np.int64))
+        store.save(group, 'history_news', np.array(history_news, dtype=np.int32))
+        if mode != 'train' and labeled_candidates:
+            store.save(group, 'candidate_label', np.array(candidate_labels, dtype=np.int8))
+        if mode == 'train':
+            store.save(group, 'negative_offsets', np.concatenate([[0], np.cumsum(negative_lengths)]).astype(np.int64))
+            store.save(group, 'negative_news', np.array(negative_news, dtype=np.int32))
 
     def __init__(self, config: Config):
-        user_history_graph_file_train = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '_train.pkl'+'.gz'
-        user_history_graph_file_dev = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '_dev.pkl'+'.gz'
-        user_history_graph_file_test = 'user_history_graph-' + str(config.max_history_num) + ('' if config.no_self_connection else '-self') + ('' if config.no_adjacent_normalization else '-normalize-' + config.gcn_normalization_type) + '-' + config.dataset + '_test.pkl'+'.gz'
-        
+        store = ArtifactStore()
+
         # preprocess data
-        Corpus.preprocess(config)
-        with open('user_ID-%s.json' % config.dataset, 'r', encoding='utf-8') as user_ID_f:
-            self.user_ID_dict = json.load(user_ID_f)
-            config.user_num = len(self.user_ID_dict)
-        with open('news_ID-%s.json' % config.dataset, 'r', encoding='utf-8') as news_ID_f:
-            self.news_ID_dict = json.load(news_ID_f)
-            self.news_num = len(self.news_ID_dict)
-        with open('category-%s.json' % config.dataset, 'r', encoding='utf-8') as category_f:
-            self.category_dict = json.load(category_f)
-            config.category_num = len(self.category_dict)
-        with open('subCategory-%s.json' % config.dataset, 'r', encoding='utf-8') as subCategory_f:
-            self.subCategory_dict = json.load(subCategory_f)
-            config.subCategory_num = len(self.subCategory_dict)
-        with open('vocabulary-' + str(config.word_threshold) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.dataset + '.json', 'r', encoding='utf-8') as vocabulary_f:
-            self.word_dict = json.load(vocabulary_f)
-            config.vocabulary_size = len(self.word_dict)
+        stages = Corpus.preprocess(config)
+        ids_group = stages['ids']['group']
+        # the news encoders load their pretrained embeddings from the groups resolved here, without fingerprinting the raw files again
+        config.word_embedding_group = stages['word_embedding']['group']
+        self.user_ID_dict = store.load_json(ids_group, 'user_ID')
+        config.user_num = len(self.user_ID_dict)
+        self.news_ID_dict = store.load_json(ids_group, 'news_ID')
+        self.news_num = len(self.news_ID_dict)
+        self.category_dict = store.load_json(ids_group, 'category')
+        config.category_num = len(self.category_dict)
+        self.subCategory_dict = store.load_json(ids_group, 'subCategory')
+        config.subCategory_num = len(self.subCategory_dict)
+        self.word_dict = store.load_json(stages['vocabulary']['group'], 'vocabulary')
+        config.vocabulary_size = len(self.word_dict)
         if config.dataset in ['mind']:
-            with open('entity-%s.json' % config.dataset, 'r', encoding='utf-8') as entity_f:
-                self.entity_dict = json.load(entity_f)
-                config.entity_size = len(self.entity_dict)
-        with gzip.open(user_history_graph_file_train, 'rb') as user_history_graph_f_train, \
-            gzip.open(user_history_graph_file_dev, 'rb') as user_history_graph_f_dev, \
-            gzip.open(user_history_graph_file_test, 'rb') as user_history_graph_f_test:
-            user_history_data_train = pickle.load(user_history_graph_f_train)
-            user_history_data_dev = pickle.load(user_history_graph_f_dev)
-            user_history_data_test = pickle.load(user_history_graph_f_test)
-            
-            self.train_user_history_graph = user_history_data_train['train_user_history_graph']
-            self.train_user_history_category_mask = user_history_data_train['train_user_history_category_mask']
-            self.train_user_history_category_indices = user_history_data_train['train_user_history_category_indices']
-            self.dev_user_history_graph = user_history_data_dev['dev_user_history_graph']
-            self.dev_user_history_category_mask = user_history_data_dev['dev_user_history_category_mask']
-            self.dev_user_history_category_indices = user_history_data_dev['dev_user_history_category_indices']
-            self.test_user_history_graph = user_history_data_test['test_user_history_graph']
-            self.test_user_history_category_mask = user_history_data_test['test_user_history_category_mask']
-            self.test_user_history_category_indices = user_history_data_test['test_user_history_category_indices']
+            self.entity_dict = store.load_json(ids_group, 'entity')
+            config.entity_size = len(self.entity_dict)
+            config.entity_embedding_group = stages['entity_embedding']['group']
+        # memory-mapped user history arrays (user history graphs are None in the 'batch' graph materialization mode)
+        for mode in ['train', 'dev', 'test']:
+            user_history_category_data = store.load_group(stages['user_history_category_' + mode]['group'])
+            setattr(self, mode + '_user_history_category_mask', user_history_category_data['user_history_category_mask'])
+            setattr(self, mode + '_user_history_category_indices', user_history_category_data['user_history_category_indices'])
+            setattr(self, mode + '_user_history_graph', store.load(stages['user_history_graph_' + mode]['group'], 'user_history_graph') if config.graph_materialization == 'precomputed' else None)
+        # history news number of each behavior (category indices are padded with category_num)
+        self.train_user_history_num = (self.train_user_history_category_indices != config.category_num).sum(axis=1)
+        self.dev_user_history_num = (self.dev_user_history_category_indices != config.category_num).sum(axis=1)
+        self.test_user_history_num = (self.test_user_history_category_indices != config.category_num).sum(axis=1)
+        self.graph_materialization = config.graph_materialization
+        self.category_num = config.category_num
+        self.gcn_self_connection = not config.no_self_connection
+        self.gcn_normalization_type = None if config.no_adjacent_normalization else config.gcn_normalization_type
 
         # meta data
         self.negative_sample_num = config.negative_sample_num                                           # negative sample number for training
+        self.seed = config.seed                                                                         # seed of the per-epoch negative sampling
         self.max_history_num = config.max_history_num                                                   # max history number for each training user
         self.max_title_length = config.max_title_length                                                 # max title length for each news text
         self.max_abstract_length = config.max_abstract_length                                           # max abstract length for each news text
+        # tokenized news meta data, cached in the artifact store and memory-mapped on later runs
+        news_text_keys = ['news_category', 'news_subCategory', 'news_title_text', 'news_title_mask', 'news_title_entity', 'news_abstract_text', 'news_abstract_mask', 'news_abstract_entity']
+        store.build_stage(stages['news_text'], news_text_keys + ['news_word_num'], lambda group: self.preprocess_news_text(config, store, group, news_text_keys))
+        news_text_data = store.load_group(stages['news_text']['group'])
+        for key in news_text_keys:
+            setattr(self, key, news_text_data[key])
+        self.title_word_num, self.abstract_word_num = news_text_data['news_word_num'].tolist()
+        # text length of each news (the text masks are prefixes), to which the batches are trimmed with dynamic padding
+        self.news_title_length = self.news_title_mask.sum(axis=1).astype(np.int32)                   # [news_num]
+        self.news_abstract_length = self.news_abstract_mask.sum(axis=1).astype(np.int32)             # [news_num]
+        self.dynamic_padding = config.dynamic_padding
+
+        # columnar behaviors, cached in the artifact store and memory-mapped on later runs
+        self.train_behaviors = Behaviors(store.load_group(stages['behaviors_train']['group']), self.max_history_num) # user_ID, positive_news, behavior_index & CSR of history and non-clicked news
+        self.dev_behaviors = Behaviors(store.load_group(stages['behaviors_dev']['group']), self.max_history_num)     # user_ID, candidate_news, behavior_index & CSR of history news
+        self.dev_indices = self.dev_behaviors.behavior_index                                                         # index for dev
+        self.test_behaviors = Behaviors(store.load_group(stages['behaviors_test']['group']), self.max_history_num)   # user_ID, candidate_news, behavior_index & CSR of history news
+        self.test_indices = self.test_behaviors.behavior_index                                                       # index for test
+
+    # 8. tokenized news meta data
+    def preprocess_news_text(self, config: Config, store: ArtifactStore, group: str, news_text_keys: list):
+        self.tokenize_news(config)
+        for key in news_text_keys:
+            store.save(group, key, getattr(self, key))
+        store.save(group, 'news_word_num', np.array([self.title_word_num, self.abstract_word_num], dtype=np.int64))
+
+    # Tokenize the title and abstract of every news and align the entities to the tokenized words
+    def tokenize_news(self, config: Config):
         self.news_category = np.zeros([self.news_num], dtype=np.int32)                                  # [news_num]
         self.news_subCategory = np.zeros([self.news_num], dtype=np.int32)                               # [news_num]
         self.news_title_text = np.zeros([self.news_num, self.max_title_length], dtype=np.int32)         # [news_num, max_title_length]
@@ -338,15 +636,7 @@ class Corpus:
         self.news_abstract_text = np.zeros([self.news_num, self.max_abstract_length], dtype=np.int32)   # [news_num, max_abstract_length]
         self.news_abstract_mask = np.zeros([self.news_num, self.max_abstract_length], dtype=bool)       # [news_num, max_abstract_length]
         self.news_abstract_entity = np.zeros([self.news_num, self.max_abstract_length], dtype=np.int32) # [news_num, max_abstract_length]
-        self.train_behaviors = []                                                                       # [user_ID, [history], [history_mask], click impression, [non-click impressions], behavior_index]
-        self.dev_behaviors = []                                                                         # [user_ID, [history], [history_mask], candidate_news_ID, behavior_index]
-        self.dev_indices = []                                                                           # index for dev
-        self.test_behaviors = []                                                                        # [user_ID, [history], [history_mask], candidate_news_ID, behavior_index]
-        self.test_indices = []                                                                          # index for test
-        self.title_word_num = 0
-        self.abstract_word_num = 0
-
-        # generate news meta data
+
         news_ID_set = set(['<PAD>'])
         news_lines = []
         with open(os.path.join(config.train_root, 'news.tsv'), 'r', encoding='utf-8') as train_news_f:
@@ -368,121 +658,14 @@ class Corpus:
                     news_lines.append(line)
                     news_ID_set.add(news_ID)
         assert self.news_num == len(news_ID_set), 'news num mismatch %d v.s. %d' % (self.news_num, len(news_ID_set))
-        for line in news_lines:
-            news_ID, category, subCategory, title, abstract, _, title_entities, abstract_entities = line.split('\t')
-            index = self.news_ID_dict[news_ID]
-            self.news_category[index] = self.category_dict[category] if category in self.category_dict else 0
-            self.news_subCategory[index] = self.subCategory_dict[subCategory] if subCategory in self.subCategory_dict else 0
-            words = pat.findall(title.lower()) if config.tokenizer == 'MIND' else word_tokenize(title.lower())
-            offsets = [-1 for _ in range(len(title))]
-            offset_index = 0
-            for i, word in enumerate(words):
-                if i == self.max_title_length:
-                    break
-                if is_number(word):
-                    self.news_title_text[index][i] = self.word_dict['<NUM>']
-                elif word in self.word_dict:
-                    self.news_title_text[index][i] = self.word_dict[word]
-                else:
-                    self.news_title_text[index][i] = 1
-                self.news_title_mask[index][i] = 1
-                while title[offset_index] in [' ', '\t']:
-                    offset_index += 1
-                for j in range(len(word)):
-                    offsets[offset_index] = i
-                    offset_index += 1
-            if config.dataset in ['mind']:
-                for entity in json.loads(title_entities):
-                    WikidataId = entity['WikidataId']
-                    for offset in entity['OccurrenceOffsets']:
-                        if offsets[offset] != -1 and WikidataId in self.entity_dict:
-                            self.news_title_entity[index][offsets[offset]] = self.entity_dict[WikidataId]
-            self.title_word_num += len(words)
-            words = pat.findall(abstract.lower()) if config.tokenizer == 'MIND' else word_tokenize(abstract.lower())
-            offsets = [-1 for _ in range(len(abstract))]
-            offset_index = 0
-            for i, word in enumerate(words):
-                if i == self.max_abstract_length:
-                    break
-                if is_number(word):
-                    self.news_abstract_text[index][i] = self.word_dict['<NUM>']
-                elif word in self.word_dict:
-                    self.news_abstract_text[index][i] = self.word_dict[word]
-                else:
-                    self.news_abstract_text[index][i] = 1
-                self.news_abstract_mask[index][i] = 1
-                while abstract[offset_index] in [' ', '\t']:
-                    offset_index += 1
-                for j in range(len(word)):
-                    offsets[offset_index] = i
-                    offset_index += 1
-            if config.dataset in ['mind']:
-                for entity in json.loads(abstract_entities):
-                    WikidataId = entity['WikidataId']
-                    for offset in entity['OccurrenceOffsets']:
-                        if offsets[offset] != -1 and WikidataId in self.entity_dict:
-                            self.news_abstract_entity[index][offsets[offset]] = self.entity_dict[WikidataId]
-            self.abstract_word_num += len(words)
+        news_lines = [line.split('\t') for line in news_lines]
+        news_indices = [self.news_ID_dict[news_ID] for news_ID, _, _, _, _, _, _, _ in news_lines]
+        self.news_category[news_indices] = [self.category_dict[category] if category in self.category_dict else 0 for _, category, _, _, _, _, _, _ in news_lines]
+        self.news_subCategory[news_indices] = [self.subCategory_dict[subCategory] if subCategory in self.subCategory_dict else 0 for _, _, subCategory, _, _, _, _, _ in news_lines]
+        news_tokenizer = NewsTokenizer(config.tokenizer, self.word_dict, self.entity_dict if config.dataset in ['mind'] else None)
+        self.news_title_text[news_indices], self.news_title_mask[news_indices], self.news_title_entity[news_indices], self.title_word_num = \
+            news_tokenizer.encode([title for _, _, _, title, _, _, _, _ in news_lines], self.max_title_length, [title_entities for _, _, _, _, _, _, title_entities, _ in news_lines] if config.dataset in ['mind'] else None)
+        self.news_abstract_text[news_indices], self.news_abstract_mask[news_indices], self.news_abstract_entity[news_indices], self.abstract_word_num = \
+            news_tokenizer.encode([abstract for _, _, _, _, abstract, _, _, _ in news_lines], self.max_abstract_length, [abstract_entities for _, _, _, _, _, _, _, abstract_entities in news_lines] if config.dataset in ['mind'] else None)
         self.news_title_mask[0][0] = 1    # for <PAD> news
         self.news_abstract_mask[0][0] = 1 # for <PAD> news
-
-        # generate behavior meta data
-        with open(os.path.join(config.train_root, 'behaviors.tsv'), 'r', encoding='utf-8') as train_behaviors_f:
-            for behavior_index, line in enumerate(train_behaviors_f):
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                click_impressions = []
-                non_click_impressions = []
-                for impression in impressions.strip().split(' '):
-                    if impression[-2:] == '-1':
-                        click_impressions.append(self.news_ID_dict[impression[:-2]])
-                    else:
-                        non_click_impressions.append(self.news_ID_dict[impression[:-2]])
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=bool)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1
-                    for click_impression in click_impressions:
-                        self.train_behaviors.append([self.user_ID_dict[user_ID], user_history, user_history_mask, click_impression, non_click_impressions, behavior_index])
-                else:
-                    for click_impression in click_impressions:
-                        self.train_behaviors.append([self.user_ID_dict[user_ID], [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=bool), click_impression, non_click_impressions, behavior_index])
-        with open(os.path.join(config.dev_root, 'behaviors.tsv'), 'r', encoding='utf-8') as dev_behaviors_f:
-            for dev_ID, line in enumerate(dev_behaviors_f):
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=bool)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1
-                    for impression in impressions.strip().split(' '):
-                        self.dev_indices.append(dev_ID)
-                        self.dev_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, user_history, user_history_mask, self.news_ID_dict[impression[:-2]], dev_ID])
-                else:
-                    for impression in impressions.strip().split(' '):
-                        self.dev_indices.append(dev_ID)
-                        self.dev_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=bool), self.news_ID_dict[impression[:-2]], dev_ID])
-        with open(os.path.join(config.test_root, 'behaviors.tsv'), 'r', encoding='utf-8') as test_behaviors_f:
-            for test_ID, line in enumerate(test_behaviors_f):
-                impression_ID, user_ID, time, history, impressions = line.split('\t')
-                if len(history) != 0:
-                    history = list(map(lambda x: self.news_ID_dict[x], history.strip().split(' ')))
-                    padding_num = max(0, self.max_history_num - len(history))
-                    user_history = history[-self.max_history_num:] + [0] * padding_num
-                    user_history_mask = np.zeros([self.max_history_num], dtype=bool)
-                    user_history_mask[:min(len(history), self.max_history_num)] = 1
-                    for impression in impressions.strip().split(' '):
-                        self.test_indices.append(test_ID)
-                        if config.dataset != 'large':
-                            self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, user_history, user_history_mask, self.news_ID_dict[impression[:-2]], test_ID])
-                        else:
-                            self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, user_history, user_history_mask, self.news_ID_dict[impression], test_ID])
-                else:
-                    for impression in impressions.strip().split(' '):
-                        self.test_indices.append(test_ID)
-                        if config.dataset != 'large':
-                            self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=bool), self.news_ID_dict[impression[:-2]], test_ID])
-                        else:
-                            self.test_behaviors.append([self.user_ID_dict[user_ID] if user_ID in self.user_ID_dict else 0, [0 for _ in range(self.max_history_num)], np.zeros([self.max_history_num], dtype=bool), self.news_ID_dict[impression], test_ID])
@@ -1,13 +1,112 @@
-from corpus import Corpus
+from corpus import Corpus, build_user_history_graph
 import time
+import itertools
 from config import Config
+import torch
 import torch.utils.data as data
-from numpy.random import randint
+import numpy as np
 from torch.utils.data import DataLoader
 
 
-class Train_Dataset(data.Dataset):
+# User history graph builder for the 'batch' graph materialization mode
+# The user_history_graph array of the datasets then holds the history news number of each behavior, and the graphs are built for the whole batch
+class UserHistoryGraph_Builder:
     def __init__(self, corpus: Corpus):
+        self.category_num = corpus.category_num
+        self.self_connection = corpus.gcn_self_connection
+        self.normalization_type = corpus.gcn_normalization_type
+
+    # Input
+    # user_history_num              : [batch_size]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # Output
+    # user_history_graph            : [batch_size, max_history_num + category_num, max_history_num + category_num]
+    def __call__(self, user_history_num, user_history_category_indices):
+        return torch.from_numpy(build_user_history_graph(user_history_category_indices, user_history_num, self.category_num, self_connection=self.self_connection, normalization_type=self.normalization_type))
+
+
+# Graph fields of a batch of behaviors : user_history_graph, user_history_category_mask and user_history_category_indices
+# The history nodes are trimmed to the history_num of the batch (the padding history nodes are only self-connected, so the other nodes are unchanged)
+def gather_user_history_graph(dataset, behavior_index, history_num):
+    user_history_category_indices = dataset.user_history_category_indices[:, :history_num][behavior_index]                                    # [batch_size, history_num]
+    if dataset.user_history_graph_builder is None:
+        max_history_num = dataset.user_history_category_indices.shape[1]
+        if history_num == max_history_num:
+            user_history_graph = torch.from_numpy(dataset.user_history_graph[behavior_index])
+        else:
+            node_index = np.concatenate([np.arange(history_num), np.arange(max_history_num, dataset.user_history_graph.shape[1])])                # [history_num + category_num]
+            user_history_graph = torch.from_numpy(dataset.user_history_graph[behavior_index[:, np.newaxis, np.newaxis], node_index[np.newaxis, :, np.newaxis], node_index[np.newaxis, np.newaxis, :]])
+    else:
+        user_history_graph = dataset.user_history_graph_builder(dataset.user_history_graph[behavior_index], user_history_category_indices)
+    return user_history_graph, torch.from_numpy(dataset.user_history_category_mask[behavior_index]), torch.from_numpy(user_history_category_indices)
+
+
+# User fields of a batch of behaviors, as contiguous tensors gathered with one fancy index each
+def gather_user_history(dataset, user_ID, behavior_index, history_index, user_history_mask, news_body_feature=None):
+    return (torch.from_numpy(user_ID.astype(np.int64)), ) + gather_news(dataset, history_index, news_body_feature) + (torch.from_numpy(user_history_mask), ) + gather_user_history_graph(dataset, behavior_index, history_index.shape[1])
+
+
+# News fields of the news indices of a batch (of any shape), as contiguous tensors gathered with one fancy index each
+# With dynamic padding, the title and abstract are trimmed to the longest ones of the gathered news (at least 1)
+# With news_body_feature (the precomputed outputs of a frozen body branch), the abstract text is replaced by the body features of the news
+# (sequence features, whose leading vector is news-level, are trimmed to the abstract length as well)
+def gather_news(dataset, news_index, news_body_feature=None):
+    if dataset.dynamic_padding:
+        title_length = max(int(dataset.news_title_length[news_index].max()), 1)
+        abstract_length = max(int(dataset.news_abstract_length[news_index].max()), 1)
+    else:
+        title_length = dataset.news_title_text.shape[1]
+        abstract_length = dataset.news_abstract_text.shape[1]
+    if news_body_feature is None:
+        abstract_text = torch.from_numpy(dataset.news_abstract_text[:, :abstract_length][news_index])
+    elif news_body_feature.ndim == 3:
+        abstract_text = torch.from_numpy(news_body_feature[:, :abstract_length + 1][news_index])
+    else:
+        abstract_text = torch.from_numpy(news_body_feature[news_index])
+    return torch.from_numpy(dataset.news_category[news_index]), torch.from_numpy(dataset.news_subCategory[news_index]), \
+           torch.from_numpy(dataset.news_title_text[:, :title_length][news_index]), torch.from_numpy(dataset.news_title_mask[:, :title_length][news_index]), torch.from_numpy(dataset.news_title_entity[:, :title_length][news_index]), \
+           abstract_text, torch.from_numpy(dataset.news_abstract_mask[:, :abstract_length][news_index]), torch.from_numpy(dataset.news_abstract_entity[:, :abstract_length][news_index])
+
+
+# Indices of negative_sample_num non-click news of each impression, uniform in both the sampled set and its order
+# An impression with more than negative_sample_num non-click news samples them without replacement (Floyd's algorithm, vectorized over the impressions)
+# An impression with fewer non-click news repeats them
+# Floyd's algorithm draws a uniform set, but its j-th column is bounded by news_num - negative_sample_num + j, so every row is shuffled afterwards
+# Input
+# news_num       : [num] (non-click news number of each impression)
+# Output
+# negative_index : [num, negative_sample_num]
+def sample_negative_index(news_num, negative_sample_num, generator):
+    # fewer non-click news than negative_sample_num : wrap around
+    negative_index = np.arange(negative_sample_num)[np.newaxis, :] % news_num[:, np.newaxis]                            # [num, negative_sample_num]
+    # more non-click news than negative_sample_num : the j-th sample is uniform in [0, news_num - negative_sample_num + j], or the upper bound if already sampled
+    long = news_num > negative_sample_num
+    long_news_num = news_num[long]
+    long_negative_index = np.empty([len(long_news_num), negative_sample_num], dtype=np.int64)                           # [long_num, negative_sample_num]
+    for j in range(negative_sample_num):
+        upper_bound = long_news_num - negative_sample_num + j
+        k = generator.integers(0, upper_bound + 1)
+        long_negative_index[:, j] = np.where((long_negative_index[:, :j] == k[:, np.newaxis]).any(axis=1), upper_bound, k)
+    negative_index[long] = long_negative_index
+    return generator.permuted(negative_index, axis=1)
+
+
+# Pool of shared_negative_num news drawn uniformly without replacement from the sampled non-click news of a batch
+# Input
+# negative_news : [batch_size, negative_sample_num]
+# Output
+# pool          : [min(shared_negative_num, batch_size * negative_sample_num)]
+def shared_negative_pool(negative_news, shared_negative_num, generator):
+    negative_news = negative_news.reshape([-1])
+    return negative_news[generator.choice(len(negative_news), min(shared_negative_num, len(negative_news)), replace=False)]
+
+
+class Train_Dataset(data.Dataset):
+    def __init__(self, corpus: Corpus, unique_news=False, in_batch_negatives=False, shared_negative_num=0, precomputed_history=False):
+        self.unique_news = unique_news or in_batch_negatives
+        self.precomputed_history = precomputed_history
+        self.in_batch_negatives = in_batch_negatives
+        self.shared_negative_num = shared_negative_num
         self.negative_sample_num = corpus.negative_sample_num
         self.news_category = corpus.news_category
         self.news_subCategory = corpus.news_subCategory
@@ -17,64 +116,100 @@ class Train_Dataset(data.Dataset):
         self.news_abstract_mask = corpus.news_abstract_mask
         self.news_title_entity = corpus.news_title_entity
         self.news_abstract_entity = corpus.news_abstract_entity
-        self.user_history_graph = corpus.train_user_history_graph
+        self.news_title_length = corpus.news_title_length
+        self.news_abstract_length = corpus.news_abstract_length
+        self.dynamic_padding = corpus.dynamic_padding
+        self.news_body_feature = None # [news_num, *body_feature_shape] (set once the body branch of the news encoder is frozen)
+        self.user_history_graph = corpus.train_user_history_graph if corpus.graph_materialization == 'precomputed' else corpus.train_user_history_num
         self.user_history_category_mask = corpus.train_user_history_category_mask
         self.user_history_category_indices = corpus.train_user_history_category_indices
+        self.user_history_graph_builder = UserHistoryGraph_Builder(corpus) if corpus.graph_materialization == 'batch' else None
         self.train_behaviors = corpus.train_behaviors
-        self.train_samples = [[0 for _ in range(1 + self.negative_sample_num)] for __ in range(len(self.train_behaviors))]
+        self.seed = corpus.seed
+        self.epoch = 0 # epoch of the current negative samples (set by negative_sampling)
         self.num = len(self.train_behaviors)
+        self.history_num = self.train_behaviors.history_length[self.train_behaviors.behavior_index] # [num] (bucketing key of LengthBucket_BatchSampler)
+        self.train_samples = np.zeros([self.num, 1 + self.negative_sample_num], dtype=np.int32) # [num, 1 + negative_sample_num] (click news and its sampled non-click news)
 
-    def negative_sampling(self, rank=None):
+    # Non-click news are sampled from the CSR non-click arrays of the behaviors, with a generator seeded by the seed and the epoch
+    def negative_sampling(self, epoch, rank=None):
         print('\n%sBegin negative sampling, training sample num : %d' % ('' if rank is None else ('rank ' + str(rank) + ' : '), self.num))
         start_time = time.time()
-        for i, train_behavior in enumerate(self.train_behaviors):
-            self.train_samples[i][0] = train_behavior[3]
-            negative_samples = train_behavior[4]
-            news_num = len(negative_samples)
-            if news_num <= self.negative_sample_num:
-                for j in range(self.negative_sample_num):
-                    self.train_samples[i][j + 1] = negative_samples[j % news_num]
-            else:
-                used_negative_samples = set()
-                for j in range(self.negative_sample_num):
-                    while True:
-                        k = randint(0, news_num)
-                        if k not in used_negative_samples:
-                            self.train_samples[i][j + 1] = negative_samples[k]
-                            used_negative_samples.add(k)
-                            break
+        generator = np.random.default_rng([self.seed, epoch])
+        self.epoch = epoch
+        behavior_index = self.train_behaviors.behavior_index
+        negative_offset = self.train_behaviors.negative_offsets[behavior_index]                                         # [num]
+        news_num = (self.train_behaviors.negative_offsets[behavior_index + 1] - negative_offset).astype(np.int64)         # [num]
+        assert np.all(news_num > 0), 'every training impression must have non-click news'
+        negative_index = sample_negative_index(news_num, self.negative_sample_num, generator)                            # [num, negative_sample_num]
+        self.train_samples[:, 0] = self.train_behaviors.positive_news
+        self.train_samples[:, 1:] = self.train_behaviors.negative_news[negative_offset[:, np.newaxis] + negative_index]
         end_time = time.time()
         print('%sEnd negative sampling, used time : %.3fs' % ('' if rank is None else ('rank ' + str(rank) + ' : '), end_time - start_time))
 
-    # user_ID                       : [1]
-    # user_category                 : [max_history_num]
-    # usre_subCategory              : [max_history_num]
-    # user_title_text               : [max_history_num, max_title_length]
-    # user_title_mask               : [max_history_num, max_title_length]
-    # user_title_entity             : [max_history_num, max_title_length]
-    # user_abstract_text            : [max_history_num, max_abstract_length]
-    # user_abstract_mask            : [max_history_num, max_abstract_length]
-    # user_abstract_entity          : [max_history_num, max_abstract_length]
-    # user_history_mask             : [max_history_num]
-    # user_history_graph            : [max_history_num, max_history_num]
-    # user_history_category_mask    : [category_num + 1]
-    # user_history_category_indices : [max_history_num]
-    # news_category                 : [1 + negative_sample_num]
-    # news_subCategory              : [1 + negative_sample_num]
-    # news_title_text               : [1 + negative_sample_num, max_title_length]
-    # news_title_mask               : [1 + negative_sample_num, max_title_length]
-    # news_title_entity             : [1 + negative_sample_num, max_title_length]
-    # news_abstract_text            : [1 + negative_sample_num, max_abstract_length]
-    # news_abstract_mask            : [1 + negative_sample_num, max_abstract_length]
-    # news_abstract_entity          : [1 + negative_sample_num, max_abstract_length]
-
-    def __getitem__(self, index):
-        train_behavior = self.train_behaviors[index]
-        history_index = train_behavior[1]
-        sample_index = self.train_samples[index]
-        behavior_index = train_behavior[5]
-        return train_behavior[0], self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], train_behavior[2], self.user_history_graph[behavior_index], self.user_history_category_mask[behavior_index], self.user_history_category_indices[behavior_index], \
-               self.news_category[sample_index], self.news_subCategory[sample_index], self.news_title_text[sample_index], self.news_title_mask[sample_index], self.news_title_entity[sample_index], self.news_abstract_text[sample_index], self.news_abstract_mask[sample_index], self.news_abstract_entity[sample_index]
+    # A batch of samples is gathered at once, with one fancy index per feature, so the dataset is loaded with batch_size=None and a BatchSampler
+    # With dynamic padding, max_history_num, max_title_length and max_abstract_length are trimmed to the longest history and texts of the batch
+    # Input
+    # indices                       : [batch_size]
+    # Output
+    # user_ID                       : [batch_size]
+    # user_category                 : [batch_size, max_history_num]
+    # user_subCategory              : [batch_size, max_history_num]
+    # user_title_text               : [batch_size, max_history_num, max_title_length]
+    # user_title_mask               : [batch_size, max_history_num, max_title_length]
+    # user_title_entity             : [batch_size, max_history_num, max_title_length]
+    # user_abstract_text            : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_mask            : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_entity          : [batch_size, max_history_num, max_abstract_length]
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num + 1]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # news_category                 : [batch_size, 1 + negative_sample_num]
+    # news_subCategory              : [batch_size, 1 + negative_sample_num]
+    # news_title_text               : [batch_size, 1 + negative_sample_num, max_title_length]
+    # news_title_mask               : [batch_size, 1 + negative_sample_num, max_title_length]
+    # news_title_entity             : [batch_size, 1 + negative_sample_num, max_title_length]
+    # news_abstract_text            : [batch_size, 1 + negative_sample_num, max_abstract_length]
+    # news_abstract_mask            : [batch_size, 1 + negative_sample_num, max_abstract_length]
+    # news_abstract_entity          : [batch_size, 1 + negative_sample_num, max_abstract_length]
+    # With unique_news, each news of the batch is gathered once, and the history and candidate slots index the unique news
+    # user_ID                       : [batch_size]
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num + 1]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # news_*                        : [unique_news_num, ...] (news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity)
+    # history_news_index            : [batch_size, max_history_num]
+    # candidate_news_index          : [batch_size, 1 + negative_sample_num]
+    # With in_batch_negatives, the candidates are shared by the batch : the click news of the samples followed by a pool of shared_negative_num sampled non-click news
+    # (drawn uniformly from the sampled non-click news of the batch, with a generator seeded by the seed, the epoch and the first sample)
+    # candidate_news_index          : [batch_size + shared_negative_num]
+    # With precomputed_history, the history news are given as news indices (for the history news cache), and the candidate news as above
+    # user_ID                       : [batch_size]
+    # user_history                  : [batch_size, max_history_num]
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num + 1]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # news_*                        : [batch_size, 1 + negative_sample_num, ...]
+    # With news_body_feature (once the body branch of the news encoder is frozen), the news and user abstract texts are replaced by the precomputed body features
+    def __getitem__(self, indices):
+        indices = np.asarray(indices)
+        behavior_index = self.train_behaviors.behavior_index[indices]
+        history_index, user_history_mask = self.train_behaviors.histories(behavior_index, trim=self.dynamic_padding)
+        sample_index = self.train_samples[indices]
+        if self.in_batch_negatives:
+            generator = np.random.default_rng([self.seed, self.epoch, int(indices[0])])
+            sample_index = np.concatenate([sample_index[:, 0], shared_negative_pool(sample_index[:, 1:], self.shared_negative_num, generator)])       # [batch_size + shared_negative_num]
+        if self.unique_news:
+            unique_news, news_index = np.unique(np.concatenate([history_index.reshape([-1]), sample_index.reshape([-1])]), return_inverse=True)
+            news_index = news_index.reshape([-1])                                                                                                # [batch_size * max_history_num + sample_num]
+            return (torch.from_numpy(self.train_behaviors.user_ID[indices].astype(np.int64)), torch.from_numpy(user_history_mask)) + gather_user_history_graph(self, behavior_index, history_index.shape[1]) + \
+                   gather_news(self, unique_news, self.news_body_feature) + (torch.from_numpy(news_index[:history_index.size].reshape(history_index.shape)), torch.from_numpy(news_index[history_index.size:].reshape(sample_index.shape)))
+        if self.precomputed_history:
+            return (torch.from_numpy(self.train_behaviors.user_ID[indices].astype(np.int64)), torch.from_numpy(history_index), torch.from_numpy(user_history_mask)) + gather_user_history_graph(self, behavior_index, history_index.shape[1]) + gather_news(self, sample_index, self.news_body_feature)
+        return gather_user_history(self, self.train_behaviors.user_ID[indices], behavior_index, history_index, user_history_mask, self.news_body_feature) + gather_news(self, sample_index, self.news_body_feature)
 
     def __len__(self):
         return self.num
@@ -91,45 +226,173 @@ class DevTest_Dataset(data.Dataset):
         self.news_abstract_text =  corpus.news_abstract_text
         self.news_abstract_mask = corpus.news_abstract_mask
         self.news_abstract_entity = corpus.news_abstract_entity
-        self.user_history_graph = corpus.dev_user_history_graph if mode == 'dev' else corpus.test_user_history_graph
+        self.news_title_length = corpus.news_title_length
+        self.news_abstract_length = corpus.news_abstract_length
+        self.dynamic_padding = corpus.dynamic_padding
+        if corpus.graph_materialization == 'precomputed':
+            self.user_history_graph = corpus.dev_user_history_graph if mode == 'dev' else corpus.test_user_history_graph
+        else:
+            self.user_history_graph = corpus.dev_user_history_num if mode == 'dev' else corpus.test_user_history_num
+        self.user_history_graph_builder = UserHistoryGraph_Builder(corpus) if corpus.graph_materialization == 'batch' else None
         self.user_history_category_mask = corpus.dev_user_history_category_mask if mode == 'dev' else corpus.test_user_history_category_mask
         self.user_history_category_indices = corpus.dev_user_history_category_indices if mode == 'dev' else corpus.test_user_history_category_indices
         self.behaviors = corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors
         self.num = len(self.behaviors)
 
-    # user_ID                        : [1]
-    # user_category                  : [max_history_num]
-    # user_subCategory               : [max_history_num]
-    # user_title_text                : [max_history_num, max_title_length]
-    # user_title_mask                : [max_history_num, max_title_length]
-    # user_title_entity              : [max_history_num, max_title_length]
-    # user_abstract_text             : [max_history_num, max_abstract_length]
-    # user_abstract_mask             : [max_history_num, max_abstract_length]
-    # user_abstract_entity           : [max_history_num, max_abstract_length]
-    # user_history_mask              : [max_history_num]
-    # user_history_graph             : [max_history_num, max_history_num]
-    # user_history_category_mask     : [category_num + 1]
-    # user_history_category_indices  : [max_history_num]
-    # candidate_news_category        : [1]
-    # candidate_news_subCategory     : [1]
-    # candidate_news_title_text      : [max_title_length]
-    # candidate_news_title_mask      : [max_title_length]
-    # candidate_news_title_entity    : [max_title_lenght]
-    # candidate_news_abstract_text   : [max_abstract_length]
-    # candidate_news_abstract_mask   : [max_abstract_length]
-    # candidate_news_abstract_entity : [max_abstract_length]
-    def __getitem__(self, index):
-        behavior = self.behaviors[index]
-        history_index = behavior[1]
-        candidate_news_index = behavior[3]
-        behavior_index = behavior[4]
-        return behavior[0], self.news_category[history_index], self.news_subCategory[history_index], self.news_title_text[history_index], self.news_title_mask[history_index], self.news_title_entity[history_index], self.news_abstract_text[history_index], self.news_abstract_mask[history_index], self.news_abstract_entity[history_index], behavior[2], self.user_history_graph[behavior_index], self.user_history_category_mask[behavior_index], self.user_history_category_indices[behavior_index], \
-               self.news_category[candidate_news_index], self.news_subCategory[candidate_news_index], self.news_title_text[candidate_news_index], self.news_title_mask[candidate_news_index], self.news_title_entity[candidate_news_index], self.news_abstract_text[candidate_news_index], self.news_abstract_mask[candidate_news_index], self.news_abstract_entity[candidate_news_index]
+    # A batch of samples is gathered at once, as in Train_Dataset
+    # Input
+    # indices                        : [batch_size]
+    # Output
+    # user_ID                        : [batch_size]
+    # user_category                  : [batch_size, max_history_num]
+    # user_subCategory               : [batch_size, max_history_num]
+    # user_title_text                : [batch_size, max_history_num, max_title_length]
+    # user_title_mask                : [batch_size, max_history_num, max_title_length]
+    # user_title_entity              : [batch_size, max_history_num, max_title_length]
+    # user_abstract_text             : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_mask             : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_entity           : [batch_size, max_history_num, max_abstract_length]
+    # user_history_mask              : [batch_size, max_history_num]
+    # user_history_graph             : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask     : [batch_size, category_num + 1]
+    # user_history_category_indices  : [batch_size, max_history_num]
+    # candidate_news_category        : [batch_size]
+    # candidate_news_subCategory     : [batch_size]
+    # candidate_news_title_text      : [batch_size, max_title_length]
+    # candidate_news_title_mask      : [batch_size, max_title_length]
+    # candidate_news_title_entity    : [batch_size, max_title_length]
+    # candidate_news_abstract_text   : [batch_size, max_abstract_length]
+    # candidate_news_abstract_mask   : [batch_size, max_abstract_length]
+    # candidate_news_abstract_entity : [batch_size, max_abstract_length]
+    def __getitem__(self, indices):
+        indices = np.asarray(indices)
+        behavior_index = self.behaviors.behavior_index[indices]
+        history_index, user_history_mask = self.behaviors.histories(behavior_index, trim=self.dynamic_padding)
+        candidate_news_index = self.behaviors.candidate_news[indices]
+        return gather_user_history(self, self.behaviors.user_ID[indices], behavior_index, history_index, user_history_mask) + gather_news(self, candidate_news_index)
+
+    def __len__(self):
+        return self.num
+
+
+
+# Impression-level dev/test dataset: each sample is one impression, so the user history is encoded once for all of its candidate news
+# A batch of impressions is gathered at once (with the batches of CandidateNum_BatchSampler), and the candidate news are padded (with news 0) to the largest candidate number of the batch
+# With precomputed_news, only the news indices of the user history and candidates are returned, to be gathered from precomputed news representations
+class DevTest_Impression_Dataset(data.Dataset):
+    def __init__(self, corpus: Corpus, mode: str, precomputed_news=False):
+        assert mode in ['dev', 'test'], 'mode must be chosen from \'dev\' or \'test\''
+        self.precomputed_news = precomputed_news
+        self.news_category = corpus.news_category
+        self.news_subCategory = corpus.news_subCategory
+        self.news_title_text =  corpus.news_title_text
+        self.news_title_mask = corpus.news_title_mask
+        self.news_title_entity = corpus.news_title_entity
+        self.news_abstract_text =  corpus.news_abstract_text
+        self.news_abstract_mask = corpus.news_abstract_mask
+        self.news_abstract_entity = corpus.news_abstract_entity
+        self.news_title_length = corpus.news_title_length
+        self.news_abstract_length = corpus.news_abstract_length
+        self.dynamic_padding = corpus.dynamic_padding
+        if corpus.graph_materialization == 'precomputed':
+            self.user_history_graph = corpus.dev_user_history_graph if mode == 'dev' else corpus.test_user_history_graph
+        else:
+            self.user_history_graph = corpus.dev_user_history_num if mode == 'dev' else corpus.test_user_history_num
+        self.user_history_graph_builder = UserHistoryGraph_Builder(corpus) if corpus.graph_materialization == 'batch' else None
+        self.user_history_category_mask = corpus.dev_user_history_category_mask if mode == 'dev' else corpus.test_user_history_category_mask
+        self.user_history_category_indices = corpus.dev_user_history_category_indices if mode == 'dev' else corpus.test_user_history_category_indices
+        self.behaviors = corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors
+        self.candidate_offsets = self.behaviors.candidate_offsets
+        self.candidate_num = self.behaviors.candidate_num
+        self.num = len(self.candidate_num)
+
+    # Input
+    # indices                       : [batch_size] (impression indices)
+    # Output
+    # user_ID                       : [batch_size]
+    # user_category                 : [batch_size, max_history_num]
+    # user_subCategory              : [batch_size, max_history_num]
+    # user_title_text               : [batch_size, max_history_num, max_title_length]
+    # user_title_mask               : [batch_size, max_history_num, max_title_length]
+    # user_title_entity             : [batch_size, max_history_num, max_title_length]
+    # user_abstract_text            : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_mask            : [batch_size, max_history_num, max_abstract_length]
+    # user_abstract_entity          : [batch_size, max_history_num, max_abstract_length]
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num + 1]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # candidate_news_*              : [batch_size, candidate_num, ...] (candidate_num is the largest candidate number of the batch)
+    # candidate_index               : [batch_size, candidate_num] (row index of each candidate in the dev/test behaviors)
+    # candidate_mask                : [batch_size, candidate_num]
+    # (with precomputed_news, the history news features are replaced by user_history : [batch_size, max_history_num], and candidate_news_* by candidate_news : [batch_size, candidate_num])
+    def __getitem__(self, indices):
+        indices = np.asarray(indices)
+        history_index, user_history_mask = self.behaviors.histories(indices, trim=self.dynamic_padding)
+        user_ID = self.behaviors.user_ID[self.candidate_offsets[indices]]
+        candidate_num = self.candidate_num[indices]                                                                                        # [batch_size]
+        candidate_range = np.arange(candidate_num.max())                                                                                  # [candidate_num]
+        candidate_mask = candidate_range[np.newaxis, :] < candidate_num[:, np.newaxis]                                                    # [batch_size, candidate_num]
+        candidate_index = np.where(candidate_mask, self.candidate_offsets[indices][:, np.newaxis] + candidate_range, 0)                  # [batch_size, candidate_num]
+        candidate_news = np.where(candidate_mask, self.behaviors.candidate_news[candidate_index], 0)                                      # [batch_size, candidate_num]
+        if self.precomputed_news:
+            return (torch.from_numpy(user_ID.astype(np.int64)), torch.from_numpy(history_index), torch.from_numpy(user_history_mask)) + gather_user_history_graph(self, indices, history_index.shape[1]) + \
+                   (torch.from_numpy(candidate_news), torch.from_numpy(candidate_index), torch.from_numpy(candidate_mask))
+        return gather_user_history(self, user_ID, indices, history_index, user_history_mask) + gather_news(self, candidate_news) + (torch.from_numpy(candidate_index), torch.from_numpy(candidate_mask))
 
     def __len__(self):
         return self.num
 
 
+# Batch sampler that buckets impressions by candidate number
+# Impressions are visited in ascending candidate number (then ascending history number, if given), and a batch is closed once its padded candidate slots (impression num * largest candidate num) would exceed max_candidate_num,
+# or once it holds max_impression_num impressions (either bound is ignored if None)
+# An impression with more than max_candidate_num candidates forms a batch on its own
+class CandidateNum_BatchSampler(data.Sampler):
+    def __init__(self, candidate_num, max_candidate_num=None, history_num=None, max_impression_num=None):
+        assert max_candidate_num is not None or max_impression_num is not None, 'the batches must be bounded by candidate slots or impressions'
+        self.batches = []
+        batch = []
+        for index in (np.argsort(candidate_num, kind='stable') if history_num is None else np.lexsort((history_num, candidate_num))):
+            if len(batch) > 0 and ((max_candidate_num is not None and (len(batch) + 1) * candidate_num[index] > max_candidate_num) or len(batch) == max_impression_num):
+                self.batches.append(batch)
+                batch = []
+            batch.append(int(index))
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+# Batch sampler that buckets samples by length, so that the batches trimmed by dynamic padding hold little padding
+# The indices of the sampler are read in pools of bucket_batch_num batches, each pool is sorted by descending length and cut into batches, and the batches of a pool are yielded in random order
+# (with descending lengths in each batch, the packed GRUs of the user encoders need no sort)
+class LengthBucket_BatchSampler(data.Sampler):
+    def __init__(self, sampler: data.Sampler, lengths, batch_size: int, bucket_batch_num: int = 100):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_batch_num = bucket_batch_num
+
+    def __iter__(self):
+        indices = iter(self.sampler)
+        while True:
+            pool = np.fromiter(itertools.islice(indices, self.batch_size * self.bucket_batch_num), dtype=np.int64)
+            if len(pool) == 0:
+                break
+            pool = pool[np.argsort(-self.lengths[pool], kind='stable')]
+            batches = [pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+            for i in torch.randperm(len(batches)).tolist():
+                yield batches[i]
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
 if __name__ == '__main__':
     start_time = time.time()
     config = Config()
@@ -141,11 +404,11 @@ if __name__ == '__main__':
     train_dataset = Train_Dataset(dataset_corpus)
     dev_dataset = DevTest_Dataset(dataset_corpus, 'dev')
     test_dataset = DevTest_Dataset(dataset_corpus, 'test')
-    train_dataset.negative_sampling()
+    train_dataset.negative_sampling(1)
     end_time = time.time()
     print('load time : %.3fs' % (end_time - start_time))
     print('Train_Dataset :', len(train_dataset))
-    train_dataloader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True, num_workers=config.batch_size // 16)
+    train_dataloader = DataLoader(train_dataset, batch_size=None, sampler=data.BatchSampler(data.RandomSampler(train_dataset), config.batch_size, drop_last=False), num_workers=config.batch_size // 16)
     for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in train_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
@@ -171,7 +434,7 @@ if __name__ == '__main__':
         print('news_abstract_entity', news_abstract_entity.size(), news_abstract_entity.dtype)
         break
     print('Dev_Dataset :', len(dev_dataset))
-    dev_dataloader = DataLoader(dev_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.batch_size // 16)
+    dev_dataloader = DataLoader(dev_dataset, batch_size=None, sampler=data.BatchSampler(data.SequentialSampler(dev_dataset), config.batch_size, drop_last=False), num_workers=config.batch_size // 16)
     for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in dev_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
@@ -198,7 +461,7 @@ if __name__ == '__main__':
         break
     print(len(dataset_corpus.dev_indices))
     print('Test_Dataset :', len(test_dataset))
-    test_dataloader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=False, num_workers=config.batch_size // 16)
+    test_dataloader = DataLoader(test_dataset, batch_size=None, sampler=data.BatchSampler(data.SequentialSampler(test_dataset), config.batch_size, drop_last=False), num_workers=config.batch_size // 16)
     for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_abstract_text, user_abstract_mask, user_abstract_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
          news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_abstract_text, news_abstract_mask, news_abstract_entity) in test_dataloader:
         print('user_ID', user_ID.size(), user_ID.dtype)
@@ -1,53 +1,115 @@
 #!/usr/bin/env python
 import sys, os, os.path
+import argparse
+import collections
+import itertools
+import multiprocessing
 import numpy as np
 import json
-from sklearn.metrics import roc_auc_score
-
-def dcg_score(y_true, y_score, k=10):
-    order = np.argsort(y_score)[::-1]
-    y_true = np.take(y_true, order[:k])
-    gains = 2 ** y_true - 1
-    discounts = np.log2(np.arange(len(y_true)) + 2)
-    return np.sum(gains / discounts)
-    
 
-def ndcg_score(y_true, y_score, k=10):
-    best = dcg_score(y_true, y_true, k)
-    actual = dcg_score(y_true, y_score, k)
-    return actual / best
 
+# Rank of each candidate within its impression (1 for the highest score); ties keep the candidate order, as the stable reverse sort of the rank file does
+# Input
+# scores             : [candidate_num]
+# impression_offsets : [impression_num + 1] (candidates of impression i are [impression_offsets[i], impression_offsets[i + 1]))
+# Output
+# ranks              : [candidate_num]
+def impression_ranks(scores, impression_offsets):
+    candidate_num = np.diff(impression_offsets)                                                                          # [impression_num]
+    impression_ID = np.repeat(np.arange(len(candidate_num)), candidate_num)                                              # [candidate_num]
+    order = np.lexsort((np.arange(len(scores)), -scores, impression_ID))                                                 # [candidate_num]
+    ranks = np.empty([len(scores)], dtype=np.int64)
+    ranks[order] = np.arange(len(scores)) - np.repeat(impression_offsets[:-1], candidate_num) + 1
+    return ranks
+
+
+# AUC, MRR, nDCG@5 and nDCG@10 of each impression, computed over the flat candidates of all impressions with one global lexsort and segmented sums
+# Same AUC as sklearn's roc_auc_score (tied scores share their average rank), and same MRR / nDCG as the former per-impression functions of the MIND scorer for distinct scores
+# Tied scores are ordered by the reversed stable argsort (the later candidate first) : the former functions used numpy's default unstable argsort, whose tie order is unspecified
+# Impressions without candidates are ignored, as the masked impressions of the truth file
+# Input
+# labels             : [candidate_num]
+# scores             : [candidate_num] (higher is better)
+# impression_offsets : [impression_num + 1] (candidates of impression i are [impression_offsets[i], impression_offsets[i + 1]))
+# Output
+# auc, mrr, ndcg5, ndcg10 : [valid_impression_num]
+def impression_metrics(labels, scores, impression_offsets):
+    candidate_num = np.diff(impression_offsets)                                                                          # [impression_num]
+    impression_num = len(candidate_num)
+    valid = candidate_num > 0
+    impression_ID = np.repeat(np.arange(impression_num), candidate_num)                                                  # [candidate_num]
+    impression_start = np.repeat(impression_offsets[:-1], candidate_num)                                                 # [candidate_num]
+    labels = np.asarray(labels, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    n = candidate_num.astype(np.float64)
+    positive_num = np.bincount(impression_ID, weights=labels, minlength=impression_num)                                  # [impression_num]
+    negative_num = n - positive_num
+    if np.any(((positive_num == 0) | (negative_num == 0)) & valid):
+        raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+    # candidates sorted by impression, then by descending score (tied scores in reversed candidate order)
+    order = np.lexsort((-np.arange(len(scores)), -scores, impression_ID))                                               # [candidate_num]
+    sorted_labels = labels[order]                                                                                        # [candidate_num]
+    sorted_scores = scores[order]                                                                                        # [candidate_num]
+    position = np.arange(len(scores)) - impression_start                                                                 # [candidate_num] (0 for the highest score)
+    # rank-sum AUC : a candidate scores above the candidates of lower ascending rank, tied candidates share their average rank
+    tie_start = np.ones([len(scores)], dtype=bool)
+    tie_start[1:] = (sorted_scores[1:] != sorted_scores[:-1]) | (impression_ID[1:] != impression_ID[:-1])
+    tie_group = np.cumsum(tie_start) - 1                                                                                 # [candidate_num]
+    tie_group_start = np.flatnonzero(tie_start)                                                                          # [tie_group_num]
+    tie_group_end = np.append(tie_group_start[1:], len(scores)) - 1                                                      # [tie_group_num]
+    average_position = (tie_group_start + tie_group_end)[tie_group] / 2 - impression_start                               # [candidate_num]
+    positive_rank_sum = np.bincount(impression_ID, weights=sorted_labels * (n[impression_ID] - average_position), minlength=impression_num)
+    auc = (positive_rank_sum - positive_num * (positive_num + 1) / 2)[valid] / (positive_num * negative_num)[valid]
+    mrr = np.bincount(impression_ID, weights=sorted_labels / (position + 1), minlength=impression_num)[valid] / positive_num[valid]
+    # ideal DCG : labels sorted in descending order within each impression
+    ideal_labels = labels[np.lexsort((-labels, impression_ID))]                                                          # [candidate_num]
+    gains = 2 ** sorted_labels - 1
+    ideal_gains = 2 ** ideal_labels - 1
+    discounts = np.log2(position + 2)
+    ndcgs = []
+    for k in [5, 10]:
+        dcg = np.bincount(impression_ID, weights=gains * (position < k) / discounts, minlength=impression_num)
+        ideal_dcg = np.bincount(impression_ID, weights=ideal_gains * (position < k) / discounts, minlength=impression_num)
+        ndcgs.append(dcg[valid] / ideal_dcg[valid])
+    return auc, mrr, ndcgs[0], ndcgs[1]
+
+
+# AUC, MRR, nDCG@5 and nDCG@10 averaged over impressions
+# Input
+# labels             : [candidate_num] (0 or 1)
+# ranks              : [candidate_num] (1 for the top-ranked candidate of each impression)
+# impression_offsets : [impression_num + 1]
+def ranking_metrics(labels, ranks, impression_offsets):
+    auc, mrr, ndcg5, ndcg10 = impression_metrics(labels, 1. / np.asarray(ranks, dtype=np.float64), impression_offsets)
+    return np.mean(auc), np.mean(mrr), np.mean(ndcg5), np.mean(ndcg10)
 
-def mrr_score(y_true, y_score):
-    order = np.argsort(y_score)[::-1]
-    y_true = np.take(y_true, order)
-    rr_score = y_true / (np.arange(len(y_true)) + 1)
-    return np.sum(rr_score) / np.sum(y_true)
 
 def parse_line(l):
     impid, ranks = l.strip('\n').split()
     ranks = json.loads(ranks)
     return impid, ranks
 
-def scoring(truth_f, sub_f):
-    aucs = []
-    mrrs = []
-    ndcg5s = []
-    ndcg10s = []
+# Truth and rank lines are parsed and checked line by line (line_index counts the unmasked lines, as in the error messages of the MIND scorer)
+# Output
+# labels             : [candidate_num]
+# ranks              : [candidate_num]
+# impression_offsets : [impression_num + 1]
+def parse_lines(truth_lines, sub_lines, line_index=1):
+    labels = []
+    ranks = []
+    candidate_nums = []
     
-    line_index = 1
-    for lt in truth_f:
-        ls = sub_f.readline()
-        impid, labels = parse_line(lt)
+    for lt, ls in zip(truth_lines, sub_lines):
+        impid, line_labels = parse_line(lt)
         
         # ignore masked impressions
-        if labels == []:
+        if line_labels == []:
             continue 
         
         if ls == '':
             # empty line: filled with 0 ranks
             sub_impid = impid
-            sub_ranks = [1] * len(labels)
+            sub_ranks = [1] * len(line_labels)
         else:
             try:
                 sub_impid, sub_ranks = parse_line(ls)
@@ -61,37 +123,81 @@ def scoring(truth_f, sub_f):
                 impid
             ))        
         
-        lt_len = float(len(labels))
+        if len(sub_ranks) != len(line_labels):
+            raise ValueError("line-{}: Inconsistent Number of Ranks {} and Labels {}".format(
+                line_index,
+                len(sub_ranks),
+                len(line_labels)
+            ))
         
-        y_true =  np.array(labels,dtype='float32')
-        y_score = []
-        for rank in sub_ranks:
-            score_rslt = 1./rank
-            if score_rslt < 0 or score_rslt > 1:
-                raise ValueError("Line-{}: score_rslt should be int from 0 to {}".format(
-                    line_index,
-                    lt_len
-                ))
-            y_score.append(score_rslt)
-            
-        auc = roc_auc_score(y_true,y_score)
-        mrr = mrr_score(y_true,y_score)
-        ndcg5 = ndcg_score(y_true,y_score,5)
-        ndcg10 = ndcg_score(y_true,y_score,10)
+        if min(sub_ranks) < 1:
+            raise ValueError("Line-{}: score_rslt should be int from 0 to {}".format(
+                line_index,
+                float(len(line_labels))
+            ))
         
-        aucs.append(auc)
-        mrrs.append(mrr)
-        ndcg5s.append(ndcg5)
-        ndcg10s.append(ndcg10)
+        labels.extend(line_labels)
+        ranks.extend(sub_ranks)
+        candidate_nums.append(len(line_labels))
         
         line_index += 1
 
-    return np.mean(aucs), np.mean(mrrs), np.mean(ndcg5s), np.mean(ndcg10s)
+    impression_offsets = np.concatenate([[0], np.cumsum(candidate_nums, dtype=np.int64)])
+    return np.array(labels, dtype=np.float64), np.array(ranks, dtype=np.float64), impression_offsets
+
+
+# The metrics are computed once over the concatenated impressions
+def scoring(truth_f, sub_f):
+    # a missing rank line reads as '' (filled with rank 1)
+    labels, ranks, impression_offsets = parse_lines(truth_f, iter(sub_f.readline, None))
+    return ranking_metrics(labels, ranks, impression_offsets)
+
+
+# Metric sums and the number of unmasked impressions of a chunk of aligned truth and rank lines
+def scoring_chunk(chunk):
+    truth_lines, sub_lines, line_index = chunk
+    labels, ranks, impression_offsets = parse_lines(truth_lines, sub_lines, line_index)
+    auc, mrr, ndcg5, ndcg10 = impression_metrics(labels, 1. / ranks, impression_offsets)
+    return np.array([np.sum(auc), np.sum(mrr), np.sum(ndcg5), np.sum(ndcg10)]), len(auc)
+
+
+# Streaming scorer for large files : chunks of chunk_line_num aligned truth and rank lines are scored by a process pool and the metric sums are reduced
+# At most 2 * worker_num chunks are read ahead of the reduction, so that memory does not grow with the file size
+def streaming_scoring(truth_f, sub_f, worker_num, chunk_line_num=100000):
+    metric_sum = np.zeros([4], dtype=np.float64)
+    impression_num = 0
+    line_index = 1
+    pending = collections.deque()
+    with multiprocessing.Pool(worker_num) as pool:
+        while True:
+            truth_lines = list(itertools.islice(truth_f, chunk_line_num))
+            if len(truth_lines) == 0:
+                break
+            sub_lines = [sub_f.readline() for _ in range(len(truth_lines))]
+            pending.append(pool.apply_async(scoring_chunk, ((truth_lines, sub_lines, line_index), )))
+            # masked impressions ('[]' labels) do not count in the line index of the error messages
+            line_index += sum(1 for lt in truth_lines if not lt.rstrip().endswith('[]'))
+            if len(pending) >= 2 * worker_num:
+                chunk_sum, chunk_impression_num = pending.popleft().get()
+                metric_sum += chunk_sum
+                impression_num += chunk_impression_num
+        while len(pending) > 0:
+            chunk_sum, chunk_impression_num = pending.popleft().get()
+            metric_sum += chunk_sum
+            impression_num += chunk_impression_num
+    auc, mrr, ndcg5, ndcg10 = metric_sum / impression_num
+    return auc, mrr, ndcg5, ndcg10
         
 
 if __name__ == '__main__':
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+    parser = argparse.ArgumentParser(description='MIND ranking scorer')
+    parser.add_argument('input_dir', type=str, help='Directory of ref/truth.txt and res/prediction.txt')
+    parser.add_argument('output_dir', type=str, help='Directory of scores.txt')
+    parser.add_argument('--workers', type=int, default=0, help='Number of scoring processes of the streaming scorer (0 for the sequential scorer)')
+    parser.add_argument('--chunk_lines', type=int, default=100000, help='Number of impression lines of each chunk of the streaming scorer')
+    args = parser.parse_args()
+    input_dir = args.input_dir
+    output_dir = args.output_dir
 
     submit_dir = os.path.join(input_dir, 'res') 
     truth_dir = os.path.join(input_dir, 'ref')
@@ -109,7 +215,10 @@ if __name__ == '__main__':
         truth_file = open(os.path.join(truth_dir, "truth.txt"), 'r')
         submission_answer_file = open(os.path.join(submit_dir, "prediction.txt"), 'r')
         
-        auc, mrr, ndcg, ndcg10 = scoring(truth_file, submission_answer_file)
+        if args.workers > 0:
+            auc, mrr, ndcg, ndcg10 = streaming_scoring(truth_file, submission_answer_file, args.workers, args.chunk_lines)
+        else:
+            auc, mrr, ndcg, ndcg10 = scoring(truth_file, submission_answer_file)
 
         output_file.write("AUC:{:.4f}\nMRR:{:.4f}\nnDCG@5:{:.4f}\nnDCG@10:{:.4f}".format(auc, mrr, ndcg, ndcg10))
         output_file.close()
@@ -98,12 +98,10 @@ class Conv2D_Pool(nn.Module):
             return torch.cat([conv1_relu_pool, conv2_relu_pool, conv3_relu_pool, conv4_relu_pool], dim=1)
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, h, d_model, len_q, len_k, d_k, d_v):
+    def __init__(self, h, d_model, d_k, d_v):
         super(MultiHeadAttention, self).__init__()
         self.h = h                  # head_num                  O
         self.d_model = d_model      # word_embedding_dim        O
-        self.len_q = len_q          # max_title_length
-        self.len_k = len_k          # max_title_length
         self.d_k = d_k              # head_dim                  O
         self.d_v = d_v              # head_dim                  O
         self.out_dim = self.h * self.d_v
@@ -120,6 +118,7 @@ class MultiHeadAttention(nn.Module):
         nn.init.xavier_uniform_(self.W_V.weight)
         nn.init.zeros_(self.W_V.bias)
 
+    # len_q and len_k are taken from the inputs, so that batches trimmed to their longest sequence can be attended
     # Input
     # Q    : [batch_size, len_q, d_model]
     # K    : [batch_size, len_k, d_model]
@@ -129,20 +128,22 @@ class MultiHeadAttention(nn.Module):
     # out  : [batch_size, len_q, h * d_v]
     def forward(self, Q, K, V, mask=None):
         batch_size = Q.size(0)
-        Q = self.W_Q(Q).view([batch_size, self.len_q, self.h, self.d_k])                                           # [batch_size, len_q, h, d_k]
-        K = self.W_K(K).view([batch_size, self.len_k, self.h, self.d_k])                                           # [batch_size, len_k, h, d_k]
-        V = self.W_V(V).view([batch_size, self.len_k, self.h, self.d_v])                                           # [batch_size, len_k, h, d_v]
-        Q = Q.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_q, self.d_k])                   # [batch_size * h, len_q, d_k]
-        K = K.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_k, self.d_k])                   # [batch_size * h, len_k, d_k]
-        V = V.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, self.len_k, self.d_v])                   # [batch_size * h, len_k, d_v]
+        len_q = Q.size(1)
+        len_k = K.size(1)
+        Q = self.W_Q(Q).view([batch_size, len_q, self.h, self.d_k])                                                # [batch_size, len_q, h, d_k]
+        K = self.W_K(K).view([batch_size, len_k, self.h, self.d_k])                                                # [batch_size, len_k, h, d_k]
+        V = self.W_V(V).view([batch_size, len_k, self.h, self.d_v])                                                # [batch_size, len_k, h, d_v]
+        Q = Q.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_q, self.d_k])                        # [batch_size * h, len_q, d_k]
+        K = K.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_k, self.d_k])                        # [batch_size * h, len_k, d_k]
+        V = V.permute(0, 2, 1, 3).contiguous().view([batch_size * self.h, len_k, self.d_v])                        # [batch_size * h, len_k, d_v]
         A = torch.bmm(Q, K.permute(0, 2, 1).contiguous()) / self.attention_scalar                                  # [batch_size * h, len_q, len_k]
         if mask != None:
-            _mask = mask.repeat([1, self.h]).view([batch_size * self.h, 1, self.len_k]).repeat([1, self.len_q, 1]) # [batch_size * h, len_q, len_k]
+            _mask = mask.repeat([1, self.h]).view([batch_size * self.h, 1, len_k]).repeat([1, len_q, 1])           # [batch_size * h, len_q, len_k]
             alpha = F.softmax(A.masked_fill(_mask == 0, -1e9), dim=2)                                              # [batch_size * h, len_q, len_k]
         else:
             alpha = F.softmax(A, dim=2)                                                                            # [batch_size * h, len_q, len_k]
-        out = torch.bmm(alpha, V).view([batch_size, self.h, self.len_q, self.d_v])                                 # [batch_size, h, len_q, d_v]
-        out = out.permute([0, 2, 1, 3]).contiguous().view([batch_size, self.len_q, self.out_dim])                  # [batch_size, len_q, h * d_v]
+        out = torch.bmm(alpha, V).view([batch_size, self.h, len_q, self.d_v])                                      # [batch_size, h, len_q, d_v]
+        out = out.permute([0, 2, 1, 3]).contiguous().view([batch_size, len_q, self.out_dim])                       # [batch_size, len_q, h * d_v]
         return out
 
 
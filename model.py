@@ -94,6 +94,15 @@ class Model(nn.Module):
             assert config.news_encoder == 'HDC' and config.user_encoder == 'FIM', 'HDC and FIM must be paired and can not be used alone'
             assert config.click_predictor == 'FIM', 'For the model FIM, the click predictor must be specially set as \'FIM\''
         self.click_predictor = config.click_predictor
+        # news representations can be precomputed for evaluation unless they depend on the user (PNE) or are not single vectors (HDC)
+        self.news_precomputable = config.news_encoder not in ['PNE', 'HDC']
+        # likewise, the news of a training batch can be encoded once as a unique set
+        assert not (config.unique_news_batching or config.in_batch_negatives) or self.news_precomputable, 'Unique news batching requires news representations that do not depend on the user'
+        assert not config.in_batch_negatives or self.click_predictor == 'dot_product', 'In-batch negatives require the dot-product click predictor'
+        assert not config.history_cache or self.news_precomputable, 'The history news cache requires news representations that do not depend on the user'
+        assert config.body_freeze_epoch <= 0 or config.news_encoder in ['CIDER', 'CNE', 'NAML'], 'The body branch can only be frozen for the news encoders CIDER, CNE and NAML'
+        # the knowledge-aware CNN pools over the windows before the trailing padding, and HDC & FIM use fixed text and history lengths
+        assert not config.dynamic_padding or (config.news_encoder not in ['KCNN', 'HDC'] and config.user_encoder != 'FIM'), 'Dynamic padding is not supported by the news encoders KCNN & HDC and the user encoder FIM'
         
         if self.click_predictor == 'mlp':
             self.mlp = nn.Linear(in_features=self.news_embedding_dim * 2, out_features=self.news_embedding_dim // 2, bias=True)
@@ -125,12 +134,35 @@ class Model(nn.Module):
             nn.init.xavier_uniform_(self.fc.weight)
             nn.init.zeros_(self.fc.bias)
 
+    # With history_news_index and candidate_news_index (unique-news batches), news_* hold the unique news of the batch [unique_news_num, ...], which are encoded once
+    # and gathered into the history [batch_size, max_history_num] and candidate [batch_size, 1 + negative_sample_num] slots; user_category ... user_content_entity are then unused
+    # With history_embedding (history news cache), the history news representations [batch_size, max_history_num, news_embedding_dim] are given and only the candidate news_* are encoded
     def forward(self, user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                      news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity):
+                      news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, history_news_index=None, candidate_news_index=None, history_embedding=None):
         user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None                                                                                                         # [batch_size, news_embedding_dim]
-        news_representation = self.news_encoder(news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, news_category, news_subCategory, user_embedding) # [batch_size, 1 + negative_sample_num, news_embedding_dim]
-        user_representation = self.user_encoder(user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                                                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, news_representation)                           # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+        if history_news_index is not None:
+            unique_news_representation = self.news_encoder(news_title_text.unsqueeze(dim=0), news_title_mask.unsqueeze(dim=0), news_title_entity.unsqueeze(dim=0), news_content_text.unsqueeze(dim=0), news_content_mask.unsqueeze(dim=0), \
+                                                           news_content_entity.unsqueeze(dim=0), news_category.unsqueeze(dim=0), news_subCategory.unsqueeze(dim=0), None).squeeze(dim=0)                         # [unique_news_num, news_embedding_dim]
+            news_representation = unique_news_representation[candidate_news_index]                                                                                                                           # [batch_size, 1 + negative_sample_num, news_embedding_dim] ([batch_size + shared_negative_num, news_embedding_dim] with in-batch negatives)
+            user_state = self.user_encoder.history_state(unique_news_representation[history_news_index], user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)
+            if candidate_news_index.dim() == 1:
+                return self.in_batch_click_predict(user_state, news_representation, candidate_news_index, user_ID.size(0))
+        elif history_embedding is not None:
+            news_representation = self.news_encoder(news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, news_category, news_subCategory, None)       # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+            user_state = self.user_encoder.history_state(history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)
+        else:
+            news_representation = self.news_encoder(news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, news_category, news_subCategory, user_embedding) # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+            user_state = self.user_encoder.encode_history(user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
+                                                          user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)                                      # history-only user state
+        user_representation = self.user_encoder.attend(user_state, news_representation)                                                                                                                     # [batch_size, 1 + negative_sample_num, news_embedding_dim]
+        return self.click_predict(user_representation, news_representation)
+
+    # Input
+    # user_representation : [batch_size, news_num, news_embedding_dim]
+    # news_representation : [batch_size, news_num, news_embedding_dim]
+    # Output
+    # logits              : [batch_size, news_num]
+    def click_predict(self, user_representation, news_representation):
         if self.click_predictor == 'dot_product':
             logits = (user_representation * news_representation).sum(dim=2) # dot-product
         elif self.click_predictor == 'mlp':
@@ -139,3 +171,42 @@ class Model(nn.Module):
         elif self.click_predictor == 'FIM':
             logits = self.fc(user_representation).squeeze(dim=2)
         return logits
+
+    # In-batch negatives : every user is scored against the candidates shared by the batch (the click news of all samples, then the shared negatives)
+    # The click news of the i-th sample is the i-th candidate; the other candidates that are the same news are masked out
+    # Input
+    # user_state           : output of user_encoder.history_state
+    # news_representation  : [batch_size + shared_negative_num, news_embedding_dim]
+    # candidate_news_index : [batch_size + shared_negative_num] (equal indices are the same news)
+    # batch_size           : int
+    # Output
+    # logits               : [batch_size, batch_size + shared_negative_num]
+    def in_batch_click_predict(self, user_state, news_representation, candidate_news_index, batch_size):
+        if not self.user_encoder.candidate_aware:
+            logits = torch.mm(user_state['user_representation'], news_representation.t())                                                     # [batch_size, batch_size + shared_negative_num]
+        else:
+            candidate_news_representation = news_representation.unsqueeze(dim=0).expand(batch_size, -1, -1)                                 # [batch_size, batch_size + shared_negative_num, news_embedding_dim]
+            logits = self.click_predict(self.user_encoder.attend(user_state, candidate_news_representation), candidate_news_representation) # [batch_size, batch_size + shared_negative_num]
+        duplicate_mask = candidate_news_index.unsqueeze(dim=0) == candidate_news_index[:batch_size].unsqueeze(dim=1)                         # [batch_size, batch_size + shared_negative_num]
+        duplicate_mask[:, :batch_size].fill_diagonal_(False)
+        return logits.masked_fill(duplicate_mask, -1e9)
+
+    # Scoring with precomputed news representations (for evaluation, requires news_precomputable)
+    # Input
+    # user_ID                       : [batch_size]
+    # history_embedding             : [batch_size, max_history_num, news_embedding_dim]
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # news_representation           : [batch_size, news_num, news_embedding_dim]
+    # Output
+    # logits                        : [batch_size, news_num]
+    def score(self, user_ID, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, news_representation):
+        user_embedding = self.dropout(self.user_embedding(user_ID)) if self.use_user_embedding else None
+        user_state = self.user_encoder.history_state(history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)
+        if not self.user_encoder.candidate_aware and self.click_predictor == 'dot_product':
+            # the user representation is shared by all candidates, so all candidates are scored with a matmul
+            return torch.bmm(news_representation, user_state['user_representation'].unsqueeze(dim=2)).squeeze(dim=2) # [batch_size, news_num]
+        user_representation = self.user_encoder.attend(user_state, news_representation)                              # [batch_size, news_num, news_embedding_dim]
+        return self.click_predict(user_representation, news_representation)
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*- 
-import pickle
 import math
 # import numpy as np
 # from torchtext.data.utils import get_tokenizer
 # from torchtext.vocab import build_vocab_from_iterator
 # import sys
 from config import Config
+from artifact_store import ArtifactStore
 import torch
 import torch.nn as nn
 from torch import Tensor
@@ -15,14 +15,18 @@ from torch.nn.utils.rnn import pack_padded_sequence
 from torch.nn.utils.rnn import pad_packed_sequence
 from layers import Conv1D, Conv2D_Pool, MultiHeadAttention, Attention, ScaledDotProduct_CandidateAttention, CandidateAttention, ScaledDotProduct_Attention
 
+# Real word ratio of an evaluation batch below which the padding-aware transformers run as nested tensors
+# Measured on CPU (1 thread, 256 texts, 300 dimensions, 10 heads), the nested tensor is faster than the dense masked transformer up to about 62% of real words for 32 and 64 words, and 75% for 128 words
+# (4x faster at 10% of real words, 1.5-2x at 30%)
+NESTED_TENSOR_MAX_REAL_WORD_RATIO = 0.6
+
 class NewsEncoder(nn.Module):
     def __init__(self, config: Config):
         super(NewsEncoder, self).__init__()
         self.word_embedding_dim = config.word_embedding_dim
         self.category_num = config.category_num
         self.word_embedding = nn.Embedding(num_embeddings=config.vocabulary_size, embedding_dim=self.word_embedding_dim)
-        with open('word_embedding-' + str(config.word_threshold) + '-' + str(config.word_embedding_dim) + '-' + config.tokenizer + '-' + str(config.max_title_length) + '-' + str(config.max_abstract_length) + '-' + config.dataset + '.pkl', 'rb') as word_embedding_f:
-            self.word_embedding.weight.data.copy_(pickle.load(word_embedding_f))
+        self.word_embedding.weight.data.copy_(ArtifactStore().load_tensor(config.word_embedding_group, 'word_embedding'))
         self.category_embedding = nn.Embedding(num_embeddings=config.category_num, embedding_dim=config.category_embedding_dim)
         self.category_embedding.weight.requires_grad = False
         self.subCategory_embedding = nn.Embedding(num_embeddings=config.subCategory_num, embedding_dim=config.subCategory_embedding_dim)
@@ -30,12 +34,29 @@ class NewsEncoder(nn.Module):
         self.dropout = nn.Dropout(p=config.dropout_rate, inplace=True)
         self.dropout_ = nn.Dropout(p=config.dropout_rate, inplace=False)
         self.auxiliary_loss = None
+        # sub-modules of the body branch, which can be frozen with its outputs precomputed (see body_feature)
+        self.body_modules = []
+        self.body_feature_shape = None
 
     def initialize(self):
         nn.init.uniform_(self.category_embedding.weight, -0.1, 0.1)
         nn.init.uniform_(self.subCategory_embedding.weight, -0.1, 0.1)
         nn.init.zeros_(self.subCategory_embedding.weight[0])
 
+    def freeze_body(self):
+        for module_name in self.body_modules:
+            getattr(self, module_name).requires_grad_(False)
+
+    # Output of the body branch, which is precomputed for every news once the body branch is frozen
+    # The news encoder then receives the body features as content_text [batch_size, news_num, *body_feature_shape] (a floating-point tensor)
+    # Input
+    # content_text : [news_num, max_content_length]
+    # content_mask : [news_num, max_content_length]
+    # Output
+    # body_feature : [news_num, *body_feature_shape]
+    def body_feature(self, content_text, content_mask):
+        raise Exception('Function body_feature must be implemented at sub-class to freeze the body branch')
+
     # Input
     # title_text          : [batch_size, news_num, max_title_length]   # [64, 5, 32]
     # title_mask          : [batch_size, news_num, max_title_length]
@@ -68,20 +89,22 @@ class CIDER(NewsEncoder):
     def __init__(self, config: Config):
         super(CIDER, self).__init__(config)
 
-        self.max_title_length = config.max_title_length
-        self.max_body_length = config.max_abstract_length
         self.category_embedding_dim = config.category_embedding_dim
         self.intent_embedding_dim = config.intent_embedding_dim
         # self.news_embedding_dim = config.head_num * config.head_dim         # for MH-Attention (400)
         self.news_embedding_dim = config.intent_embedding_dim * 2 + config.category_embedding_dim + config.subCategory_embedding_dim
         
         # Transformer encoder
+        # with padding_aware_transformer, the padding words are masked and excluded from the mean pooling
+        # in evaluation, batches of less than NESTED_TENSOR_MAX_REAL_WORD_RATIO real words run as nested tensors without their padding words (which needs an even head number)
+        self.padding_aware_transformer = config.padding_aware_transformer
+        self.nested_tensor = self.padding_aware_transformer and config.head_num % 2 == 0
         self.title_pos_encoder = PositionalEncoding(config.word_embedding_dim, config.dropout_rate, config.max_title_length)
         self.body_pos_encoder = PositionalEncoding(config.word_embedding_dim, config.dropout_rate, config.max_abstract_length)
         title_encoder_layers = TransformerEncoderLayer(config.word_embedding_dim, config.head_num, config.feedforward_dim, config.dropout_rate, batch_first=True)   # head_num은 word_embedding_dim을 나눌 수 있어야 함
-        self.title_transformer = TransformerEncoder(title_encoder_layers, config.num_layers)
+        self.title_transformer = TransformerEncoder(title_encoder_layers, config.num_layers, enable_nested_tensor=self.nested_tensor)
         body_encoder_layers = TransformerEncoderLayer(config.word_embedding_dim, config.head_num, config.feedforward_dim, config.dropout_rate, batch_first=True)   # head_num은 word_embedding_dim을 나눌 수 있어야 함
-        self.body_transformer = TransformerEncoder(body_encoder_layers, config.num_layers)
+        self.body_transformer = TransformerEncoder(body_encoder_layers, config.num_layers, enable_nested_tensor=self.nested_tensor)
         
         # MAB(Multihead Attention Block) encoder
         # self.MAB = MAB(config.word_embedding_dim, 
@@ -97,8 +120,8 @@ class CIDER(NewsEncoder):
         #                  num_inds = config.isab_num_inds,          # The number of inducing points  4,  choices=[2, 4, 6, 8]
         #                  ln = True)
         
-        # self.title_multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.max_title_length, config.max_title_length, config.head_dim, config.head_dim)          # for MH-Attention
-        # self.body_multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.max_abstract_length, config.max_abstract_length, config.head_dim, config.head_dim)     # for MH-Attention
+        # self.title_multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.head_dim, config.head_dim)          # for MH-Attention
+        # self.body_multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.head_dim, config.head_dim)     # for MH-Attention
         # self.title_multiheadAttention = torch.nn.MultiheadAttention(config.word_embedding_dim, config.head_num, dropout=0.2, batch_first=True)
         # self.body_multiheadAttention = torch.nn.MultiheadAttention(config.word_embedding_dim, config.head_num, dropout=0.2, batch_first=True)
         
@@ -109,41 +132,105 @@ class CIDER(NewsEncoder):
         # self.title_intent_attention = ScaledDotProduct_Attention(config.intent_embedding_dim, config.category_embedding_dim, config.attention_dim)      # 230922
         self.title_intent_attention = Attention(config.intent_embedding_dim, config.attention_dim) 
         self.body_intent_attention = Attention(config.intent_embedding_dim, config.attention_dim)
-        self.intent_layers = nn.ModuleList([nn.Linear(config.word_embedding_dim
-                                                      + config.category_embedding_dim
-                                                      , config.intent_embedding_dim, bias=True) 
-                                            for _ in range(self.intent_num)])
+        # the k intent layers are stacked into one linear layer (intent i is the output block [i * intent_embedding_dim, (i + 1) * intent_embedding_dim))
+        self.intent_layer = nn.Linear(config.word_embedding_dim + config.category_embedding_dim, config.intent_embedding_dim * self.intent_num, bias=True)
         
         self.category_predictor = CategoryPredictor(config.intent_embedding_dim, config.category_num)
+        self.body_modules = ['word_embedding', 'body_pos_encoder', 'body_transformer']
+        self.body_feature_shape = (config.word_embedding_dim, )
 
     
     def initialize(self):
         super().initialize()
         self.title_intent_attention.initialize()
         self.body_intent_attention.initialize()
-        self.body_category_attention.initialize()
         # self.title_multiheadAttention.initialize()
         # self.body_multiheadAttention.initialize()
         nn.init.xavier_uniform_(self.category_affine.weight)
         nn.init.zeros_(self.category_affine.bias)
-        # Initialize each intent layer with different weights to learn different embedding for each intent
-        for intent_layer in self.intent_layers:
-            nn.init.xavier_uniform_(intent_layer.weight)
-            nn.init.zeros_(intent_layer.bias)
-
-    # Apply k-FC layer for k-intent disentanglement
-    def k_intent_disentangle(self, intent_num, news_embedding):                                        
-        k_intent_embeddings = []
-        for i in range(intent_num):
-            # Apply different linear transformations for each intent
-            intent_embedding = F.relu(self.intent_layers[i](news_embedding), inplace=True)      # [batch_size * news_num, intent_embedding_dim]     
-            # Expand the dimension (axis 1)
-            intent_embedding_exp = intent_embedding.unsqueeze(1)
-            k_intent_embeddings.append(intent_embedding_exp)
-        # Concatenate the k_intent_embeddings along the second axis (axis 1)
-        k_intent_embeddings = torch.cat(k_intent_embeddings, dim=1)                             # [batch_size * news_num, intent_length, intent_embedding_dim]
-
-        return k_intent_embeddings
+        # Initialize each intent block with different weights to learn different embedding for each intent
+        for i in range(self.intent_num):
+            nn.init.xavier_uniform_(self.intent_layer.weight[i * self.intent_embedding_dim:(i + 1) * self.intent_embedding_dim])
+        nn.init.zeros_(self.intent_layer.bias)
+
+    # Checkpoints of the former per-intent layers (intent_layers.i.weight & intent_layers.i.bias) are loaded into the stacked intent layer
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'intent_layers.0.weight' in state_dict:
+            state_dict[prefix + 'intent_layer.weight'] = torch.cat([state_dict.pop(prefix + 'intent_layers.%d.weight' % i) for i in range(self.intent_num)], dim=0)
+            state_dict[prefix + 'intent_layer.bias'] = torch.cat([state_dict.pop(prefix + 'intent_layers.%d.bias' % i) for i in range(self.intent_num)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Apply k-FC layer for k-intent disentanglement, as one GEMM for the title and body streams
+    # Input
+    # text_embedding          : [2, batch_size * news_num, word_embedding_dim] (title & body)
+    # category_representation : [batch_size * news_num, category_embedding_dim]
+    # Output
+    # k_intent_embeddings     : [2, batch_size * news_num, intent_num, intent_embedding_dim]
+    def k_intent_disentangle(self, text_embedding, category_representation):
+        batch_news_num = text_embedding.size(1)
+        category_aware_embedding = torch.cat([text_embedding, category_representation.unsqueeze(dim=0).expand(2, -1, -1)], dim=2)          # [2, batch_size * news_num, word_embedding_dim + category_embedding_dim]
+        k_intent_embeddings = F.relu(self.intent_layer(category_aware_embedding.view([2 * batch_news_num, -1])), inplace=True)            # [2 * batch_size * news_num, intent_num * intent_embedding_dim]
+        return k_intent_embeddings.view([2, batch_news_num, self.intent_num, self.intent_embedding_dim])
+
+    # Intent attention of the title and body streams at once, with the parameters of title_intent_attention and body_intent_attention stacked
+    # Input
+    # k_intent_embeddings : [2, batch_size * news_num, intent_num, intent_embedding_dim]
+    # Output
+    # intent_embedding    : [2, batch_size * news_num, intent_embedding_dim]
+    def intent_attention(self, k_intent_embeddings):
+        batch_news_num = k_intent_embeddings.size(1)
+        affine1_weight = torch.stack([self.title_intent_attention.affine1.weight, self.body_intent_attention.affine1.weight], dim=0)       # [2, attention_dim, intent_embedding_dim]
+        affine1_bias = torch.stack([self.title_intent_attention.affine1.bias, self.body_intent_attention.affine1.bias], dim=0)            # [2, attention_dim]
+        affine2_weight = torch.stack([self.title_intent_attention.affine2.weight, self.body_intent_attention.affine2.weight], dim=0)       # [2, 1, attention_dim]
+        feature = k_intent_embeddings.view([2, batch_news_num * self.intent_num, self.intent_embedding_dim])                              # [2, batch_size * news_num * intent_num, intent_embedding_dim]
+        attention = torch.tanh_(torch.baddbmm(affine1_bias.unsqueeze(dim=1), feature, affine1_weight.transpose(1, 2)))                    # [2, batch_size * news_num * intent_num, attention_dim]
+        a = torch.bmm(attention, affine2_weight.transpose(1, 2)).view([2 * batch_news_num, 1, self.intent_num])                           # [2 * batch_size * news_num, 1, intent_num]
+        alpha = F.softmax(a, dim=2)                                                                                                       # [2 * batch_size * news_num, 1, intent_num]
+        intent_embedding = torch.bmm(alpha, k_intent_embeddings.view([2 * batch_news_num, self.intent_num, self.intent_embedding_dim]))   # [2 * batch_size * news_num, 1, intent_embedding_dim]
+        return intent_embedding.view([2, batch_news_num, self.intent_embedding_dim])
+
+    # Transformer encoding with the padding words masked
+    # Nested tensors only pay off when enough words are padding (on batches of more than 70% real words, the masked padded kernels are faster),
+    # and batches without padding words (e.g. the length-sorted chunks of dynamic padding) skip the mask
+    # Input
+    # feature : [batch_size * news_num, length, word_embedding_dim]
+    # mask    : [batch_size * news_num, length]
+    # Output
+    # out     : [batch_size * news_num, length, word_embedding_dim]
+    def padding_aware_encode(self, transformer, feature, mask):
+        if self.training:
+            return transformer(feature, src_key_padding_mask=(mask == 0))
+        real_word_ratio = float(mask.float().mean())
+        if real_word_ratio == 1:
+            return transformer(feature)
+        if self.nested_tensor and real_word_ratio < NESTED_TENSOR_MAX_REAL_WORD_RATIO:
+            return transformer(feature, src_key_padding_mask=(mask == 0))
+        # denser batches run layer by layer, as the transformer converts every masked batch into a nested tensor when enable_nested_tensor is set
+        for layer in transformer.layers:
+            feature = layer(feature, src_key_padding_mask=(mask == 0))
+        return feature
+
+    # Body branch : positional encoding, transformer encoding and average pooling of the body words
+    # Input
+    # body_w         : [batch_size * news_num, max_body_length, word_embedding_dim]
+    # b_mask         : [batch_size * news_num, max_body_length]
+    # Output
+    # body_embedding : [batch_size * news_num, word_embedding_dim]
+    def encode_body(self, body_w, b_mask):
+        body_p = self.body_pos_encoder(body_w)                                                          # [batch_size * news_num, max_content_length, news_embedding_dim]
+        if self.padding_aware_transformer:
+            # the first word is kept for empty texts, so that no sequence is fully masked
+            b_mask = b_mask.clone()                                                                     # [batch_size * news_num, max_body_length]
+            b_mask[:, 0] = 1
+            body_t = self.padding_aware_encode(self.body_transformer, body_p, b_mask)                   # [batch_size * news_num, max_content_length, news_embedding_dim]
+            b_mask = b_mask.unsqueeze(dim=2).to(body_t.dtype)                                           # [batch_size * news_num, max_content_length, 1]
+            return (body_t * b_mask).sum(dim=1) / b_mask.sum(dim=1)                                     # [batch_size * news_num, news_embedding_dim]          for Transformer(masked average)
+        body_t = self.body_transformer(body_p)                                                          # [batch_size * news_num, max_content_length, news_embedding_dim]
+        return body_t.mean(dim=1).view([body_w.size(0), self.word_embedding_dim])                       # [batch_size * news_num, news_embedding_dim]          for Transformer(average)
+
+    def body_feature(self, content_text, content_mask):
+        body_w = self.dropout(self.word_embedding(content_text))                                        # [news_num, max_content_length, word_embedding_dim]
+        return self.encode_body(body_w, content_mask)                                                   # [news_num, word_embedding_dim]
 
     def similarity_compute(self, title, body):                              # [batch_size * news_num, intent_embedding_dim]
         cosine_similarity = F.cosine_similarity(title, body, dim=1)             
@@ -160,12 +247,15 @@ class CIDER(NewsEncoder):
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
         
-        t_mask = title_mask.view([batch_news_num, self.max_title_length])                                   # [batch_size * news_num, max_title_length]
-        b_mask = content_mask.view([batch_news_num, self.max_body_length])                                  # [batch_size * news_num, max_body_length]
+        t_mask = title_mask.view([batch_news_num, -1])                                                      # [batch_size * news_num, max_title_length]
+        b_mask = content_mask.view([batch_news_num, -1])                                                    # [batch_size * news_num, max_body_length]
         
         # (1) Word embedding
-        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])          # [batch_size * news_num, max_title_length, word_embedding_dim]
-        body_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_body_length, self.word_embedding_dim])          # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                             # [batch_size * news_num, max_title_length, word_embedding_dim]
+        # with the body branch frozen, content_text holds the precomputed body embeddings
+        precomputed_body = content_text.is_floating_point()
+        if not precomputed_body:
+            body_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                        # [batch_size * news_num, max_content_length, word_embedding_dim]
         
         # (2) Multihead Attention encoding
         # title_m = self.title_multiheadAttention(title_w, title_w, title_w, t_mask)                          # [batch_size * news_num, max_title_length, news_embedding_dim]
@@ -174,13 +264,23 @@ class CIDER(NewsEncoder):
         # body_embedding = body_m.mean(dim=1).view([batch_size * news_num, self.word_embedding_dim])          # [batch_size * news_num, news_embedding_dim] 
 
         # (2) Transformer encoding
+        if self.padding_aware_transformer:
+            # the first word is kept for empty texts, so that no sequence is fully masked
+            t_mask = t_mask.clone()                                                                     # [batch_size * news_num, max_title_length]
+            t_mask[:, 0] = 1
         title_p = self.title_pos_encoder(title_w)                                                       # [batch_size * news_num, max_title_length, news_embedding_dim]
-        title_t = self.title_transformer(title_p)                                                       # [batch_size * news_num, max_title_length, news_embedding_dim]
-        title_embedding = title_t.mean(dim=1).view([batch_size * news_num, self.word_embedding_dim])    # [batch_size * news_num, news_embedding_dim]          for Transformer(average)
+        if self.padding_aware_transformer:
+            title_t = self.padding_aware_encode(self.title_transformer, title_p, t_mask)                # [batch_size * news_num, max_title_length, news_embedding_dim]
+            t_mask = t_mask.unsqueeze(dim=2).to(title_t.dtype)                                          # [batch_size * news_num, max_title_length, 1]
+            title_embedding = (title_t * t_mask).sum(dim=1) / t_mask.sum(dim=1)                         # [batch_size * news_num, news_embedding_dim]          for Transformer(masked average)
+        else:
+            title_t = self.title_transformer(title_p)                                                   # [batch_size * news_num, max_title_length, news_embedding_dim]
+            title_embedding = title_t.mean(dim=1).view([batch_size * news_num, self.word_embedding_dim]) # [batch_size * news_num, news_embedding_dim]          for Transformer(average)
         
-        body_p = self.body_pos_encoder(body_w)                                                          # [batch_size * news_num, max_content_length, news_embedding_dim]
-        body_t = self.body_transformer(body_p)                                                          # [batch_size * news_num, max_content_length, news_embedding_dim]
-        body_embedding = body_t.mean(dim=1).view([batch_size * news_num, self.word_embedding_dim])      # [batch_size * news_num, news_embedding_dim]          for Transformer(average)
+        if precomputed_body:
+            body_embedding = content_text.view([batch_news_num, self.word_embedding_dim])               # [batch_size * news_num, news_embedding_dim]
+        else:
+            body_embedding = self.encode_body(body_w, b_mask)                                           # [batch_size * news_num, news_embedding_dim]
         
         # (2) MAB(Multihead Attention Block) encoding
         # title_mab1 = self.dropout(self.MAB(title_w, title_w))                                                # [batch_size * news_num, max_title_length, news_embedding_dim]
@@ -211,25 +311,20 @@ class CIDER(NewsEncoder):
         category_representation = self.category_affine(torch.cat([self.category_embedding(category),
                                                                   self.subCategory_embedding(subCategory)], 
                                                                   dim=2)).view([batch_news_num, self.category_embedding_dim])   # [batch_size * news_num, category_embedding_dim] 
-        category_aware_title_embedding= torch.cat([title_embedding, category_representation], dim=1)                            # [batch_size * news_num, news_embedding_dim + category_embedding_dim]
-        category_aware_body_embedding = torch.cat([body_embedding, category_representation], dim=1)                             # [batch_size * news_num, news_embedding_dim + category_embedding_dim]
-
-        k = self.intent_num
-        title_k_intent_embeddings = self.k_intent_disentangle(k, category_aware_title_embedding)              # [batch_size * news_num, intent_length(k), intent_embedding_dim]
-        body_k_intent_embeddings = self.k_intent_disentangle(k, category_aware_body_embedding)                # [batch_size * news_num, intent_length(k), intent_embedding_dim]
+        # the title and body streams are stacked, and the category-aware intents of both are computed at once
+        k_intent_embeddings = self.k_intent_disentangle(torch.stack([title_embedding, body_embedding], dim=0), category_representation)   # [2, batch_size * news_num, intent_length(k), intent_embedding_dim]
         
         # (5) Intent-based Attention
         # title_intent_embedding, title_intent_distribution = self.intent_attention_func(k, title_k_intent_embeddings)                   # [batch_size, news_num, intent_embedding_dim]
         # body_intent_embedding, body_intent_distribution = self.intent_attention_func(k, body_k_intent_embeddings)                      # [batch_size, news_num, intent_embedding_dim]
         
-        title_intent_embedding = self.title_intent_attention(title_k_intent_embeddings)              # [batch_size * news_num, intent_embedding_dim]
-        body_intent_embedding = self.body_intent_attention(body_k_intent_embeddings)                 # [batch_size * news_num, intent_embedding_dim]
+        title_intent_embedding, body_intent_embedding = self.intent_attention(k_intent_embeddings)   # [batch_size * news_num, intent_embedding_dim]
         
         # Category predictor
         # title_embedding     : [batch_size * news_num, intent_embedding_dim]
-        # target category     : [batch_size * news_num, 1]
-        target_category = category.view([batch_news_num, 1])
-        category_loss = self.category_predictor(title_intent_embedding, target_category, self.category_num)
+        # target category     : [batch_size * news_num]
+        target_category = category.view([batch_news_num])
+        category_loss = self.category_predictor(title_intent_embedding, target_category)
         
         self.auxiliary_loss = category_loss * self.alpha
         
@@ -247,18 +342,12 @@ class CategoryPredictor(nn.Module):
         super(CategoryPredictor, self).__init__()
         self.fc = nn.Linear(title_embedding, category_num)
 
-    def one_hot_encode(self, target, category_num):
-        batch_size, _ = target.size()
-        one_hot = torch.zeros(batch_size, category_num, device=target.device)
-        target = target.long()
-        one_hot.scatter_(1, target, 1)
-        return one_hot
     # Input: title_intent_embedding             # [batch_size * news_num, intent_embedding_dim]
-    # Output: category loss (auxiliary loss)    # [batch_size, news_num]
-    def forward(self, title_intent_embedding, targets, category_num):
+    #        targets                            # [batch_size * news_num] (category indices)
+    # Output: category loss (auxiliary loss)    # scalar
+    def forward(self, title_intent_embedding, targets):
         category_logits = self.fc(title_intent_embedding)               # [batch_size * news_num, category_num]
-        one_hot_targets = self.one_hot_encode(targets, category_num)    # [batch_size * news_num, category_num]
-        category_loss = F.cross_entropy(category_logits, one_hot_targets)
+        category_loss = F.cross_entropy(category_logits, targets.long())
 
         return category_loss
 
@@ -309,8 +398,6 @@ class ISAB(nn.Module):
 class CNE(NewsEncoder):
     def __init__(self, config: Config):
         super(CNE, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 4 + config.category_embedding_dim + config.subCategory_embedding_dim # 900
@@ -327,6 +414,9 @@ class CNE(NewsEncoder):
         # cross-attention
         self.title_cross_attention = ScaledDotProduct_CandidateAttention(self.hidden_dim * 2, self.hidden_dim * 2, config.attention_dim)
         self.content_cross_attention = ScaledDotProduct_CandidateAttention(self.hidden_dim * 2, self.hidden_dim * 2, config.attention_dim)
+        # the body features are the semantic memory vector followed by the LSTM outputs of the content
+        self.body_modules = ['word_embedding', 'content_lstm']
+        self.body_feature_shape = (config.max_abstract_length + 1, self.hidden_dim * 2)
 
     def initialize(self):
         super().initialize()
@@ -351,42 +441,62 @@ class CNE(NewsEncoder):
         self.title_cross_attention.initialize()
         self.content_cross_attention.initialize()
 
+    # Body branch : word embedding and selective LSTM encoding of the content
+    # Input
+    # content_text : [batch_size * news_num, max_content_length]
+    # content_mask : [batch_size * news_num, max_content_length] (with the first word unmasked)
+    # Output
+    # content_h    : [batch_size * news_num, max_content_length, hidden_dim * 2]
+    # content_m    : [batch_size * news_num, hidden_dim * 2]
+    def encode_content(self, content_text, content_mask):
+        content_length = content_mask.sum(dim=1, keepdim=False).long().cpu()                                                                               # [batch_size * news_num]
+        content = self.dropout(self.word_embedding(content_text))                                                                                          # [batch_size * news_num, max_content_length, word_embedding_dim]
+        packed_content = pack_padded_sequence(content, content_length, batch_first=True, enforce_sorted=False)                                             # [batch_size * news_num, max_content_length, word_embedding_dim]
+        content_h, (content_h_n, content_c_n) = self.content_lstm(packed_content)
+        content_m = torch.cat([content_c_n[0], content_c_n[1]], dim=1)                                                                                     # [batch_size * news_num, hidden_dim * 2]
+        content_h, _ = pad_packed_sequence(content_h, batch_first=True, total_length=content_text.size(1))                                                 # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        return content_h, content_m
+
+    def body_feature(self, content_text, content_mask):
+        content_mask = content_mask.clone()                                                                                                                # [news_num, max_content_length]
+        content_mask[:, 0] = 1 # To avoid empty input of LSTM
+        content_h, content_m = self.encode_content(content_text, content_mask)
+        return torch.cat([content_m.unsqueeze(dim=1), content_h], dim=1)                                                                                   # [news_num, max_content_length + 1, hidden_dim * 2]
+
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        title_mask = title_mask.view([batch_news_num, self.max_title_length])                                                                              # [batch_size * news_num, max_title_length]
-        content_mask = content_mask.view([batch_news_num, self.max_content_length])                                                                        # [batch_size * news_num, max_content_length]
+        title_mask = title_mask.view([batch_news_num, -1])                                                                                                 # [batch_size * news_num, max_title_length]
+        content_mask = content_mask.view([batch_news_num, -1])                                                                                             # [batch_size * news_num, max_content_length]
         title_mask[:, 0] = 1   # To avoid empty input of LSTM
         content_mask[:, 0] = 1 # To avoid empty input of LSTM
-        title_length = title_mask.sum(dim=1, keepdim=False).long()                                                                                         # [batch_size * news_num]
-        content_length = content_mask.sum(dim=1, keepdim=False).long()                                                                                     # [batch_size * news_num]
-        sorted_title_length, sorted_title_indices = torch.sort(title_length, descending=True)                                                              # [batch_size * news_num]
-        _, desorted_title_indices = torch.sort(sorted_title_indices, descending=False)                                                                     # [batch_size * news_num]
-        sorted_content_length, sorted_content_indices = torch.sort(content_length, descending=True)                                                        # [batch_size * news_num]
-        _, desorted_content_indices = torch.sort(sorted_content_indices, descending=False)                                                                 # [batch_size * news_num]
+        title_length = title_mask.sum(dim=1, keepdim=False).long().cpu()                                                                                   # [batch_size * news_num]
         # 1. word embedding
-        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])                       # [batch_size * news_num, max_title_length, word_embedding_dim]
-        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim])                 # [batch_size * news_num, max_content_length, word_embedding_dim]
-        sorted_title = pack_padded_sequence(title.index_select(0, sorted_title_indices), sorted_title_length.cpu(), batch_first=True)                      # [batch_size * news_num, max_title_length, word_embedding_dim]
-        sorted_content = pack_padded_sequence(content.index_select(0, sorted_content_indices), sorted_content_length.cpu(), batch_first=True)              # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                                          # [batch_size * news_num, max_title_length, word_embedding_dim]
+        # the packed sequences sort the news by length once, and the LSTM outputs and states are returned in the news order
+        packed_title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False)                                                   # [batch_size * news_num, max_title_length, word_embedding_dim]
         # [Cross-selective Encoding]
         # 2. selective LSTM encoding
         # parallel bidirectional LSTMs (1),(2)
         # h: hidden state, c: cell state
-        sorted_title_h, (sorted_title_h_n, sorted_title_c_n) = self.title_lstm(sorted_title)
-        sorted_content_h, (sorted_content_h_n, sorted_content_c_n) = self.content_lstm(sorted_content)
+        title_h, (title_h_n, title_c_n) = self.title_lstm(packed_title)
+        if content_text.is_floating_point():
+            # with the body branch frozen, content_text holds the precomputed semantic memory vectors and LSTM outputs of the content
+            content_feature = content_text.view([batch_news_num, -1, self.hidden_dim * 2])                                                                 # [batch_size * news_num, max_content_length + 1, hidden_dim * 2]
+            content_m = content_feature[:, 0]                                                                                                              # [batch_size * news_num, hidden_dim * 2]
+            content_h = content_feature[:, 1:]                                                                                                             # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        else:
+            content_h, content_m = self.encode_content(content_text.view([batch_news_num, -1]), content_mask)
         # semantic memory vector (3)
-        sorted_title_m = torch.cat([sorted_title_c_n[0], sorted_title_c_n[1]], dim=1)                                                                      # [batch_size * news_num, hidden_dim * 2]
-        sorted_content_m = torch.cat([sorted_content_c_n[0], sorted_content_c_n[1]], dim=1)                                                                # [batch_size * news_num, hidden_dim * 2]
-        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=self.max_title_length)                                      # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=self.max_content_length)                                # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_m = torch.cat([title_c_n[0], title_c_n[1]], dim=1)                                                                                           # [batch_size * news_num, hidden_dim * 2]
+        title_h, _ = pad_packed_sequence(title_h, batch_first=True, total_length=title_text.size(2))                                                       # [batch_size * news_num, max_title_length, hidden_dim * 2]
         # sigmoid gate function (4),(5)
-        sorted_title_gate = torch.sigmoid(self.title_H(sorted_title_h) + self.title_M(sorted_content_m).unsqueeze(dim=1))                                  # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_gate = torch.sigmoid(self.content_H(sorted_content_h) + self.content_M(sorted_title_m).unsqueeze(dim=1))                            # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_gate = torch.sigmoid(self.title_H(title_h) + self.title_M(content_m).unsqueeze(dim=1))                                                       # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        content_gate = torch.sigmoid(self.content_H(content_h) + self.content_M(title_m).unsqueeze(dim=1))                                                   # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # cross selective feature (final output of cross-selective encoding)
-        title_h = (sorted_title_h * sorted_title_gate).index_select(0, desorted_title_indices)                                                             # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        content_h = (sorted_content_h * sorted_content_gate).index_select(0, desorted_content_indices)                                                     # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_h = title_h * title_gate                                                                                                                     # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        content_h = content_h * content_gate                                                                                                               # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # [Cross-attentive Encoding]
         # 3. self-attention (6)
         title_self = self.title_self_attention(title_h, title_mask)                                                                                        # [batch_size * news_num, hidden_dim * 2]
@@ -403,7 +513,6 @@ class CNE(NewsEncoder):
 class CNN(NewsEncoder):
     def __init__(self, config: Config):
         super(CNN, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
         self.attention = Attention(config.cnn_kernel_num, config.attention_dim)
@@ -417,9 +526,9 @@ class CNN(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        mask = title_mask.view([batch_news_num, self.max_sentence_length])                                                          # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_news_num, -1])                                                                                # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_sentence_length, self.word_embedding_dim]) # [batch_size * news_num, max_sentence_length, word_embedding_dim]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                       # [batch_size * news_num, max_sentence_length, word_embedding_dim]
         # 2. CNN encoding
         c = self.dropout_(self.conv(w.permute(0, 2, 1)).permute(0, 2, 1))                                                           # [batch_size * news_num, max_sentence_length, cnn_kernel_num]
         # 3. attention layer
@@ -432,9 +541,8 @@ class CNN(NewsEncoder):
 class MHSA(NewsEncoder):
     def __init__(self, config: Config):
         super(MHSA, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.feature_dim = config.head_num * config.head_dim
-        self.multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.max_title_length, config.max_title_length, config.head_dim, config.head_dim)
+        self.multiheadAttention = MultiHeadAttention(config.head_num, config.word_embedding_dim, config.head_dim, config.head_dim)
         self.attention = Attention(config.head_num*config.head_dim, config.attention_dim)
         self.news_embedding_dim = config.head_num * config.head_dim + config.category_embedding_dim + config.subCategory_embedding_dim
 
@@ -447,9 +555,9 @@ class MHSA(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        mask = title_mask.view([batch_news_num, self.max_sentence_length])                                                          # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_news_num, -1])                                                                                # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_sentence_length, self.word_embedding_dim]) # [batch_size * news_num, max_sentence_length, word_embedding_dim]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                       # [batch_size * news_num, max_sentence_length, word_embedding_dim]
         # 2. multi-head self-attention
         c = self.dropout(self.multiheadAttention(w, w, w, mask))                                                                    # [batch_size * news_num, max_sentence_length, news_embedding_dim]
         # 3. attention layer
@@ -462,16 +570,14 @@ class MHSA(NewsEncoder):
 class KCNN(NewsEncoder):
     def __init__(self, config: Config):
         super(KCNN, self).__init__(config)
-        self.max_title_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.entity_embedding_dim = config.entity_embedding_dim
         self.context_embedding_dim = config.context_embedding_dim
         self.entity_embedding = nn.Embedding(num_embeddings=config.entity_size, embedding_dim=self.entity_embedding_dim)
         self.context_embedding = nn.Embedding(num_embeddings=config.entity_size, embedding_dim=self.context_embedding_dim)
-        with open('entity_embedding-%s.pkl' % config.dataset, 'rb') as entity_embedding_f:
-            self.entity_embedding.weight.data.copy_(pickle.load(entity_embedding_f))
-        with open('context_embedding-%s.pkl' % config.dataset, 'rb') as context_embedding_f:
-            self.context_embedding.weight.data.copy_(pickle.load(context_embedding_f))
+        store = ArtifactStore()
+        self.entity_embedding.weight.data.copy_(store.load_tensor(config.entity_embedding_group, 'entity_embedding'))
+        self.context_embedding.weight.data.copy_(store.load_tensor(config.entity_embedding_group, 'context_embedding'))
         self.M_entity = nn.Linear(self.entity_embedding_dim, self.word_embedding_dim, bias=True)
         self.M_context = nn.Linear(self.context_embedding_dim, self.word_embedding_dim, bias=True)
         self.knowledge_cnn = Conv2D_Pool(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size, 3)
@@ -489,9 +595,9 @@ class KCNN(NewsEncoder):
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
         # 1. word & entity & context embedding
-        word_embedding = self.word_embedding(title_text).view([batch_news_num, self.max_title_length, self.word_embedding_dim])                                  # [batch_size * news_num, max_title_length, word_embedding_dim]
-        entity_embedding = self.entity_embedding(title_entity).view([batch_news_num, self.max_title_length, self.entity_embedding_dim])                          # [batch_size * news_num, max_title_length, entity_embedding_dim]
-        context_embedding = self.context_embedding(title_entity).view([batch_news_num, self.max_title_length, self.context_embedding_dim])                       # [batch_size * news_num, max_title_length, context_embedding_dim]
+        word_embedding = self.word_embedding(title_text).view([batch_news_num, -1, self.word_embedding_dim])                                                     # [batch_size * news_num, max_title_length, word_embedding_dim]
+        entity_embedding = self.entity_embedding(title_entity).view([batch_news_num, -1, self.entity_embedding_dim])                                             # [batch_size * news_num, max_title_length, entity_embedding_dim]
+        context_embedding = self.context_embedding(title_entity).view([batch_news_num, -1, self.context_embedding_dim])                                          # [batch_size * news_num, max_title_length, context_embedding_dim]
         W = torch.stack([word_embedding, torch.tanh(self.M_entity(entity_embedding)), torch.tanh(self.M_context(context_embedding))], dim=3).permute(0, 2, 1, 3) # [batch_size * news_num, word_embedding_dim, max_title_length, 3]
         # 2. knowledge-aware CNN
         news_representation = self.knowledge_cnn(W).view([batch_size, news_num, self.cnn_kernel_num])                                                            # [batch_size, news_num, cnn_kernel_num]
@@ -503,8 +609,6 @@ class KCNN(NewsEncoder):
 class NAML(NewsEncoder):
     def __init__(self, config: Config):
         super(NAML, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.news_embedding_dim = config.cnn_kernel_num
         self.title_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
@@ -515,6 +619,8 @@ class NAML(NewsEncoder):
         self.subCategory_affine = nn.Linear(config.subCategory_embedding_dim, config.cnn_kernel_num, bias=True)
         self.affine1 = nn.Linear(config.cnn_kernel_num, config.attention_dim, bias=True)
         self.affine2 = nn.Linear(config.attention_dim, 1, bias=False)
+        self.body_modules = ['word_embedding', 'content_conv', 'content_attention']
+        self.body_feature_shape = (config.cnn_kernel_num, )
 
     def initialize(self):
         super().initialize()
@@ -528,19 +634,33 @@ class NAML(NewsEncoder):
         nn.init.zeros_(self.affine1.bias)
         nn.init.xavier_uniform_(self.affine2.weight)
 
+    # Body branch : CNN encoding and attention layer of the content
+    # Input
+    # content_w              : [batch_size * news_num, max_content_length, word_embedding_dim]
+    # Output
+    # content_representation : [batch_size * news_num, cnn_kernel_num]
+    def encode_content(self, content_w):
+        content_c = self.dropout_(self.content_conv(content_w.permute(0, 2, 1)).permute(0, 2, 1))                                            # [batch_size * news_num, max_content_length, cnn_kernel_num]
+        return self.content_attention(content_c)                                                                                             # [batch_size * news_num, cnn_kernel_num]
+
+    def body_feature(self, content_text, content_mask):
+        return self.encode_content(self.dropout(self.word_embedding(content_text)))                                                          # [news_num, cnn_kernel_num]
+
     def forward(self, title_text, title_mask, title_entity, content_text, content_mask, content_entity, category, subCategory, user_embedding):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
         # 1. word embedding
-        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])       # [batch_size * news_num, max_title_length, word_embedding_dim]
-        content_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim]) # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                          # [batch_size * news_num, max_title_length, word_embedding_dim]
+        # with the body branch frozen, content_text holds the precomputed content representations
+        precomputed_content = content_text.is_floating_point()
+        if not precomputed_content:
+            content_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                  # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. CNN encoding
         title_c = self.dropout_(self.title_conv(title_w.permute(0, 2, 1)).permute(0, 2, 1))                                                  # [batch_size * news_num, max_title_length, cnn_kernel_num]
-        content_c = self.dropout_(self.content_conv(content_w.permute(0, 2, 1)).permute(0, 2, 1))                                            # [batch_size * news_num, max_content_length, cnn_kernel_num]
         # 3. attention layer
         title_representation = self.title_attention(title_c).view([batch_size, news_num, self.cnn_kernel_num])                               # [batch_size, news_num, cnn_kernel_num]
-        content_representation = self.content_attention(content_c).view([batch_size, news_num, self.cnn_kernel_num])                         # [batch_size, news_num, cnn_kernel_num]
+        content_representation = (content_text if precomputed_content else self.encode_content(content_w)).view([batch_size, news_num, self.cnn_kernel_num]) # [batch_size, news_num, cnn_kernel_num]
         # 4. category and subCategory encoding
         category_representation = F.relu(self.category_affine(self.category_embedding(category)), inplace=True)                              # [batch_size, news_num, cnn_kernel_num]
         subCategory_representation = F.relu(self.subCategory_affine(self.subCategory_embedding(subCategory)), inplace=True)                  # [batch_size, news_num, cnn_kernel_num]
@@ -558,7 +678,6 @@ class NAML(NewsEncoder):
 class PNE(NewsEncoder):
     def __init__(self, config: Config):
         super(PNE, self).__init__(config)
-        self.max_sentence_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.personalized_embedding_dim = config.personalized_embedding_dim
         self.conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
@@ -576,13 +695,13 @@ class PNE(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        mask = title_mask.view([batch_news_num, self.max_sentence_length])                                                          # [batch_size * news_num, max_sentence_length]
+        mask = title_mask.view([batch_news_num, -1])                                                                                # [batch_size * news_num, max_sentence_length]
         # 1. word embedding
-        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_sentence_length, self.word_embedding_dim]) # [batch_size * news_num, max_sentence_length, word_embedding_dim]
+        w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                       # [batch_size * news_num, max_sentence_length, word_embedding_dim]
         # 2. CNN encoding
         c = self.dropout_(self.conv(w.permute(0, 2, 1)).permute(0, 2, 1))                                                           # [batch_size * news_num, max_sentence_length, cnn_kernel_num]
         # 3. attention layer
-        q_w = F.relu(self.dense(user_embedding), inplace=True).repeat([news_num, 1])                                                # [batch_size * news_num, personalized_embedding_dim]
+        q_w = F.relu(self.dense(user_embedding), inplace=True).repeat_interleave(news_num, dim=0)                                    # [batch_size * news_num, personalized_embedding_dim]
         news_representation = self.personalizedAttention(c, q_w, mask).view([batch_size, news_num, self.cnn_kernel_num])            # [batch_size, news_num, cnn_kernel_num]
         # 4. feature fusion
         news_representation = self.feature_fusion(news_representation, category, subCategory)                                       # [batch_size, news_num, news_embedding_dim]
@@ -0,0 +1,37 @@
+import os
+import zipfile
+import multiprocessing
+from artifact_store import ArtifactStore
+
+
+def test_content_digest_of_zip_member_matches_extracted_file(tmp_path):
+    store = ArtifactStore(str(tmp_path / 'artifacts'))
+    text_file = tmp_path / 'glove.6B.50d.txt'
+    text_file.write_bytes(b'the 0.1 0.2\nof 0.3 0.4\n')
+    with zipfile.ZipFile(str(tmp_path / 'glove.6B.zip'), 'w') as glove_zip:
+        glove_zip.write(str(text_file), 'glove.6B.50d.txt')
+    digest = store.content_digest(str(text_file))
+    assert store.content_digest(str(tmp_path / 'glove.6B.zip'), 'glove.6B.50d.txt') == digest
+    # a moved and touched file keeps its digest, a modified one does not
+    moved_file = tmp_path / 'moved.txt'
+    os.replace(str(text_file), str(moved_file))
+    os.utime(str(moved_file))
+    assert store.content_digest(str(moved_file)) == digest
+    moved_file.write_bytes(b'the 0.1 0.2\nof 0.3 0.5\n')
+    assert store.content_digest(str(moved_file)) != digest
+
+def update_manifest(root, group):
+    store = ArtifactStore(root)
+    for key in range(50):
+        store.update_manifest(group, str(key), {'file': group + '/' + str(key) + '.npy', 'nbytes': 0})
+
+# Concurrent read-modify-write updates of the manifest lose no entry
+def test_concurrent_manifest_updates(tmp_path):
+    root = str(tmp_path / 'artifacts')
+    processes = [multiprocessing.Process(target=update_manifest, args=(root, 'group%d' % i)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert {group: len(entries) for group, entries in ArtifactStore(root).read_manifest()['groups'].items()} == {'group%d' % i: 50 for i in range(4)}
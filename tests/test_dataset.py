@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from dataset import sample_negative_index, shared_negative_pool, CandidateNum_BatchSampler
+
+
+# Frequency of each non-click news position in every column of the sampled indices
+def column_position_frequencies(negative_index, news_num):
+    return np.stack([np.bincount(negative_index[:, j], minlength=news_num) / len(negative_index) for j in range(negative_index.shape[1])])
+
+@pytest.mark.parametrize('news_num', [10, 5, 4])
+def test_negative_sampling_is_uniform_per_column(news_num):
+    negative_sample_num = 4
+    negative_index = sample_negative_index(np.full([60000], news_num, dtype=np.int64), negative_sample_num, np.random.default_rng(0))
+    assert negative_index.shape == (60000, negative_sample_num)
+    assert np.all(np.sort(negative_index, axis=1)[:, 1:] != np.sort(negative_index, axis=1)[:, :-1]) # without replacement
+    np.testing.assert_allclose(column_position_frequencies(negative_index, news_num), 1 / news_num, atol=0.01)
+
+def test_negative_sampling_wraps_short_impressions():
+    negative_index = sample_negative_index(np.full([60000], 3, dtype=np.int64), 4, np.random.default_rng(0))
+    np.testing.assert_array_equal(np.sort(negative_index, axis=1), np.broadcast_to([0, 0, 1, 2], negative_index.shape)) # [0, 1, 2, 0] wrapped around
+    np.testing.assert_allclose(column_position_frequencies(negative_index, 3), np.broadcast_to([0.5, 0.25, 0.25], [4, 3]), atol=0.01)
+
+# Every non-click news position of an impression is equally likely in the shared pool, also with fewer shared negatives than samples
+@pytest.mark.parametrize('shared_negative_num', [8, 32, 100])
+def test_shared_negative_pool_is_uniform_per_position(shared_negative_num):
+    rng = np.random.default_rng(0)
+    batch_size, negative_sample_num, news_num = 32, 4, 10
+    position_count = np.zeros([news_num])
+    for _ in range(3000):
+        negative_index = sample_negative_index(np.full([batch_size], news_num, dtype=np.int64), negative_sample_num, rng)
+        pool = shared_negative_pool(negative_index, shared_negative_num, rng)
+        assert len(pool) == min(shared_negative_num, batch_size * negative_sample_num)
+        position_count += np.bincount(pool, minlength=news_num)
+    np.testing.assert_allclose(position_count / position_count.sum(), 1 / news_num, atol=0.005)
+
+# Batches bounded by impression number hold max_impression_num impressions of ascending candidate number (the last one possibly fewer)
+def test_candidate_num_batches_bounded_by_impressions():
+    candidate_num = np.random.default_rng(0).integers(2, 60, size=500)
+    batches = list(CandidateNum_BatchSampler(candidate_num, max_impression_num=16))
+    np.testing.assert_array_equal(np.sort(np.concatenate(batches)), np.arange(500))
+    assert [len(batch) for batch in batches] == [16] * 31 + [4]
+    assert np.all(np.diff(candidate_num[np.concatenate(batches)]) >= 0)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from sklearn.metrics import roc_auc_score
+from evaluate import impression_metrics
+
+
+# Former per-line metrics of the MIND scorer, with the argsort kind as a parameter (numpy's default quicksort is not stable)
+def dcg_score(y_true, y_score, k=10, kind='quicksort'):
+    order = np.argsort(y_score, kind=kind)[::-1]
+    y_true = np.take(y_true, order[:k])
+    gains = 2 ** y_true - 1
+    discounts = np.log2(np.arange(len(y_true)) + 2)
+    return np.sum(gains / discounts)
+
+def ndcg_score(y_true, y_score, k=10, kind='quicksort'):
+    best = dcg_score(y_true, y_true, k, kind)
+    actual = dcg_score(y_true, y_score, k, kind)
+    return actual / best
+
+def mrr_score(y_true, y_score, kind='quicksort'):
+    order = np.argsort(y_score, kind=kind)[::-1]
+    y_true = np.take(y_true, order)
+    rr_score = y_true / (np.arange(len(y_true)) + 1)
+    return np.sum(rr_score) / np.sum(y_true)
+
+# Impressions of 2 to max_candidate_num candidates with at least one positive and one negative candidate, and a few impressions without candidates
+# Tied scores are drawn from score_levels values when score_levels is not None
+def random_impressions(rng, impression_num, max_candidate_num, score_levels=None):
+    candidate_num = rng.integers(2, max_candidate_num + 1, size=impression_num)
+    candidate_num[rng.random(impression_num) < 0.05] = 0
+    labels = []
+    for n in candidate_num:
+        if n > 0:
+            impression_labels = (rng.random(n) < rng.uniform(0.05, 0.5)).astype(np.float64)
+            impression_labels[rng.choice(n, 2, replace=False)] = [0, 1]
+            labels.append(impression_labels)
+    labels = np.concatenate(labels)
+    if score_levels is None:
+        scores = rng.standard_normal(len(labels))
+    else:
+        scores = rng.integers(0, score_levels, size=len(labels)).astype(np.float64)
+    impression_offsets = np.concatenate([[0], np.cumsum(candidate_num)])
+    return labels, scores, impression_offsets
+
+def per_line_metrics(labels, scores, impression_offsets, kind):
+    metrics = []
+    for start, end in zip(impression_offsets[:-1], impression_offsets[1:]):
+        if end > start:
+            y_true, y_score = labels[start:end], scores[start:end]
+            metrics.append([roc_auc_score(y_true, y_score), mrr_score(y_true, y_score, kind), ndcg_score(y_true, y_score, 5, kind), ndcg_score(y_true, y_score, 10, kind)])
+    return np.array(metrics).T
+
+@pytest.mark.parametrize('seed', range(5))
+def test_impression_metrics_match_per_line_metrics(seed):
+    rng = np.random.default_rng(seed)
+    labels, scores, impression_offsets = random_impressions(rng, 200, 60)
+    expected_auc, expected_mrr, expected_ndcg5, expected_ndcg10 = per_line_metrics(labels, scores, impression_offsets, 'quicksort')
+    auc, mrr, ndcg5, ndcg10 = impression_metrics(labels, scores, impression_offsets)
+    np.testing.assert_allclose(auc, expected_auc, rtol=1e-12)
+    np.testing.assert_allclose(mrr, expected_mrr, rtol=1e-12)
+    np.testing.assert_allclose(ndcg5, expected_ndcg5, rtol=1e-12)
+    np.testing.assert_allclose(ndcg10, expected_ndcg10, rtol=1e-12)
+
+# AUC averages tied scores as sklearn does, and MRR / nDCG rank tied scores by the reversed stable argsort
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('score_levels', [2, 5])
+def test_impression_metrics_with_tied_scores(seed, score_levels):
+    rng = np.random.default_rng(seed)
+    labels, scores, impression_offsets = random_impressions(rng, 200, 60, score_levels)
+    expected_auc, expected_mrr, expected_ndcg5, expected_ndcg10 = per_line_metrics(labels, scores, impression_offsets, 'stable')
+    auc, mrr, ndcg5, ndcg10 = impression_metrics(labels, scores, impression_offsets)
+    np.testing.assert_allclose(auc, expected_auc, rtol=1e-12)
+    np.testing.assert_allclose(mrr, expected_mrr, rtol=1e-12)
+    np.testing.assert_allclose(ndcg5, expected_ndcg5, rtol=1e-12)
+    np.testing.assert_allclose(ndcg10, expected_ndcg10, rtol=1e-12)
+
+# An impression of a single class raises the ValueError of the former roc_auc_score (recent scikit-learn versions warn and return NaN instead)
+@pytest.mark.parametrize('impression_labels', [[1, 1, 1], [0, 0]])
+def test_impression_metrics_single_class(impression_labels):
+    labels = np.array([1, 0] + impression_labels, dtype=np.float64)
+    impression_offsets = np.array([0, 2, 2 + len(impression_labels)])
+    with pytest.raises(ValueError, match='Only one class present in y_true'):
+        impression_metrics(labels, np.arange(len(labels), dtype=np.float64), impression_offsets)
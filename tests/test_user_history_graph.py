@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from corpus import build_user_history_graph
+
+
+# Former per-behavior construction of Corpus.preprocess, with the category indices of the (truncated) history news as input
+def per_behavior_user_history_graph(history_category_indices, max_history_num, category_num, self_connection, normalization_type):
+    graph_size = max_history_num + category_num
+    if self_connection:
+        history_graph = np.identity(graph_size, dtype=np.float32)
+    else:
+        history_graph = np.zeros([graph_size, graph_size], dtype=np.float32)
+    history_news_num = len(history_category_indices)
+    if history_news_num > 0:
+        for i in range(history_news_num):
+            category_index = history_category_indices[i]
+            history_graph[i, max_history_num + category_index] = 1
+            history_graph[max_history_num + category_index, i] = 1
+            for j in range(i + 1, history_news_num):
+                _category_index = history_category_indices[j]
+                if category_index == _category_index:
+                    history_graph[i, j] = 1
+                    history_graph[j, i] = 1
+                else:
+                    history_graph[max_history_num + category_index, max_history_num + _category_index] = 1
+                    history_graph[max_history_num + _category_index, max_history_num + category_index] = 1
+        if normalization_type is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if normalization_type == 'asymmetric':
+                    D_inv = np.zeros([graph_size, graph_size], dtype=np.float32)
+                    np.fill_diagonal(D_inv, 1 / history_graph.sum(axis=1, keepdims=False))
+                    history_graph = np.matmul(D_inv, history_graph)
+                else:
+                    D_inv_sqrt = np.zeros([graph_size, graph_size], dtype=np.float32)
+                    np.fill_diagonal(D_inv_sqrt, np.sqrt(1 / history_graph.sum(axis=1, keepdims=False)))
+                    history_graph = np.matmul(np.matmul(D_inv_sqrt, history_graph), D_inv_sqrt)
+    return history_graph
+
+def random_histories(rng, behavior_num, max_history_num, category_num, empty_ratio):
+    user_history_num = rng.integers(1, max_history_num + 1, size=behavior_num)
+    user_history_num[rng.random(behavior_num) < empty_ratio] = 0
+    user_history_category_indices = np.full([behavior_num, max_history_num], category_num, dtype=np.int64) # padded with category_num
+    for i in range(behavior_num):
+        user_history_category_indices[i, :user_history_num[i]] = rng.integers(0, category_num, size=user_history_num[i])
+    return user_history_category_indices, user_history_num
+
+# Identical float32 bits, where NaN (the degree-0 category nodes normalized without self-connection) must appear at the same entries
+def assert_bitwise_equal(graph, expected_graph):
+    assert graph.dtype == expected_graph.dtype == np.float32 and graph.shape == expected_graph.shape
+    nan_mask = np.isnan(expected_graph)
+    np.testing.assert_array_equal(np.isnan(graph), nan_mask)
+    np.testing.assert_array_equal(graph.view(np.uint32)[~nan_mask], expected_graph.view(np.uint32)[~nan_mask])
+
+@pytest.mark.parametrize('self_connection', [True, False])
+@pytest.mark.parametrize('normalization_type', ['symmetric', 'asymmetric', None])
+@pytest.mark.parametrize('empty_ratio', [0.2, 1.0])
+def test_user_history_graph_matches_per_behavior_loop(self_connection, normalization_type, empty_ratio):
+    rng = np.random.default_rng(0)
+    max_history_num, category_num = 10, 6
+    user_history_category_indices, user_history_num = random_histories(rng, 300, max_history_num, category_num, empty_ratio)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        user_history_graph = build_user_history_graph(user_history_category_indices, user_history_num, category_num, self_connection=self_connection, normalization_type=normalization_type)
+        expected_graph = np.stack([per_behavior_user_history_graph(user_history_category_indices[i, :user_history_num[i]].tolist(), max_history_num, category_num, self_connection, normalization_type) for i in range(len(user_history_num))])
+    assert_bitwise_equal(user_history_graph, expected_graph)
+
+def test_empty_history_graph():
+    user_history_category_indices = np.full([2, 4], 3, dtype=np.int64)
+    user_history_num = np.zeros([2], dtype=np.int64)
+    for normalization_type in ['symmetric', 'asymmetric', None]:
+        np.testing.assert_array_equal(build_user_history_graph(user_history_category_indices, user_history_num, 3, self_connection=True, normalization_type=normalization_type), np.broadcast_to(np.identity(7, dtype=np.float32), [2, 7, 7]))
+        np.testing.assert_array_equal(build_user_history_graph(user_history_category_indices, user_history_num, 3, self_connection=False, normalization_type=normalization_type), np.zeros([2, 7, 7], dtype=np.float32))
@@ -5,14 +5,17 @@ import shutil
 import json
 from config import Config
 from corpus import Corpus
-from dataset import Train_Dataset
+from dataset import Train_Dataset, LengthBucket_BatchSampler
 from util import AvgMetric
 from util import compute_scores
+from util import HistoryNewsCache
+from util import precompute_body_features
 from tqdm import tqdm
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 # import wandb
@@ -25,12 +28,17 @@ class Trainer:
         self.batch_size = config.batch_size
         self.max_history_num = config.max_history_num
         self.negative_sample_num = config.negative_sample_num
-        self.loss = self.negative_log_softmax if config.click_predictor in ['dot_product', 'mlp', 'FIM'] else self.negative_log_sigmoid
+        self.loss = self.in_batch_negative_log_softmax if config.in_batch_negatives else (self.negative_log_softmax if config.click_predictor in ['dot_product', 'mlp', 'FIM'] else self.negative_log_sigmoid)
         self.optimizer = optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()), lr=config.lr, weight_decay=config.weight_decay)
         self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='max', factor=0.5, patience=3, verbose=True)
         self._dataset = config.dataset
+        self.no_prediction_file = config.no_prediction_file
         self._corpus = corpus
-        self.train_dataset = Train_Dataset(corpus)
+        self.unique_news_batching = config.unique_news_batching or config.in_batch_negatives
+        self.length_bucketing = config.length_bucketing
+        self.body_freeze_epoch = config.body_freeze_epoch
+        self.train_dataset = Train_Dataset(corpus, unique_news=config.unique_news_batching, in_batch_negatives=config.in_batch_negatives, shared_negative_num=config.shared_negative_num, precomputed_history=config.history_cache)
+        self.history_cache = HistoryNewsCache(model, corpus, config.batch_size, config.history_cache_refresh_steps, config.history_cache_max_age) if config.history_cache else None
         self.run_index = run_index
         self.model_dir = config.model_dir + '/#' + str(self.run_index)
         self.best_model_dir = config.best_model_dir + '/#' + str(self.run_index)
@@ -68,6 +76,11 @@ class Trainer:
         loss = (-torch.log_softmax(logits, dim=1).select(dim=1, index=0)).mean()
         return loss
 
+    # logits : [batch_size, batch_size + shared_negative_num], the click news of the i-th sample is the i-th candidate
+    def in_batch_negative_log_softmax(self, logits):
+        loss = (-torch.log_softmax(logits, dim=1).diagonal()).mean()
+        return loss
+
     def negative_log_sigmoid(self, logits):
         positive_sigmoid = torch.clamp(torch.sigmoid(logits[:, 0]), min=1e-15, max=1)
         negative_sigmoid = torch.clamp(torch.sigmoid(-logits[:, 1:]), min=1e-15, max=1)
@@ -78,36 +91,50 @@ class Trainer:
         model = self.model
         # wandb.watch(model, log='all')
         for e in tqdm(range(1, self.epoch + 1)):
-            self.train_dataset.negative_sampling()
-            train_dataloader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.batch_size // 16, pin_memory=True)
+            if self.body_freeze_epoch > 0 and e == self.body_freeze_epoch + 1:
+                # the body branch of the news encoder is frozen, and its outputs are read from the precomputed features in the later epochs
+                model.news_encoder.freeze_body()
+                self.train_dataset.news_body_feature = precompute_body_features(model, self._corpus, self.batch_size, self.model_dir + '/' + model.model_name + '-body_feature.npy')
+            self.train_dataset.negative_sampling(e)
+            if self.length_bucketing:
+                train_batch_sampler = LengthBucket_BatchSampler(RandomSampler(self.train_dataset), self.train_dataset.history_num, self.batch_size)
+            else:
+                train_batch_sampler = BatchSampler(RandomSampler(self.train_dataset), self.batch_size, drop_last=False)
+            train_dataloader = DataLoader(self.train_dataset, batch_size=None, sampler=train_batch_sampler, num_workers=self.batch_size // 16, pin_memory=True)
             model.train()
             epoch_loss = 0
-            for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) in train_dataloader:
-                user_ID = user_ID.cuda(non_blocking=True)                                                                                                                       # [batch_size]
-                user_category = user_category.cuda(non_blocking=True)                                                                                                           # [batch_size, max_history_num]
-                user_subCategory = user_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, max_history_num]
-                user_title_text = user_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-                user_title_mask = user_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-                user_title_entity = user_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_title_length]
-                user_content_text = user_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-                user_content_mask = user_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-                user_content_entity = user_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, max_history_num, max_content_length]
-                user_history_mask = user_history_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num]
-                user_history_graph = user_history_graph.cuda(non_blocking=True)                                                                                                 # [batch_size, max_history_num, max_history_num]
-                user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)                                                                                 # [batch_size, category_num + 1]
-                user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)                                                                           # [batch_size, max_history_num]
-                news_category = news_category.cuda(non_blocking=True)                                                                                                           # [batch_size, 1 + negative_sample_num]
-                news_subCategory = news_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, 1 + negative_sample_num]
-                news_title_text = news_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_title_mask = news_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_title_entity = news_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_title_length]
-                news_content_text = news_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-                news_content_mask = news_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-                news_content_entity = news_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, 1 + negative_sample_num, max_content_length]
+            for batch in train_dataloader:
+                if self.history_cache is not None:
+                    logits = history_cache_forward(model, batch, self.history_cache)                                                                              # [batch_size, 1 + negative_sample_num]
+                elif self.unique_news_batching:
+                    logits = unique_news_forward(model, batch)                                                                                                    # [batch_size, 1 + negative_sample_num] ([batch_size, batch_size + shared_negative_num] with in-batch negatives)
+                else:
+                    (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                        news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) = batch
+                    user_ID = user_ID.cuda(non_blocking=True)                                                                                                                       # [batch_size]
+                    user_category = user_category.cuda(non_blocking=True)                                                                                                           # [batch_size, max_history_num]
+                    user_subCategory = user_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, max_history_num]
+                    user_title_text = user_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
+                    user_title_mask = user_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
+                    user_title_entity = user_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_title_length]
+                    user_content_text = user_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
+                    user_content_mask = user_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
+                    user_content_entity = user_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, max_history_num, max_content_length]
+                    user_history_mask = user_history_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num]
+                    user_history_graph = user_history_graph.cuda(non_blocking=True)                                                                                                 # [batch_size, max_history_num, max_history_num]
+                    user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)                                                                                 # [batch_size, category_num + 1]
+                    user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)                                                                           # [batch_size, max_history_num]
+                    news_category = news_category.cuda(non_blocking=True)                                                                                                           # [batch_size, 1 + negative_sample_num]
+                    news_subCategory = news_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, 1 + negative_sample_num]
+                    news_title_text = news_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
+                    news_title_mask = news_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
+                    news_title_entity = news_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_title_length]
+                    news_content_text = news_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
+                    news_content_mask = news_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
+                    news_content_entity = news_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, 1 + negative_sample_num, max_content_length]
 
-                logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                               news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, 1 + negative_sample_num]
+                    logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                                   news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, 1 + negative_sample_num]
                 
                 loss = self.loss(logits)
                 if model.news_encoder.auxiliary_loss is not None:
@@ -116,17 +143,19 @@ class Trainer:
                 if model.user_encoder.auxiliary_loss is not None:
                     user_encoder_auxiliary_loss = model.user_encoder.auxiliary_loss.mean()
                     loss += user_encoder_auxiliary_loss
-                epoch_loss += float(loss) * user_ID.size(0)
+                epoch_loss += float(loss) * logits.size(0)
                 self.optimizer.zero_grad()
                 loss.backward()
                 if self.gradient_clip_norm > 0:
                     nn.utils.clip_grad_norm_(model.parameters(), self.gradient_clip_norm)
                 self.optimizer.step()
+                if self.history_cache is not None:
+                    self.history_cache.advance()
             print('Epoch %d : train done' % e)
             print('loss =', epoch_loss / len(self.train_dataset))
             
             # validation
-            auc, mrr, ndcg5, ndcg10 = compute_scores(model, self._corpus, self.batch_size * 3 // 2, 'dev', self.dev_res_dir + '/' + model.model_name + '-' + str(e) + '.txt', self._dataset)
+            auc, mrr, ndcg5, ndcg10 = compute_scores(model, self._corpus, self.batch_size * 3 // 2, 'dev', None if self.no_prediction_file else self.dev_res_dir + '/' + model.model_name + '-' + str(e) + '.txt', self._dataset)
             self.auc_results.append(auc)
             self.mrr_results.append(mrr)
             self.ndcg5_results.append(ndcg5)
@@ -209,10 +238,31 @@ class Trainer:
         print('nDCG@10 : %.4f' % self.ndcg10_results[self.best_dev_epoch - 1])
 
 
+# Forward of a unique-news batch of Train_Dataset, whose news are encoded once by the model
+def unique_news_forward(model, batch):
+    (user_ID, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+     news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, history_news_index, candidate_news_index) = [x.cuda(non_blocking=True) for x in batch]
+    return model(user_ID, None, None, None, None, None, None, None, None, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                 news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, history_news_index=history_news_index, candidate_news_index=candidate_news_index)
+
+
+# Forward of a precomputed-history batch of Train_Dataset, whose history news representations are read from the history news cache (without gradient)
+def history_cache_forward(model, batch, history_cache):
+    (user_ID, user_history, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+     news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) = [x.cuda(non_blocking=True) for x in batch]
+    history_embedding = history_cache.lookup(user_history.long())                                                                                                 # [batch_size, max_history_num, news_embedding_dim]
+    return model(user_ID, None, None, None, None, None, None, None, None, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                 news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, history_embedding=history_embedding)
+
+
 def negative_log_softmax(logits):
     loss = (-torch.log_softmax(logits, dim=1).select(dim=1, index=0)).mean()
     return loss
 
+def in_batch_negative_log_softmax(logits):
+    loss = (-torch.log_softmax(logits, dim=1).diagonal()).mean()
+    return loss
+
 def negative_log_sigmoid(logits):
     positive_sigmoid = torch.clamp(torch.sigmoid(logits[:, 0]), min=1e-15, max=1)
     negative_sigmoid = torch.clamp(torch.sigmoid(-logits[:, 1:]), min=1e-15, max=1)
@@ -226,13 +276,15 @@ def distributed_train(rank, model: nn.Module, config: Config, corpus: Corpus, ru
     config.device_id = rank
     config.set_cuda()
     model.cuda()
-    loss_ = negative_log_softmax if config.click_predictor in ['dot_product', 'mlp', 'FIM'] else negative_log_sigmoid
+    loss_ = in_batch_negative_log_softmax if config.in_batch_negatives else (negative_log_softmax if config.click_predictor in ['dot_product', 'mlp', 'FIM'] else negative_log_sigmoid)
     epoch = config.epoch
     batch_size = config.batch_size // world_size
     model = DDP(model, device_ids=[rank])
     optimizer = optim.Adam(filter(lambda p: p.requires_grad, model.module.parameters()), lr=config.lr, weight_decay=config.weight_decay)
     gradient_clip_norm = config.gradient_clip_norm
-    train_dataset = Train_Dataset(corpus)
+    train_dataset = Train_Dataset(corpus, unique_news=config.unique_news_batching, in_batch_negatives=config.in_batch_negatives, shared_negative_num=config.shared_negative_num, precomputed_history=config.history_cache)
+    # each process keeps its own history news cache, encoded by its replica of the model
+    history_cache = HistoryNewsCache(model.module, corpus, batch_size, config.history_cache_refresh_steps, config.history_cache_max_age) if config.history_cache else None
     if rank == 0:
         model_dir = config.model_dir + '/#' + str(run_index)
         best_model_dir = config.best_model_dir + '/#' + str(run_index)
@@ -265,38 +317,58 @@ def distributed_train(rank, model: nn.Module, config: Config, corpus: Corpus, ru
         print('Running : ' + model_name + '\t#' + str(run_index))
 
     for e in tqdm(range(1, epoch + 1)):
-        train_dataset.negative_sampling(rank=rank)
+        if config.body_freeze_epoch > 0 and e == config.body_freeze_epoch + 1:
+            # the body branch of the news encoder is frozen, and its outputs are read from the features precomputed by rank 0 in the later epochs
+            body_feature_file = config.model_dir + '/#' + str(run_index) + '/' + model_name + '-body_feature.npy'
+            model.module.news_encoder.freeze_body()
+            if rank == 0:
+                precompute_body_features(model.module, corpus, batch_size, body_feature_file)
+            dist.barrier()
+            train_dataset.news_body_feature = np.load(body_feature_file, mmap_mode='r')
+            # DDP is rebuilt, so that the gradients of the frozen parameters are not waited for
+            model = DDP(model.module, device_ids=[rank])
+        train_dataset.negative_sampling(e, rank=rank)
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
         train_sampler.set_epoch(e)
-        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=batch_size // 16, pin_memory=True, sampler=train_sampler)
+        if config.length_bucketing:
+            train_batch_sampler = LengthBucket_BatchSampler(train_sampler, train_dataset.history_num, batch_size)
+        else:
+            train_batch_sampler = BatchSampler(train_sampler, batch_size, drop_last=False)
+        train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=batch_size // 16, pin_memory=True, sampler=train_batch_sampler)
         model.train()
         epoch_loss = 0
-        for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-            news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) in train_dataloader:
-            user_ID = user_ID.cuda(non_blocking=True)                                                                                                                       # [batch_size]
-            user_category = user_category.cuda(non_blocking=True)                                                                                                           # [batch_size, max_history_num]
-            user_subCategory = user_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, max_history_num]
-            user_title_text = user_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-            user_title_mask = user_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
-            user_title_entity = user_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_title_length]
-            user_content_text = user_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-            user_content_mask = user_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
-            user_content_entity = user_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, max_history_num, max_content_length]
-            user_history_mask = user_history_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num]
-            user_history_graph = user_history_graph.cuda(non_blocking=True)                                                                                                 # [batch_size, max_history_num, max_history_num]
-            user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)                                                                                 # [batch_size, category_num + 1]
-            user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)                                                                           # [batch_size, max_history_num]
-            news_category = news_category.cuda(non_blocking=True)                                                                                                           # [batch_size, 1 + negative_sample_num]
-            news_subCategory = news_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, 1 + negative_sample_num]
-            news_title_text = news_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-            news_title_mask = news_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
-            news_title_entity = news_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_title_length]
-            news_content_text = news_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-            news_content_mask = news_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
-            news_content_entity = news_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, 1 + negative_sample_num, max_content_length]
+        for batch in train_dataloader:
+            if history_cache is not None:
+                logits = history_cache_forward(model, batch, history_cache)                                                                                   # [batch_size, 1 + negative_sample_num]
+            elif config.unique_news_batching or config.in_batch_negatives:
+                logits = unique_news_forward(model, batch)                                                                                                    # [batch_size, 1 + negative_sample_num] ([batch_size, batch_size + shared_negative_num] with in-batch negatives)
+            else:
+                (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) = batch
+                user_ID = user_ID.cuda(non_blocking=True)                                                                                                                       # [batch_size]
+                user_category = user_category.cuda(non_blocking=True)                                                                                                           # [batch_size, max_history_num]
+                user_subCategory = user_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, max_history_num]
+                user_title_text = user_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
+                user_title_mask = user_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, max_history_num, max_title_length]
+                user_title_entity = user_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_title_length]
+                user_content_text = user_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
+                user_content_mask = user_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num, max_content_length]
+                user_content_entity = user_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, max_history_num, max_content_length]
+                user_history_mask = user_history_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, max_history_num]
+                user_history_graph = user_history_graph.cuda(non_blocking=True)                                                                                                 # [batch_size, max_history_num, max_history_num]
+                user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)                                                                                 # [batch_size, category_num + 1]
+                user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)                                                                           # [batch_size, max_history_num]
+                news_category = news_category.cuda(non_blocking=True)                                                                                                           # [batch_size, 1 + negative_sample_num]
+                news_subCategory = news_subCategory.cuda(non_blocking=True)                                                                                                     # [batch_size, 1 + negative_sample_num]
+                news_title_text = news_title_text.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
+                news_title_mask = news_title_mask.cuda(non_blocking=True)                                                                                                       # [batch_size, 1 + negative_sample_num, max_title_length]
+                news_title_entity = news_title_entity.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_title_length]
+                news_content_text = news_content_text.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
+                news_content_mask = news_content_mask.cuda(non_blocking=True)                                                                                                   # [batch_size, 1 + negative_sample_num, max_content_length]
+                news_content_entity = news_content_entity.cuda(non_blocking=True)                                                                                               # [batch_size, 1 + negative_sample_num, max_content_length]
 
-            logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                           news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, 1 + negative_sample_num]
+                logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                               news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, 1 + negative_sample_num]
 
             loss = loss_(logits)
             if model.module.news_encoder.auxiliary_loss is not None:
@@ -305,18 +377,20 @@ def distributed_train(rank, model: nn.Module, config: Config, corpus: Corpus, ru
             if model.module.user_encoder.auxiliary_loss is not None:
                 user_encoder_auxiliary_loss = model.module.user_encoder.auxiliary_loss.mean()
                 loss += user_encoder_auxiliary_loss
-            epoch_loss += float(loss) * user_ID.size(0)
+            epoch_loss += float(loss) * logits.size(0)
             optimizer.zero_grad()
             loss.backward()
             if gradient_clip_norm > 0:
                 nn.utils.clip_grad_norm_(model.parameters(), gradient_clip_norm)
             optimizer.step()
+            if history_cache is not None:
+                history_cache.advance()
         print('rank %d : Epoch %d : train done' % (rank, e))
         print('rank %d : loss = %.6f' % (rank, epoch_loss / len(train_dataset) * world_size))
 
         # dev
         if rank == 0:
-            auc, mrr, ndcg5, ndcg10 = compute_scores(model.module, corpus, batch_size * 3 // 2, 'dev', dev_res_dir + '/' + model_name + '-' + str(e) + '.txt', config.dataset)
+            auc, mrr, ndcg5, ndcg10 = compute_scores(model.module, corpus, batch_size * 3 // 2, 'dev', None if config.no_prediction_file else dev_res_dir + '/' + model_name + '-' + str(e) + '.txt', config.dataset)
             auc_results.append(auc)
             mrr_results.append(mrr)
             ndcg5_results.append(ndcg5)
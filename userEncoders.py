@@ -9,6 +9,28 @@ from layers import MultiHeadAttention, Attention, ScaledDotProduct_CandidateAtte
 from newsEncoders import NewsEncoder
 from torch_scatter import scatter_sum, scatter_softmax # need to be installed by following `https://pytorch-scatter.readthedocs.io/en/latest`
 
+# Packs the non-empty histories of a batch for a GRU
+# A batch in descending history number (as the batches of LengthBucket_BatchSampler) is packed as it is; otherwise the packed sequence sorts the histories once,
+# and the GRU returns its states in the batch order
+# Input
+# history_embedding        : [batch_size, max_history_num, news_embedding_dim]
+# user_history_mask        : [batch_size, max_history_num]
+# Output
+# packed_history_embedding : packed non-empty histories (None if all the histories are empty)
+# non_empty_index          : index of the non-empty histories in the batch (a slice, or an index tensor)
+def pack_histories(history_embedding, user_history_mask):
+    user_history_num = user_history_mask.sum(dim=1, keepdim=False).long().cpu()                                                                      # [batch_size]
+    non_empty_num = int((user_history_num > 0).sum())
+    if non_empty_num == 0:
+        return None, None
+    descending = bool((user_history_num[1:] <= user_history_num[:-1]).all())
+    if descending or non_empty_num == user_history_num.size(0):
+        non_empty_index = slice(0, non_empty_num) # with descending history numbers, the empty histories are the last ones
+    else:
+        non_empty_index = (user_history_num > 0).nonzero(as_tuple=False).squeeze(dim=1)
+    return pack_padded_sequence(history_embedding[non_empty_index], user_history_num[non_empty_index], batch_first=True, enforce_sorted=descending), non_empty_index
+
+
 class UserEncoder(nn.Module):
     def __init__(self, news_encoder, config):
         super(UserEncoder, self).__init__()
@@ -16,6 +38,7 @@ class UserEncoder(nn.Module):
         self.news_encoder = news_encoder
         self.device = torch.device('cuda')
         self.auxiliary_loss = None
+        self.candidate_aware = False # whether the user representation depends on the candidate news
 
     # Input
     # user_title_text               : [batch_size, max_history_num, max_title_length]
@@ -33,15 +56,52 @@ class UserEncoder(nn.Module):
     # user_embedding                : [batch_size, user_embedding]
     # candidate_news_representation : [batch_size, news_num, news_embedding_dim]
     # Output
-    # user_representation           : [batch_size, news_embedding_dim]
+    # user_representation           : [batch_size, news_num, news_embedding_dim]
     def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
                 user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        raise Exception('Function forward must be implemented at sub-class')
+        user_state = self.encode_history(user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
+                                         user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)
+        return self.attend(user_state, candidate_news_representation)
+
+    # Stage 1 : history-only encoding, whose output can be reused for any candidate news of the same users
+    # Input
+    # the user history inputs of forward
+    # Output
+    # user_state : dict of history-only tensors (batch_size first), consumed by attend
+    def encode_history(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
+                       user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
+                                              user_content_text, user_content_mask, user_content_entity, \
+                                              user_category, user_subCategory, user_embedding)                  # [batch_size, max_history_num, news_embedding_dim]
+        return self.history_state(history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding)
+
+    # Input
+    # history_embedding             : [batch_size, max_history_num, news_embedding_dim] (encoded by news_encoder, or gathered from precomputed news representations)
+    # user_history_mask             : [batch_size, max_history_num]
+    # user_history_graph            : [batch_size, max_history_num, max_history_num]
+    # user_history_category_mask    : [batch_size, category_num]
+    # user_history_category_indices : [batch_size, max_history_num]
+    # user_embedding                : [batch_size, user_embedding]
+    # Output
+    # user_state                    : candidate-independent user encoders return {'user_representation' : [batch_size, news_embedding_dim]}
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        raise Exception('Function history_state must be implemented at sub-class')
+
+    # Stage 2 : candidate attention
+    # Input
+    # user_state                    : output of encode_history (or history_state)
+    # candidate_news_representation : [batch_size, news_num, news_embedding_dim]
+    # Output
+    # user_representation           : [batch_size, news_num, news_embedding_dim]
+    def attend(self, user_state, candidate_news_representation):
+        news_num = candidate_news_representation.size(1)
+        return user_state['user_representation'].unsqueeze(dim=1).expand(-1, news_num, -1)
 
 # Our proposed model: CIDER - user encoder
 class CIDER(UserEncoder):
     def __init__(self, news_encoder, config):
         super(CIDER, self).__init__(news_encoder, config)
+        self.candidate_aware = True
         
         self.attention_dim = config.attention_dim
         self.graph_sage = GraphSAGE(in_channels = self.news_embedding_dim,
@@ -75,45 +135,33 @@ class CIDER(UserEncoder):
         
         return edge_index
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        batch_news_num = batch_size * news_num
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                  # [batch_size, max_history_num, news_embedding_dim]
-        
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
         # Create user-news bipartite graph
         edge_index = self.create_bipartite_graph(user_history_mask, history_embedding.device)
         
         # GNN convolution    
-        gcn_feature = self.graph_sage(history_embedding, edge_index)
-        gcn_feature = gcn_feature.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                 # [batch_size, news_num, max_history_num, news_embedding_dim]
-        
+        gcn_feature = self.graph_sage(history_embedding, edge_index)                                # [batch_size, max_history_num, news_embedding_dim]
+        K = self.K(gcn_feature)                                                                     # [batch_size, max_history_num, attention_dim]
+        return {'gcn_feature': gcn_feature, 'K': K}
+
+    def attend(self, user_state, candidate_news_representation):
         # Attention
-        K = self.K(gcn_feature).view([batch_news_num, self.max_history_num, self.attention_dim])            # [batch_size * news_num, max_history_num, attention_dim]
-        Q = self.Q(candidate_news_representation).view([batch_news_num, self.attention_dim, 1])             # [batch_size * news_num, attention_dim, 1]
-        a = torch.bmm(K, Q).view([batch_news_num, self.max_history_num]) / self.attention_scalar            # [batch_size * news_num, max_history_num]
-        alpha = F.softmax(a, dim=1)                                                                         # [batch_size * news_num, max_history_num]
-        # bmm input: [batch_size * news_num, 1, max_history_num]
-        # bmm mat2: [batch_size * news_num, max_history_num, news_embedding_dim]
-        # bmm out: [batch_size * news_num, 1, news_embedding_dim]
-        out = torch.bmm(alpha.unsqueeze(dim=1), gcn_feature.reshape([batch_news_num, self.max_history_num, self.news_embedding_dim]))       # [batch_size * news_num, 1, news_embedding_dim]
-        out = out.squeeze(dim=1).view([batch_size, news_num, self.news_embedding_dim])                                                      # [batch_size, news_num, news_embedding_dim]
+        Q = self.Q(candidate_news_representation)                                                   # [batch_size, news_num, attention_dim]
+        a = torch.bmm(Q, user_state['K'].transpose(1, 2)) / self.attention_scalar                   # [batch_size, news_num, max_history_num]
+        alpha = F.softmax(a, dim=2)                                                                 # [batch_size, news_num, max_history_num]
+        out = torch.bmm(alpha, user_state['gcn_feature'])                                           # [batch_size, news_num, news_embedding_dim]
         
-        user_representation = out # self.dropout(F.relu(self.affine(out), inplace=True) + out)                                                    # [batch_size, news_num, news_embedding_dim]
-        # Apply average 
-        # user_representation = gcn_feature.mean(dim=1).unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_num, news_embedding_dim]
+        user_representation = out # self.dropout(F.relu(self.affine(out), inplace=True) + out)      # [batch_size, news_num, news_embedding_dim]
         
-        return user_representation                                                          # [batch_size, news_num, news_embedding_dim]
+        return user_representation                                                                  # [batch_size, news_num, news_embedding_dim]
+
 
 
 class CIDER_backup(UserEncoder):
     def __init__(self, news_encoder, config):
         super(CIDER_backup, self).__init__(news_encoder, config)
         
-        self.multiheadAttention = MultiHeadAttention(config.head_num, self.news_embedding_dim, config.max_history_num, config.max_history_num, config.head_dim, config.head_dim)
+        self.multiheadAttention = MultiHeadAttention(config.head_num, self.news_embedding_dim, config.head_dim, config.head_dim)
         self.affine = nn.Linear(config.head_num * config.head_dim, self.news_embedding_dim, bias=True)
         self.attention = Attention(self.news_embedding_dim, config.attention_dim)
     
@@ -123,24 +171,19 @@ class CIDER_backup(UserEncoder):
         nn.init.zeros_(self.affine.bias)
         self.attention.initialize()
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                  # [batch_size, max_history_num, news_embedding_dim]
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
         # print('history_embedding shape: ', history_embedding.shape)
         h = self.multiheadAttention(history_embedding, history_embedding, history_embedding, user_history_mask) # [batch_size, max_history_num, head_num * head_dim]
         h = F.relu(F.dropout(self.affine(h), training=self.training, inplace=True), inplace=True)               # [batch_size, max_history_num, news_embedding_dim]
-        user_representation = self.attention(h).unsqueeze(dim=1).repeat(1, news_num, 1)                         # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        return {'user_representation': self.attention(h)}                                                       # [batch_size, news_embedding_dim]
+
 
 
 # Structural User Encoding(SUE)
 class SUE(UserEncoder):
     def __init__(self, news_encoder, config):
         super(SUE, self).__init__(news_encoder, config)
+        self.candidate_aware = True
         self.attention_dim = max(config.attention_dim, self.news_embedding_dim // 4)
         self.proxy_node_embedding = nn.Parameter(torch.zeros([config.category_num, self.news_embedding_dim]))
         # Input
@@ -156,7 +199,6 @@ class SUE(UserEncoder):
         self.dropout = nn.Dropout(p=config.dropout_rate, inplace=True)
         self.dropout_ = nn.Dropout(p=config.dropout_rate, inplace=False)
         self.category_num = config.category_num + 1 # extra one category index for padding news
-        self.max_history_num = config.max_history_num
         self.attention_scalar = math.sqrt(float(self.attention_dim))
 
     def initialize(self):
@@ -170,26 +212,26 @@ class SUE(UserEncoder):
         self.interClusterAttention.initialize()
 
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        batch_news_num = batch_size * news_num
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        batch_size = history_embedding.size(0)
         user_history_category_mask[:, -1] = 1
-        user_history_category_mask = user_history_category_mask.unsqueeze(dim=1).expand(-1, news_num, -1).contiguous()                                  # [batch_size, news_num, category_num]
-        user_history_category_indices = user_history_category_indices.unsqueeze(dim=1).expand(-1, news_num, -1)                                         # [batch_size, news_num, max_history_num]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
         # 1. GCN
         history_embedding = torch.cat([history_embedding, self.dropout_(self.proxy_node_embedding.unsqueeze(dim=0).expand(batch_size, -1, -1))], dim=1) # [batch_size, max_history_num + category_num, news_embedding_dim]
         gcn_feature = self.gcn(history_embedding, user_history_graph) + history_embedding                                                               # [batch_size, max_history_num + category_num, news_embedding_dim]
-        gcn_feature = gcn_feature[:, :self.max_history_num, :]                                                                                          # [batch_size, max_history_num, news_embedding_dim]
-        gcn_feature = gcn_feature.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                                                         # [batch_size, news_num, max_history_num, news_embedding_dim]
+        gcn_feature = gcn_feature[:, :user_history_mask.size(1), :]                                                                                     # [batch_size, max_history_num, news_embedding_dim]
+        K = self.intraCluster_K(gcn_feature)                                                                                                            # [batch_size, max_history_num, attention_dim]
+        return {'gcn_feature': gcn_feature, 'K': K, 'user_history_category_mask': user_history_category_mask, 'user_history_category_indices': user_history_category_indices}
+
+    def attend(self, user_state, candidate_news_representation):
+        batch_size = candidate_news_representation.size(0)
+        news_num = candidate_news_representation.size(1)
+        batch_news_num = batch_size * news_num
+        user_history_category_mask = user_state['user_history_category_mask'].unsqueeze(dim=1).expand(-1, news_num, -1).contiguous()                    # [batch_size, news_num, category_num]
+        user_history_category_indices = user_state['user_history_category_indices'].unsqueeze(dim=1).expand(-1, news_num, -1)                           # [batch_size, news_num, max_history_num]
+        gcn_feature = user_state['gcn_feature'].unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                                           # [batch_size, news_num, max_history_num, news_embedding_dim]
         # 2. Intra-cluster attention
-        K = self.intraCluster_K(gcn_feature).view([batch_news_num, self.max_history_num, self.attention_dim])                                           # [batch_size * news_num, max_history_num, attention_dim]
-        Q = self.intraCluster_Q(candidate_news_representation).view([batch_news_num, self.attention_dim, 1])                                            # [batch_size * news_num, attention_dim, 1]
-        a = torch.bmm(K, Q).view([batch_size, news_num, self.max_history_num]) / self.attention_scalar                                                  # [batch_size, news_num, max_history_num]
+        Q = self.intraCluster_Q(candidate_news_representation)                                                                                          # [batch_size, news_num, attention_dim]
+        a = torch.bmm(Q, user_state['K'].transpose(1, 2)) / self.attention_scalar                                                                       # [batch_size, news_num, max_history_num]
         alpha_intra = scatter_softmax(a, user_history_category_indices, 2).unsqueeze(dim=3)                                                             # [batch_size, news_num, max_history_num, 1]
         intra_cluster_feature = scatter_sum(alpha_intra * gcn_feature, user_history_category_indices, dim=2, dim_size=self.category_num)                # [batch_size, news_num, category_num, news_embedding_dim]
         # perform nonlinear transformation on intra-cluster features
@@ -197,12 +239,13 @@ class SUE(UserEncoder):
         # 3. Inter-cluster attention
         inter_cluster_feature = self.interClusterAttention(
             intra_cluster_feature.view([batch_news_num, self.category_num, self.news_embedding_dim]),
-            candidate_news_representation.view([batch_news_num, self.news_embedding_dim]),
+            candidate_news_representation.reshape([batch_news_num, self.news_embedding_dim]),
             mask=user_history_category_mask.view([batch_news_num, self.category_num])
         ).view([batch_size, news_num, self.news_embedding_dim])                                                                                         # [batch_size, news_num, news_embedding_dim]
         return inter_cluster_feature
 
 
+
 # LSTUR(Long Short-Term User Representations)
 class LSTUR(UserEncoder):
     def __init__(self, news_encoder, config):
@@ -217,47 +260,25 @@ class LSTUR(UserEncoder):
             else:
                 nn.init.zeros_(parameter.data)
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        user_history_num = user_history_mask.sum(dim=1, keepdim=False).long()                                                                           # [batch_size]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                               user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
-        sorted_user_history_num, sorted_indices = torch.sort(user_history_num, descending=True)                                                         # [batch_size]
-        _, desorted_indices = torch.sort(sorted_indices, descending=False)                                                                              # [batch_size]
-        nonzero_indices = sorted_user_history_num.nonzero(as_tuple=False).squeeze(dim=1)
-        if nonzero_indices.size(0) == 0:
-            user_representation = user_embedding.unsqueeze(dim=1).expand(-1, news_num, -1)                                                              # [batch_size, news_num, news_embedding_dim]  
-            return user_representation
-        index = nonzero_indices[-1]
-        if index + 1 == batch_size:
-            sorted_user_embedding = user_embedding.index_select(0, sorted_indices)                                                                      # [batch_size, user_embedding_dim]
-            if self.training and self.masking_probability != 1.0:
-                sorted_user_embedding *= torch.bernoulli(torch.empty([batch_size, 1], device=self.device).fill_(self.masking_probability))              # [batch_size, user_embedding_dim]
-            sorted_history_embedding = history_embedding.index_select(0, sorted_indices)                                                                # [batch_size, max_history_num, news_embedding_dim]
-            packed_sorted_history_embedding = pack_padded_sequence(sorted_history_embedding, sorted_user_history_num.cpu(), batch_first=True)           # [batch_size, max_history_num, news_embedding_dim]
-            _, h = self.gru(packed_sorted_history_embedding, sorted_user_embedding.unsqueeze(dim=0))                                                    # [1, batch_size, news_embedding_dim]
-            user_representation = h.squeeze(dim=0).index_select(0, desorted_indices)                                                                    # [batch_size, news_embedding_dim]
-        else:
-            non_empty_indices = sorted_indices[:index+1]
-            empty_indices = sorted_indices[index+1:]
-            sorted_user_embedding = user_embedding.index_select(0, non_empty_indices)                                                                   # [batch_size, user_embedding_dim]
-            if self.training and self.masking_probability != 1.0:
-                sorted_user_embedding *= torch.bernoulli(torch.empty([index + 1, 1], device=self.device).fill_(self.masking_probability))               # [batch_size, user_embedding_dim]
-            sorted_history_embedding = history_embedding.index_select(0, non_empty_indices)                                                             # [batch_size, max_history_num, news_embedding_dim]
-            packed_sorted_history_embedding = pack_padded_sequence(sorted_history_embedding, sorted_user_history_num[:index+1].cpu(), batch_first=True) # [batch_size, max_history_num, news_embedding_dim]
-            _, h = self.gru(packed_sorted_history_embedding, sorted_user_embedding.unsqueeze(dim=0))                                                    # [1, batch_size, news_embedding_dim]
-            user_representation = torch.cat([h.squeeze(dim=0), user_embedding.index_select(0, empty_indices)], dim=0).index_select(0, desorted_indices) # [batch_size, news_embedding_dim]
-        user_representation = user_representation.unsqueeze(dim=1).expand(-1, news_num, -1)                                                             # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        packed_history_embedding, non_empty_index = pack_histories(history_embedding, user_history_mask)
+        if packed_history_embedding is None:
+            return {'user_representation': user_embedding}                                                                                              # [batch_size, news_embedding_dim]
+        initial_user_embedding = user_embedding[non_empty_index]                                                                                        # [non_empty_num, user_embedding_dim]
+        if self.training and self.masking_probability != 1.0:
+            initial_user_embedding = initial_user_embedding * torch.bernoulli(torch.empty([initial_user_embedding.size(0), 1], device=self.device).fill_(self.masking_probability))
+        _, h = self.gru(packed_history_embedding, initial_user_embedding.unsqueeze(dim=0))                                                              # [1, non_empty_num, news_embedding_dim]
+        if h.size(1) == user_embedding.size(0):
+            return {'user_representation': h.squeeze(dim=0)}                                                                                            # [batch_size, news_embedding_dim]
+        user_representation = user_embedding.clone()                                                                                                    # [batch_size, news_embedding_dim]
+        user_representation[non_empty_index] = h.squeeze(dim=0)
+        return {'user_representation': user_representation}
 
 
 class MHSA(UserEncoder):
     def __init__(self, news_encoder, config):
         super(MHSA, self).__init__(news_encoder, config)
-        self.multiheadAttention = MultiHeadAttention(config.head_num, self.news_embedding_dim, config.max_history_num, config.max_history_num, config.head_dim, config.head_dim)
+        self.multiheadAttention = MultiHeadAttention(config.head_num, self.news_embedding_dim, config.head_dim, config.head_dim)
         self.affine = nn.Linear(config.head_num*config.head_dim, self.news_embedding_dim, bias=True)
         self.attention = Attention(self.news_embedding_dim, config.attention_dim)
 
@@ -267,16 +288,11 @@ class MHSA(UserEncoder):
         nn.init.zeros_(self.affine.bias)
         self.attention.initialize()
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                  # [batch_size, max_history_num, news_embedding_dim]
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
         h = self.multiheadAttention(history_embedding, history_embedding, history_embedding, user_history_mask) # [batch_size, max_history_num, head_num * head_dim]
         h = F.relu(F.dropout(self.affine(h), training=self.training, inplace=True), inplace=True)               # [batch_size, max_history_num, news_embedding_dim]
-        user_representation = self.attention(h).unsqueeze(dim=1).repeat(1, news_num, 1)                         # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        return {'user_representation': self.attention(h)}                                                       # [batch_size, news_embedding_dim]
+
 
 # NPA - user encoder
 class PUE(UserEncoder):
@@ -290,15 +306,10 @@ class PUE(UserEncoder):
         nn.init.zeros_(self.dense.bias) # for dense layer
         self.personalizedAttention.initialize() # for attention layer
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                # [batch_size, max_history_num, news_embedding_dim]
-        q_d = F.relu(self.dense(user_embedding), inplace=True)                                                                                # [batch_size, personalized_embedding_dim]
-        user_representation = self.personalizedAttention(history_embedding, q_d, user_history_mask).unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        q_d = F.relu(self.dense(user_embedding), inplace=True)                                                # [batch_size, personalized_embedding_dim]
+        return {'user_representation': self.personalizedAttention(history_embedding, q_d, user_history_mask)} # [batch_size, news_embedding_dim]
+
 
 
 class ATT(UserEncoder):
@@ -309,19 +320,15 @@ class ATT(UserEncoder):
     def initialize(self):
         self.attention.initialize()
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)            # [batch_size, max_history_num, news_embedding_dim]
-        user_representation = self.attention(history_embedding).unsqueeze(dim=1).expand(-1, news_num, -1) # [batch_size, news_embedding_dim]
-        return user_representation
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        return {'user_representation': self.attention(history_embedding)} # [batch_size, news_embedding_dim]
+
 
 
 class CATT(UserEncoder):
     def __init__(self, news_encoder, config):
         super(CATT, self).__init__(news_encoder, config)
+        self.candidate_aware = True
         self.affine1 = nn.Linear(self.news_embedding_dim * 2, config.attention_dim, bias=True)
         self.affine2 = nn.Linear(config.attention_dim, 1, bias=True)
         self.max_history_num = config.max_history_num
@@ -332,23 +339,21 @@ class CATT(UserEncoder):
         nn.init.xavier_uniform_(self.affine2.weight)
         nn.init.zeros_(self.affine2.bias)
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                  # [batch_size, max_history_num, news_embedding_dim]
-        user_history_mask = user_history_mask.unsqueeze(dim=1).expand(-1, news_num, -1)                                         # [batch_size, news_num, max_history_num]
-        candidate_news_representation = candidate_news_representation.unsqueeze(dim=2).expand(-1, -1, self.max_history_num, -1) # [batch_size, news_num, max_history_num, news_embedding_dim]
-        history_embedding = history_embedding.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                     # [batch_size, news_num, max_history_num, news_embedding_dim]
-        concat_embeddings = torch.cat([candidate_news_representation, history_embedding], dim=3)                                # [batch_size, news_num, max_history_num, news_embedding_dim * 2]
-        hidden = F.relu(self.affine1(concat_embeddings), inplace=True)                                                          # [batch_size, news_num, max_history_num, attention_dim]
-        a = self.affine2(hidden).squeeze(dim=3)                                                                                 # [batch_size, news_num, max_history_num]
-        alpha = F.softmax(a.masked_fill(user_history_mask == 0, -1e9), dim=2)                                                   # [batch_size, news_num, max_history_num]
-        user_representation = (alpha.unsqueeze(dim=3) * history_embedding).sum(dim=2, keepdim=False)                            # [batch_size, news_num, news_embedding_dim]
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        # affine1 is applied to [candidate ; history], so its history half is projected once per user
+        history_key = F.linear(history_embedding, self.affine1.weight[:, self.news_embedding_dim:])                                            # [batch_size, max_history_num, attention_dim]
+        return {'history_embedding': history_embedding, 'history_key': history_key, 'user_history_mask': user_history_mask}
+
+    def attend(self, user_state, candidate_news_representation):
+        candidate_key = F.linear(candidate_news_representation, self.affine1.weight[:, :self.news_embedding_dim], self.affine1.bias)          # [batch_size, news_num, attention_dim]
+        hidden = F.relu(candidate_key.unsqueeze(dim=2) + user_state['history_key'].unsqueeze(dim=1), inplace=True)                            # [batch_size, news_num, max_history_num, attention_dim]
+        a = self.affine2(hidden).squeeze(dim=3)                                                                                               # [batch_size, news_num, max_history_num]
+        alpha = F.softmax(a.masked_fill(user_state['user_history_mask'].unsqueeze(dim=1) == 0, -1e9), dim=2)                                  # [batch_size, news_num, max_history_num]
+        user_representation = torch.bmm(alpha, user_state['history_embedding'])                                                              # [batch_size, news_num, news_embedding_dim]
         return user_representation
 
 
+
 class GRU(UserEncoder):
     def __init__(self, news_encoder, config):
         super(GRU, self).__init__(news_encoder, config)
@@ -364,34 +369,15 @@ class GRU(UserEncoder):
         nn.init.xavier_uniform_(self.dec.weight, gain=nn.init.calculate_gain('tanh'))
         nn.init.zeros_(self.dec.bias)
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        user_history_num = user_history_mask.sum(dim=1, keepdim=False).long()                                                                           # [batch_size]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                          # [batch_size, max_history_num, news_embedding_dim]
-        sorted_user_history_num, sorted_indices = torch.sort(user_history_num, descending=True)                                                         # [batch_size]
-        _, desorted_indices = torch.sort(sorted_indices, descending=False)                                                                              # [batch_size]
-        nonzero_indices = sorted_user_history_num.nonzero(as_tuple=False).squeeze(dim=1)
-        if nonzero_indices.size(0) == 0:
-            user_representation = torch.zeros([batch_size, news_num, self.news_embedding_dim], device=self.device)                                      # [batch_size, news_num, news_embedding_dim]
-            return user_representation
-        index = nonzero_indices[-1]
-        if index + 1 == batch_size:
-            sorted_history_embedding = history_embedding.index_select(0, sorted_indices)                                                                # [batch_size, max_history_num, news_embedding_dim]
-            packed_sorted_history_embedding = pack_padded_sequence(sorted_history_embedding, sorted_user_history_num.cpu(), batch_first=True)           # [batch_size, max_history_num, news_embedding_dim]
-            _, h = self.gru(packed_sorted_history_embedding)                                                                                            # [1, batch_size, news_embedding_dim]
-            h = torch.tanh(self.dec(h.squeeze(dim=0)))                                                                                                  # [batch_size, news_embedding_dim]
-            user_representation = h.index_select(0, desorted_indices)                                                                                   # [batch_size, news_embedding_dim]
-        else:
-            non_empty_indices = sorted_indices[:index+1]
-            sorted_history_embedding = history_embedding.index_select(0, non_empty_indices)                                                             # [batch_size, max_history_num, news_embedding_dim]
-            packed_sorted_history_embedding = pack_padded_sequence(sorted_history_embedding, sorted_user_history_num[:index+1].cpu(), batch_first=True) # [batch_size, max_history_num, news_embedding_dim]
-            _, h = self.gru(packed_sorted_history_embedding)                                                                                            # [1, batch_size, news_embedding_dim]
-            h = torch.tanh(self.dec(h.squeeze(dim=0)))                                                                                                  # [batch_size, news_embedding_dim]
-            user_representation = torch.cat([h, torch.zeros([batch_size - 1 - index, self.news_embedding_dim], device=self.device)], \
-                                            dim=0).index_select(0, desorted_indices)                                                                    # [batch_size, news_embedding_dim]
-        user_representation = user_representation.unsqueeze(dim=1).expand(-1, news_num, -1)                                                             # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        batch_size = history_embedding.size(0)
+        packed_history_embedding, non_empty_index = pack_histories(history_embedding, user_history_mask)
+        if packed_history_embedding is None:
+            return {'user_representation': torch.zeros([batch_size, self.news_embedding_dim], device=self.device)}                                      # [batch_size, news_embedding_dim]
+        _, h = self.gru(packed_history_embedding)                                                                                                       # [1, non_empty_num, hidden_dim]
+        h = torch.tanh(self.dec(h.squeeze(dim=0)))                                                                                                      # [non_empty_num, news_embedding_dim]
+        if h.size(0) == batch_size:
+            return {'user_representation': h}                                                                                                           # [batch_size, news_embedding_dim]
+        user_representation = torch.zeros([batch_size, self.news_embedding_dim], device=self.device)                                                    # [batch_size, news_embedding_dim]
+        user_representation[non_empty_index] = h
+        return {'user_representation': user_representation}
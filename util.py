@@ -1,72 +1,198 @@
 # -*- coding: utf-8 -*- 
 import os
+import threading
+import numpy as np
 import torch
 import torch.nn as nn
 from corpus import Corpus
-from dataset import DevTest_Dataset
+from dataset import DevTest_Impression_Dataset, CandidateNum_BatchSampler, gather_news
 from torch.utils.data import DataLoader
-from evaluate import scoring
+from evaluate import impression_ranks, ranking_metrics
 
 
+# Encode the news of news_index with the news encoder of the model
+# Output
+# news_representation : [len(news_index), news_embedding_dim]
+def encode_news(model, corpus, news_index):
+    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity = \
+        [feature.cuda(non_blocking=True).unsqueeze(dim=1) for feature in gather_news(corpus, news_index)]
+    return model.news_encoder(news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, news_category, news_subCategory, None).squeeze(dim=1)
+
+
+# Encode every news of the corpus once, in chunks of batch_size * max_history_num news (as many as the history news of a former evaluation batch)
+# Output
+# news_representation : [news_num, news_embedding_dim]
+def compute_news_representations(model, corpus, batch_size):
+    chunk_size = batch_size * corpus.max_history_num
+    news_representation = torch.zeros([corpus.news_num, model.news_embedding_dim]).cuda()
+    # with dynamic padding, the news are encoded in ascending text length, so that each chunk is trimmed to similar lengths
+    news_order = np.lexsort((corpus.news_title_length, corpus.news_abstract_length)) if corpus.dynamic_padding else np.arange(corpus.news_num)
+    for start in range(0, corpus.news_num, chunk_size):
+        news_index = news_order[start:start + chunk_size]
+        news_representation[torch.from_numpy(news_index).cuda()] = encode_news(model, corpus, news_index) # [chunk_size, news_embedding_dim]
+    return news_representation
+
+
+# Encode the body branch of the news encoder (frozen, see NewsEncoder.body_feature) for every news once, into the memory-mapped .npy feature_file
+# Output
+# news_body_feature : [news_num, *body_feature_shape] (read-only memory map)
+def precompute_body_features(model, corpus, batch_size, feature_file):
+    chunk_size = batch_size * corpus.max_history_num
+    news_body_feature = np.lib.format.open_memmap(feature_file, mode='w+', dtype=np.float32, shape=(corpus.news_num, ) + model.news_encoder.body_feature_shape)
+    news_order = np.lexsort((corpus.news_title_length, corpus.news_abstract_length)) if corpus.dynamic_padding else np.arange(corpus.news_num)
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        for start in range(0, corpus.news_num, chunk_size):
+            news_index = news_order[start:start + chunk_size]
+            _, _, _, _, _, news_content_text, news_content_mask, _ = gather_news(corpus, news_index)
+            body_feature = model.news_encoder.body_feature(news_content_text.cuda(non_blocking=True), news_content_mask.cuda(non_blocking=True)).cpu().numpy() # [chunk_size, *body_feature_shape]
+            # with dynamic padding, sequence features are trimmed to the longest body of the chunk (the rest of the file stays zero)
+            news_body_feature[(news_index, ) + tuple(slice(0, size) for size in body_feature.shape[1:])] = body_feature
+    model.train(training)
+    news_body_feature.flush()
+    del news_body_feature
+    return np.load(feature_file, mmap_mode='r')
+
+
+# Staleness-bounded cache of the news representations, from which the history news of the training batches are read without gradient
+# The whole cache is re-encoded every refresh_steps training steps (only once if refresh_steps is non-positive), and with a positive max_age,
+# the history news of a batch encoded more than max_age steps ago are re-encoded before use
+# The news are encoded in evaluation mode without gradient, as by compute_news_representations
+class HistoryNewsCache:
+    def __init__(self, model, corpus, batch_size, refresh_steps, max_age):
+        self.model = model
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.refresh_steps = refresh_steps
+        self.max_age = max_age
+        self.step = 0
+        self.news_representation = None                                                    # [news_num, news_embedding_dim] (None until the next full encoding)
+        self.encoded_step = torch.zeros([corpus.news_num], dtype=torch.long).cuda()        # [news_num] (training step of the cached representation of each news)
+
+    def encode(self, news_index=None):
+        training = self.model.training
+        self.model.eval()
+        with torch.no_grad():
+            if news_index is None:
+                self.news_representation = compute_news_representations(self.model, self.corpus, self.batch_size)
+                self.encoded_step.fill_(self.step)
+            else:
+                chunk_size = self.batch_size * self.corpus.max_history_num
+                for start in range(0, news_index.size(0), chunk_size):
+                    chunk_index = news_index[start:start + chunk_size]
+                    self.news_representation[chunk_index] = encode_news(self.model, self.corpus, chunk_index.cpu().numpy())
+                self.encoded_step[news_index] = self.step
+        self.model.train(training)
+
+    # Input
+    # user_history        : [batch_size, max_history_num]
+    # Output
+    # history_embedding   : [batch_size, max_history_num, news_embedding_dim]
+    def lookup(self, user_history):
+        if self.news_representation is None:
+            self.encode()
+        elif self.max_age > 0:
+            news_index = torch.unique(user_history)
+            stale_news_index = news_index[self.step - self.encoded_step[news_index] > self.max_age]
+            if stale_news_index.size(0) > 0:
+                self.encode(stale_news_index)
+        return self.news_representation[user_history]
+
+    # Called after each optimizer step
+    def advance(self):
+        self.step += 1
+        if self.refresh_steps > 0 and self.step % self.refresh_steps == 0:
+            self.news_representation = None
+
+
+# Output
+# AUC, MRR, nDCG@5 and nDCG@10 of the labeled dev & test impressions (None for unlabeled test impressions)
+# The rank file is written to result_file unless it is None
 def compute_scores(model, corpus, batch_size, mode, result_file, dataset):
     assert mode in ['dev', 'test'], 'mode must be chosen from \'dev\' or \'test\''
-    dataloader = DataLoader(DevTest_Dataset(corpus, mode), batch_size=batch_size, shuffle=False, num_workers=batch_size // 16, pin_memory=True)
+    # news representations are encoded once and gathered for history and candidate news, unless the news encoder depends on the user
+    precomputed_news = model.news_precomputable
+    impression_dataset = DevTest_Impression_Dataset(corpus, mode, precomputed_news=precomputed_news)
+    # with precomputed news representations, no news is encoded per batch, so each batch holds batch_size impressions (the user encoder then runs at batch_size)
+    # otherwise, each batch holds at most batch_size candidate slots, so that the per-candidate user representations take as much memory as the former per-candidate batches
+    # with dynamic padding, the impressions of a candidate number are also bucketed by history number
+    history_num = impression_dataset.behaviors.history_length if corpus.dynamic_padding else None
+    if precomputed_news:
+        batch_sampler = CandidateNum_BatchSampler(impression_dataset.candidate_num, history_num=history_num, max_impression_num=batch_size)
+    else:
+        batch_sampler = CandidateNum_BatchSampler(impression_dataset.candidate_num, batch_size, history_num=history_num)
+    dataloader = DataLoader(impression_dataset, batch_size=None, sampler=batch_sampler, num_workers=batch_size // 16, pin_memory=True)
     indices = (corpus.dev_indices if mode == 'dev' else corpus.test_indices)
     scores = torch.zeros([len(indices)]).cuda()
-    index = 0
     torch.cuda.empty_cache()
     model.eval()
     with torch.no_grad():
-        for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-             news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) in dataloader:
-            user_ID = user_ID.cuda(non_blocking=True)
-            user_category = user_category.cuda(non_blocking=True)
-            user_subCategory = user_subCategory.cuda(non_blocking=True)
-            user_title_text = user_title_text.cuda(non_blocking=True)
-            user_title_mask = user_title_mask.cuda(non_blocking=True)
-            user_title_entity = user_title_entity.cuda(non_blocking=True)
-            user_content_text = user_content_text.cuda(non_blocking=True)
-            user_content_mask = user_content_mask.cuda(non_blocking=True)
-            user_content_entity = user_content_entity.cuda(non_blocking=True)
-            user_history_mask = user_history_mask.cuda(non_blocking=True)
-            user_history_graph = user_history_graph.cuda(non_blocking=True)
-            user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)
-            user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)
-            news_category = news_category.cuda(non_blocking=True)
-            news_subCategory = news_subCategory.cuda(non_blocking=True)
-            news_title_text = news_title_text.cuda(non_blocking=True)
-            news_title_mask = news_title_mask.cuda(non_blocking=True)
-            news_title_entity = news_title_entity.cuda(non_blocking=True)
-            news_content_text = news_content_text.cuda(non_blocking=True)
-            news_content_mask = news_content_mask.cuda(non_blocking=True)
-            news_content_entity = news_content_entity.cuda(non_blocking=True)
-            batch_size = user_ID.size(0)
-            news_category = news_category.unsqueeze(dim=1)
-            news_subCategory = news_subCategory.unsqueeze(dim=1)
-            news_title_text = news_title_text.unsqueeze(dim=1)
-            news_title_mask = news_title_mask.unsqueeze(dim=1)
-            news_content_text = news_content_text.unsqueeze(dim=1)
-            news_content_mask = news_content_mask.unsqueeze(dim=1)
-            scores[index: index+batch_size] = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
-                                                    news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity).squeeze(dim=1) # [batch_size]
-            index += batch_size
-    scores = scores.tolist()
-    sub_scores = [[] for _ in range(indices[-1] + 1)]
-    for i, index in enumerate(indices):
-        sub_scores[index].append([scores[i], len(sub_scores[index])])
-    with open(result_file, 'w', encoding='utf-8') as result_f:
-        for i, sub_score in enumerate(sub_scores):
-            sub_score.sort(key=lambda x: x[0], reverse=True)
-            result = [0 for _ in range(len(sub_score))]
-            for j in range(len(sub_score)):
-                result[sub_score[j][1]] = j + 1
-            result_f.write(('' if i == 0 else '\n') + str(i + 1) + ' ' + str(result).replace(' ', ''))
-    if dataset != 'large' or mode != 'test':
-        with open(mode + '/ref/truth-%s.txt' % dataset, 'r', encoding='utf-8') as truth_f, open(result_file, 'r', encoding='utf-8') as result_f:
-            auc, mrr, ndcg5, ndcg10 = scoring(truth_f, result_f)
-        return auc, mrr, ndcg5, ndcg10
+        if precomputed_news:
+            news_representation = compute_news_representations(model, corpus, batch_size)
+            for (user_ID, user_history, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, candidate_news, candidate_index, candidate_mask) in dataloader:
+                user_ID = user_ID.cuda(non_blocking=True)
+                user_history = user_history.cuda(non_blocking=True)
+                user_history_mask = user_history_mask.cuda(non_blocking=True)
+                user_history_graph = user_history_graph.cuda(non_blocking=True)
+                user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)
+                user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)
+                candidate_news = candidate_news.cuda(non_blocking=True)
+                candidate_index = candidate_index.cuda(non_blocking=True)
+                candidate_mask = candidate_mask.cuda(non_blocking=True)
+                logits = model.score(user_ID, news_representation[user_history.long()], user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, news_representation[candidate_news.long()]) # [batch_size, candidate_num]
+                scores[candidate_index[candidate_mask]] = logits[candidate_mask]
+        else:
+            for (user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                 news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity, candidate_index, candidate_mask) in dataloader:
+                user_ID = user_ID.cuda(non_blocking=True)
+                user_category = user_category.cuda(non_blocking=True)
+                user_subCategory = user_subCategory.cuda(non_blocking=True)
+                user_title_text = user_title_text.cuda(non_blocking=True)
+                user_title_mask = user_title_mask.cuda(non_blocking=True)
+                user_title_entity = user_title_entity.cuda(non_blocking=True)
+                user_content_text = user_content_text.cuda(non_blocking=True)
+                user_content_mask = user_content_mask.cuda(non_blocking=True)
+                user_content_entity = user_content_entity.cuda(non_blocking=True)
+                user_history_mask = user_history_mask.cuda(non_blocking=True)
+                user_history_graph = user_history_graph.cuda(non_blocking=True)
+                user_history_category_mask = user_history_category_mask.cuda(non_blocking=True)
+                user_history_category_indices = user_history_category_indices.cuda(non_blocking=True)
+                news_category = news_category.cuda(non_blocking=True)
+                news_subCategory = news_subCategory.cuda(non_blocking=True)
+                news_title_text = news_title_text.cuda(non_blocking=True)
+                news_title_mask = news_title_mask.cuda(non_blocking=True)
+                news_title_entity = news_title_entity.cuda(non_blocking=True)
+                news_content_text = news_content_text.cuda(non_blocking=True)
+                news_content_mask = news_content_mask.cuda(non_blocking=True)
+                news_content_entity = news_content_entity.cuda(non_blocking=True)
+                candidate_index = candidate_index.cuda(non_blocking=True)
+                candidate_mask = candidate_mask.cuda(non_blocking=True)
+                logits = model(user_ID, user_category, user_subCategory, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, \
+                               news_category, news_subCategory, news_title_text, news_title_mask, news_title_entity, news_content_text, news_content_mask, news_content_entity) # [batch_size, candidate_num]
+                scores[candidate_index[candidate_mask]] = logits[candidate_mask]
+    behaviors = corpus.dev_behaviors if mode == 'dev' else corpus.test_behaviors
+    ranks = impression_ranks(scores.cpu().numpy(), behaviors.candidate_offsets) # [candidate_num]
+    # the rank file is written by a background thread while the metrics are computed in memory, and the thread is joined before returning,
+    # so that the rank file (mandatory for the unlabeled large test) is complete once compute_scores returns
+    writer = None
+    if result_file is not None:
+        writer = threading.Thread(target=write_prediction_file, args=(result_file, ranks, behaviors.candidate_offsets))
+        writer.start()
+    if hasattr(behaviors, 'candidate_label'):
+        metrics = ranking_metrics(behaviors.candidate_label, ranks, behaviors.candidate_offsets)
     else:
-        return None, None, None, None
+        metrics = None, None, None, None
+    if writer is not None:
+        writer.join()
+    return metrics
+
+
+# Rank file of MIND format : one line "impression_index [rank_1,...,rank_n]" per impression
+def write_prediction_file(result_file, ranks, impression_offsets):
+    ranks = ranks.tolist()
+    with open(result_file, 'w', encoding='utf-8') as result_f:
+        result_f.write('\n'.join(str(i + 1) + ' [' + ','.join(map(str, ranks[impression_offsets[i]:impression_offsets[i + 1]])) + ']' for i in range(len(impression_offsets) - 1)))
 
 
 def get_run_index(result_dir):
@@ -14,7 +14,6 @@ from userEncoders import UserEncoder
 class CNE_Title(NewsEncoder):
     def __init__(self, config):
         super(CNE_Title, self).__init__(config)
-        self.max_title_length = config.max_title_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 2 + config.category_embedding_dim + config.subCategory_embedding_dim
@@ -36,18 +35,15 @@ class CNE_Title(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        title_mask = title_mask.view([batch_news_num, self.max_title_length])                                                         # [batch_size * news_num, max_title_length]
+        title_mask = title_mask.view([batch_news_num, -1])                                                                            # [batch_size * news_num, max_title_length]
         title_mask[:, 0] = 1 # To avoid empty input of LSTM
-        title_length = title_mask.sum(dim=1, keepdim=False).long()                                                                    # [batch_size * news_num]
-        sorted_title_length, sorted_title_indices = torch.sort(title_length, descending=True)                                         # [batch_size * news_num]
-        _, desorted_title_indices = torch.sort(sorted_title_indices, descending=False)                                                # [batch_size * news_num]
+        title_length = title_mask.sum(dim=1, keepdim=False).long().cpu()                                                              # [batch_size * news_num]
         # 1. word embedding
-        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])  # [batch_size * news_num, max_title_length, word_embedding_dim]
-        sorted_title = pack_padded_sequence(title.index_select(0, sorted_title_indices), sorted_title_length.cpu(), batch_first=True) # [batch_size * news_num, max_title_length, word_embedding_dim]
+        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                     # [batch_size * news_num, max_title_length, word_embedding_dim]
+        packed_title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False)                              # [batch_size * news_num, max_title_length, word_embedding_dim]
         # 2. LSTM encoding
-        sorted_title_h, (sorted_title_h_n, sorted_title_c_n) = self.title_lstm(sorted_title)
-        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=self.max_title_length)                 # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        title_h = sorted_title_h.index_select(0, desorted_title_indices)                                                              # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        title_h, (title_h_n, title_c_n) = self.title_lstm(packed_title)
+        title_h, _ = pad_packed_sequence(title_h, batch_first=True, total_length=title_text.size(2))                                  # [batch_size * news_num, max_title_length, hidden_dim * 2]
         # 3. self-attention
         title_self = self.title_self_attention(title_h, title_mask).view([batch_size, news_num, self.hidden_dim * 2])                 # [batch_size * news_num, hidden_dim * 2]
         # 4. feature fusion
@@ -58,7 +54,6 @@ class CNE_Title(NewsEncoder):
 class CNE_Content(NewsEncoder):
     def __init__(self, config):
         super(CNE_Content, self).__init__(config)
-        self.max_content_length = config.max_abstract_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 2 + config.category_embedding_dim + config.subCategory_embedding_dim
@@ -80,18 +75,15 @@ class CNE_Content(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        content_mask = content_mask.view([batch_news_num, self.max_content_length])                                                           # [batch_size * news_num, max_content_length]
+        content_mask = content_mask.view([batch_news_num, -1])                                                                                # [batch_size * news_num, max_content_length]
         content_mask[:, 0] = 1 # To avoid empty input of LSTM
-        content_length = content_mask.sum(dim=1, keepdim=False).long()                                                                        # [batch_size * news_num]
-        sorted_content_length, sorted_content_indices = torch.sort(content_length, descending=True)                                           # [batch_size * news_num]
-        _, desorted_content_indices = torch.sort(sorted_content_indices, descending=False)                                                    # [batch_size * news_num]
+        content_length = content_mask.sum(dim=1, keepdim=False).long().cpu()                                                                  # [batch_size * news_num]
         # 1. word embedding
-        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim])    # [batch_size * news_num, max_content_length, word_embedding_dim]
-        sorted_content = pack_padded_sequence(content.index_select(0, sorted_content_indices), sorted_content_length.cpu(), batch_first=True) # [batch_size * news_num, max_content_length, word_embedding_dim]
+        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                         # [batch_size * news_num, max_content_length, word_embedding_dim]
+        packed_content = pack_padded_sequence(content, content_length, batch_first=True, enforce_sorted=False)                                # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. LSTM encoding
-        sorted_content_h, (sorted_content_h_n, sorted_content_c_n) = self.content_lstm(sorted_content)
-        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=self.max_content_length)                   # [batch_size * news_num, max_content_length, hidden_dim * 2]
-        content_h = sorted_content_h.index_select(0, desorted_content_indices)                                                                # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        content_h, (content_h_n, content_c_n) = self.content_lstm(packed_content)
+        content_h, _ = pad_packed_sequence(content_h, batch_first=True, total_length=content_text.size(2))                                    # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # 3. self-attention
         content_self = self.content_self_attention(content_h, content_mask).view([batch_size, news_num, self.hidden_dim * 2])                 # [batch_size * news_num, hidden_dim * 2]
         # 4. feature fusion
@@ -102,7 +94,6 @@ class CNE_Content(NewsEncoder):
 class NAML_Title(NewsEncoder):
     def __init__(self, config):
         super(NAML_Title, self).__init__(config)
-        self.max_title_length = config.max_title_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.news_embedding_dim = config.cnn_kernel_num
         self.title_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
@@ -128,7 +119,7 @@ class NAML_Title(NewsEncoder):
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
         # 1. word embedding
-        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim]) # [batch_size * news_num, word_embedding_dim, max_title_length]
+        title_w = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                    # [batch_size * news_num, word_embedding_dim, max_title_length]
         # 2. CNN encoding
         title_c = self.dropout_(self.title_conv(title_w.permute(0, 2, 1)).permute(0, 2, 1))                                            # [batch_size * news_num, max_title_length, cnn_kernel_num]
         # 3. attention layer
@@ -146,7 +137,6 @@ class NAML_Title(NewsEncoder):
 class NAML_Content(NewsEncoder):
     def __init__(self, config):
         super(NAML_Content, self).__init__(config)
-        self.max_content_length = config.max_abstract_length
         self.cnn_kernel_num = config.cnn_kernel_num
         self.news_embedding_dim = config.cnn_kernel_num
         self.content_conv = Conv1D(config.cnn_method, config.word_embedding_dim, config.cnn_kernel_num, config.cnn_window_size)
@@ -172,7 +162,7 @@ class NAML_Content(NewsEncoder):
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
         # 1. word embedding
-        content_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim]) # [batch_size * news_num, max_content_length, word_embedding_dim]
+        content_w = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                      # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. CNN encoding
         content_c = self.dropout_(self.content_conv(content_w.permute(0, 2, 1)).permute(0, 2, 1))                                            # [batch_size * news_num, max_content_length, cnn_kernel_num]
         # 3. attention layer
@@ -190,8 +180,6 @@ class NAML_Content(NewsEncoder):
 class CNE_wo_CS(NewsEncoder):
     def __init__(self, config):
         super(CNE_wo_CS, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 4 + config.category_embedding_dim + config.subCategory_embedding_dim
@@ -226,28 +214,22 @@ class CNE_wo_CS(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        title_mask = title_mask.view([batch_news_num, self.max_title_length])                                                                              # [batch_size * news_num, max_title_length]
-        content_mask = content_mask.view([batch_news_num, self.max_content_length])                                                                        # [batch_size * news_num, max_content_length]
+        title_mask = title_mask.view([batch_news_num, -1])                                                                                                 # [batch_size * news_num, max_title_length]
+        content_mask = content_mask.view([batch_news_num, -1])                                                                                             # [batch_size * news_num, max_content_length]
         title_mask[:, 0] = 1   # To avoid empty input of LSTM
         content_mask[:, 0] = 1 # To avoid empty input of LSTM
-        title_length = title_mask.sum(dim=1, keepdim=False).long()                                                                                         # [batch_size * news_num]
-        content_length = content_mask.sum(dim=1, keepdim=False).long()                                                                                     # [batch_size * news_num]
-        sorted_title_length, sorted_title_indices = torch.sort(title_length, descending=True)                                                              # [batch_size * news_num]
-        _, desorted_title_indices = torch.sort(sorted_title_indices, descending=False)                                                                     # [batch_size * news_num]
-        sorted_content_length, sorted_content_indices = torch.sort(content_length, descending=True)                                                        # [batch_size * news_num]
-        _, desorted_content_indices = torch.sort(sorted_content_indices, descending=False)                                                                 # [batch_size * news_num]
+        title_length = title_mask.sum(dim=1, keepdim=False).long().cpu()                                                                                   # [batch_size * news_num]
+        content_length = content_mask.sum(dim=1, keepdim=False).long().cpu()                                                                               # [batch_size * news_num]
         # 1. word embedding
-        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])                       # [batch_size * news_num, max_title_length, word_embedding_dim]
-        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim])                 # [batch_size * news_num, max_content_length, word_embedding_dim]
-        sorted_title = pack_padded_sequence(title.index_select(0, sorted_title_indices), sorted_title_length.cpu(), batch_first=True)                      # [batch_size * news_num, max_title_length, word_embedding_dim]
-        sorted_content = pack_padded_sequence(content.index_select(0, sorted_content_indices), sorted_content_length.cpu(), batch_first=True)              # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                                          # [batch_size * news_num, max_title_length, word_embedding_dim]
+        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                                      # [batch_size * news_num, max_content_length, word_embedding_dim]
+        packed_title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False)                                                   # [batch_size * news_num, max_title_length, word_embedding_dim]
+        packed_content = pack_padded_sequence(content, content_length, batch_first=True, enforce_sorted=False)                                             # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. LSTM encoding
-        sorted_title_h, (sorted_title_h_n, sorted_title_c_n) = self.title_lstm(sorted_title)
-        sorted_content_h, (sorted_content_h_n, sorted_content_c_n) = self.content_lstm(sorted_content)
-        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=self.max_title_length)                                      # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=self.max_content_length)                                # [batch_size * news_num, max_content_length, hidden_dim * 2]
-        title_h = sorted_title_h.index_select(0, desorted_title_indices)                                                                                   # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        content_h = sorted_content_h.index_select(0, desorted_content_indices)                                                                             # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_h, (title_h_n, title_c_n) = self.title_lstm(packed_title)
+        content_h, (content_h_n, content_c_n) = self.content_lstm(packed_content)
+        title_h, _ = pad_packed_sequence(title_h, batch_first=True, total_length=title_text.size(2))                                                       # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        content_h, _ = pad_packed_sequence(content_h, batch_first=True, total_length=content_text.size(2))                                                 # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # 3. self-attention
         title_self = self.title_self_attention(title_h, title_mask)                                                                                        # [batch_size * news_num, hidden_dim * 2]
         content_self = self.content_self_attention(content_h, content_mask)                                                                                # [batch_size * news_num, hidden_dim * 2]
@@ -263,8 +245,6 @@ class CNE_wo_CS(NewsEncoder):
 class CNE_wo_CA(NewsEncoder):
     def __init__(self, config):
         super(CNE_wo_CA, self).__init__(config)
-        self.max_title_length = config.max_title_length
-        self.max_content_length = config.max_abstract_length
         self.word_embedding_dim = config.word_embedding_dim
         self.hidden_dim = config.hidden_dim
         self.news_embedding_dim = config.hidden_dim * 4 + config.category_embedding_dim + config.subCategory_embedding_dim
@@ -304,32 +284,26 @@ class CNE_wo_CA(NewsEncoder):
         batch_size = title_text.size(0)
         news_num = title_text.size(1)
         batch_news_num = batch_size * news_num
-        title_mask = title_mask.view([batch_news_num, self.max_title_length])                                                                 # [batch_size * news_num, max_title_length]
-        content_mask = content_mask.view([batch_news_num, self.max_content_length])                                                           # [batch_size * news_num, max_content_length]
+        title_mask = title_mask.view([batch_news_num, -1])                                                                                    # [batch_size * news_num, max_title_length]
+        content_mask = content_mask.view([batch_news_num, -1])                                                                                # [batch_size * news_num, max_content_length]
         title_mask[:, 0] = 1   # To avoid empty input of LSTM
         content_mask[:, 0] = 1 # To avoid empty input of LSTM
-        title_length = title_mask.sum(dim=1, keepdim=False).long()                                                                            # [batch_size * news_num]
-        content_length = content_mask.sum(dim=1, keepdim=False).long()                                                                        # [batch_size * news_num]
-        sorted_title_length, sorted_title_indices = torch.sort(title_length, descending=True)                                                 # [batch_size * news_num]
-        _, desorted_title_indices = torch.sort(sorted_title_indices, descending=False)                                                        # [batch_size * news_num]
-        sorted_content_length, sorted_content_indices = torch.sort(content_length, descending=True)                                           # [batch_size * news_num]
-        _, desorted_content_indices = torch.sort(sorted_content_indices, descending=False)                                                    # [batch_size * news_num]
+        title_length = title_mask.sum(dim=1, keepdim=False).long().cpu()                                                                      # [batch_size * news_num]
+        content_length = content_mask.sum(dim=1, keepdim=False).long().cpu()                                                                  # [batch_size * news_num]
         # 1. word embedding
-        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, self.max_title_length, self.word_embedding_dim])          # [batch_size * news_num, max_title_length, word_embedding_dim]
-        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, self.max_content_length, self.word_embedding_dim])    # [batch_size * news_num, max_content_length, word_embedding_dim]
-        sorted_title = pack_padded_sequence(title.index_select(0, sorted_title_indices), sorted_title_length.cpu(), batch_first=True)         # [batch_size * news_num, max_title_length, word_embedding_dim]
-        sorted_content = pack_padded_sequence(content.index_select(0, sorted_content_indices), sorted_content_length.cpu(), batch_first=True) # [batch_size * news_num, max_content_length, word_embedding_dim]
+        title = self.dropout(self.word_embedding(title_text)).view([batch_news_num, -1, self.word_embedding_dim])                             # [batch_size * news_num, max_title_length, word_embedding_dim]
+        content = self.dropout(self.word_embedding(content_text)).view([batch_news_num, -1, self.word_embedding_dim])                         # [batch_size * news_num, max_content_length, word_embedding_dim]
+        packed_title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False)                                      # [batch_size * news_num, max_title_length, word_embedding_dim]
+        packed_content = pack_padded_sequence(content, content_length, batch_first=True, enforce_sorted=False)                                # [batch_size * news_num, max_content_length, word_embedding_dim]
         # 2. selective LSTM encoding
-        sorted_title_h, (sorted_title_h_n, sorted_title_c_n) = self.title_lstm(sorted_title)
-        sorted_content_h, (sorted_content_h_n, sorted_content_c_n) = self.content_lstm(sorted_content)
-        sorted_title_m = torch.cat([sorted_title_c_n[0], sorted_title_c_n[1]], dim=1)                                                         # [batch_size * news_num, hidden_dim * 2]
-        sorted_content_m = torch.cat([sorted_content_c_n[0], sorted_content_c_n[1]], dim=1)                                                   # [batch_size * news_num, hidden_dim * 2]
-        sorted_title_h, _ = pad_packed_sequence(sorted_title_h, batch_first=True, total_length=self.max_title_length)                         # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_h, _ = pad_packed_sequence(sorted_content_h, batch_first=True, total_length=self.max_content_length)                   # [batch_size * news_num, max_content_length, hidden_dim * 2]
-        sorted_title_gate = torch.sigmoid(self.title_H(sorted_title_h) + self.title_M(sorted_content_m).unsqueeze(dim=1))                     # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        sorted_content_gate = torch.sigmoid(self.content_H(sorted_content_h) + self.content_M(sorted_title_m).unsqueeze(dim=1))               # [batch_size * news_num, max_content_length, hidden_dim * 2]
-        title_h = (sorted_title_h * sorted_title_gate).index_select(0, desorted_title_indices)                                                # [batch_size * news_num, max_title_length, hidden_dim * 2]
-        content_h = (sorted_content_h * sorted_content_gate).index_select(0, desorted_content_indices)                                        # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_h, (title_h_n, title_c_n) = self.title_lstm(packed_title)
+        content_h, (content_h_n, content_c_n) = self.content_lstm(packed_content)
+        title_m = torch.cat([title_c_n[0], title_c_n[1]], dim=1)                                                                              # [batch_size * news_num, hidden_dim * 2]
+        content_m = torch.cat([content_c_n[0], content_c_n[1]], dim=1)                                                                        # [batch_size * news_num, hidden_dim * 2]
+        title_h, _ = pad_packed_sequence(title_h, batch_first=True, total_length=title_text.size(2))                                          # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        content_h, _ = pad_packed_sequence(content_h, batch_first=True, total_length=content_text.size(2))                                    # [batch_size * news_num, max_content_length, hidden_dim * 2]
+        title_h = title_h * torch.sigmoid(self.title_H(title_h) + self.title_M(content_m).unsqueeze(dim=1))                                   # [batch_size * news_num, max_title_length, hidden_dim * 2]
+        content_h = content_h * torch.sigmoid(self.content_H(content_h) + self.content_M(title_m).unsqueeze(dim=1))                           # [batch_size * news_num, max_content_length, hidden_dim * 2]
         # 3. self-attention
         title_self = self.title_self_attention(title_h, title_mask)                                                                           # [batch_size * news_num, hidden_dim * 2]
         content_self = self.content_self_attention(content_h, content_mask)                                                                   # [batch_size * news_num, hidden_dim * 2]
@@ -342,6 +316,7 @@ class CNE_wo_CA(NewsEncoder):
 class SUE_wo_GCN(UserEncoder):
     def __init__(self, news_encoder, config):
         super(SUE_wo_GCN, self).__init__(news_encoder, config)
+        self.candidate_aware = True
         self.attention_dim = max(config.attention_dim, self.news_embedding_dim // 4)
         self.intraCluster_K = nn.Linear(self.news_embedding_dim, self.attention_dim, bias=True)
         self.intraCluster_Q = nn.Linear(self.news_embedding_dim, self.attention_dim, bias=True)
@@ -361,22 +336,21 @@ class SUE_wo_GCN(UserEncoder):
         nn.init.zeros_(self.clusterFeatureAffine.bias)
         self.interClusterAttention.initialize()
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        user_history_category_mask[:, -1] = 1
+        K = self.intraCluster_K(history_embedding)                                                                                             # [batch_size, max_history_num, attention_dim]
+        return {'history_embedding': history_embedding, 'K': K, 'user_history_category_mask': user_history_category_mask, 'user_history_category_indices': user_history_category_indices}
+
+    def attend(self, user_state, candidate_news_representation):
+        batch_size = candidate_news_representation.size(0)
         news_num = candidate_news_representation.size(1)
         batch_news_num = batch_size * news_num
-        user_history_category_mask[:, -1] = 1
-        user_history_category_mask = user_history_category_mask.unsqueeze(dim=1).expand(-1, news_num, -1).contiguous()                         # [batch_size, news_num, category_num]
-        user_history_category_indices = user_history_category_indices.unsqueeze(dim=1).expand(-1, news_num, -1)                                # [batch_size, news_num, max_history_num]
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, \
-                                              user_category, user_subCategory, user_embedding)                                                 # [batch_size, max_history_num, news_embedding_dim]
-        history_embedding = history_embedding.unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                                    # [batch_size, news_num, max_history_num, news_embedding_dim]
+        user_history_category_mask = user_state['user_history_category_mask'].unsqueeze(dim=1).expand(-1, news_num, -1).contiguous()           # [batch_size, news_num, category_num]
+        user_history_category_indices = user_state['user_history_category_indices'].unsqueeze(dim=1).expand(-1, news_num, -1)                  # [batch_size, news_num, max_history_num]
+        history_embedding = user_state['history_embedding'].unsqueeze(dim=1).expand(-1, news_num, -1, -1)                                      # [batch_size, news_num, max_history_num, news_embedding_dim]
         # 1. Intra-cluster attention
-        K = self.intraCluster_K(history_embedding).view([batch_news_num, self.max_history_num, self.attention_dim])                            # [batch_size * news_num, max_history_num, attention_dim]
-        Q = self.intraCluster_Q(candidate_news_representation).view([batch_news_num, self.attention_dim, 1])                                   # [batch_size * news_num, attention_dim, 1]
-        a = torch.bmm(K, Q).view([batch_size, news_num, self.max_history_num]) / self.attention_scalar                                         # [batch_size, news_num, max_history_num]
+        Q = self.intraCluster_Q(candidate_news_representation)                                                                                 # [batch_size, news_num, attention_dim]
+        a = torch.bmm(Q, user_state['K'].transpose(1, 2)) / self.attention_scalar                                                              # [batch_size, news_num, max_history_num]
         alpha_intra = scatter_softmax(a, user_history_category_indices, 2).unsqueeze(dim=3)                                                    # [batch_size, news_num, max_history_num, 1]
         intra_cluster_feature = scatter_sum(alpha_intra * history_embedding, user_history_category_indices, dim=2, dim_size=self.category_num) # [batch_size, news_num, category_num, news_embedding_dim]
         # perform non-linear transformation on intra-cluster features
@@ -384,16 +358,14 @@ class SUE_wo_GCN(UserEncoder):
         # 2. Inter-cluster attention
         inter_cluster_feature = self.interClusterAttention(
             intra_cluster_feature.view([batch_news_num, self.category_num, self.news_embedding_dim]),
-            candidate_news_representation.view([batch_news_num, self.news_embedding_dim]),
+            candidate_news_representation.reshape([batch_news_num, self.news_embedding_dim]),
             mask=user_history_category_mask.view([batch_news_num, self.category_num])
         ).view([batch_size, news_num, self.news_embedding_dim])                                                                                # [batch_size, news_num, news_embedding_dim]
         return inter_cluster_feature
 
-
 class SUE_wo_HCA(UserEncoder):
     def __init__(self, news_encoder, config):
         super(SUE_wo_HCA, self).__init__(news_encoder, config)
-        self.max_history_num = config.max_history_num
         self.proxy_node_embedding = nn.Parameter(torch.zeros([config.category_num, self.news_embedding_dim]))
         self.gcn = GCN_(in_dim=self.news_embedding_dim, out_dim=self.news_embedding_dim, hidden_dim=self.news_embedding_dim, num_layers=config.gcn_layer_num, dropout=config.dropout_rate / 2, residual=not config.no_gcn_residual, layer_norm=config.gcn_layer_norm)
         self.attention = Attention(self.news_embedding_dim, config.attention_dim)
@@ -404,16 +376,11 @@ class SUE_wo_HCA(UserEncoder):
         self.gcn.initialize()
         self.attention.initialize()
 
-    def forward(self, user_title_text, user_title_mask, user_title_entity, user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, \
-                user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding, candidate_news_representation):
-        batch_size = user_title_text.size(0)
-        news_num = candidate_news_representation.size(1)
-        history_embedding = self.news_encoder(user_title_text, user_title_mask, user_title_entity, \
-                                              user_content_text, user_content_mask, user_content_entity, user_category, user_subCategory, user_embedding) # [batch_size, max_history_num, news_embedding_dim]
+    def history_state(self, history_embedding, user_history_mask, user_history_graph, user_history_category_mask, user_history_category_indices, user_embedding):
+        batch_size = history_embedding.size(0)
         # 1. GCN
         history_embedding = torch.cat([history_embedding, self.dropout_(self.proxy_node_embedding.unsqueeze(dim=0).expand(batch_size, -1, -1))], dim=1)   # [batch_size, max_history_num + category_num, news_embedding_dim]
         gcn_feature = self.gcn(history_embedding, user_history_graph) + history_embedding                                                                 # [batch_size, max_history_num + category_num, news_embedding_dim]
-        gcn_feature = gcn_feature[:, :self.max_history_num, :]                                                                                            # [batch_size, max_history_num, news_embedding_dim]
+        gcn_feature = gcn_feature[:, :user_history_mask.size(1), :]                                                                                       # [batch_size, max_history_num, news_embedding_dim]
         # 2. Plain attention
-        user_representation = self.attention(gcn_feature).unsqueeze(dim=1).repeat(1, news_num, 1)                                                         # [batch_size, news_num, news_embedding_dim]
-        return user_representation
+        return {'user_representation': self.attention(gcn_feature)}                                                                                       # [batch_size, news_embedding_dim]